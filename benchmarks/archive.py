@@ -0,0 +1,105 @@
+'''
+Synthetic datanode DRS structured CMIP5 archives for benchmarks.
+'''
+
+import os
+
+import numpy as np
+from netCDF4 import Dataset, num2date
+
+EXPERIMENTS = ['rcp26', 'rcp45', 'rcp60', 'rcp85', 'historical']
+
+TIME_UNITS = 'days since 2006-01-01'
+
+
+def get_drs_dir(base_dir, model, experiment, member, variable, version='v20120101'):
+    return os.path.join(base_dir, 'CMIP5', 'output', 'INST', model, experiment, 'day', 'atmos', 'day', member, version, variable)
+
+
+def iter_drs_paths(base_dir, models=4, experiments=3, members=2, variables=3, files_per_variable=2):
+    '''
+    Yields datanode DRS paths of a synthetic archive of daily files, without creating anything
+    '''
+    for m in range(models):
+        for experiment in EXPERIMENTS[:experiments]:
+            for r in range(members):
+                for v in range(variables):
+                    model, member, variable = 'MODEL{}'.format(m), 'r{}i1p1'.format(r + 1), 'var{}'.format(v)
+                    for f in range(files_per_variable):
+                        fname = '{}_day_{}_{}_{}_{}0101-{}1231.nc'.format(variable, model, experiment, member, 2000 + 10 * f, 2009 + 10 * f)
+                        yield os.path.join(get_drs_dir(base_dir, model, experiment, member, variable), fname)
+
+
+def make_drs_tree(base_dir, models=4, experiments=3, members=2, variables=3, files_per_variable=2):
+    '''
+    Creates empty files in a datanode DRS layout below base_dir. Returns the number of files created
+    '''
+    n = 0
+    for fp in iter_drs_paths(base_dir, models, experiments, members, variables, files_per_variable):
+        if not os.path.exists(os.path.dirname(fp)):
+            os.makedirs(os.path.dirname(fp))
+        open(fp, 'w').close()
+        n += 1
+    return n
+
+
+def write_base_variable(fp, variable, model, days, nlat, nlon, calendar, complevel, format, seed):
+    '''
+    Writes a daily (time, lat, lon) base variable with time bounds and plausible values
+    '''
+    rs = np.random.RandomState(seed)
+    with Dataset(fp, 'w', format=format) as nc:
+        nc.model_id = model
+        nc.frequency = 'day'
+        nc.createDimension('time', None)
+        nc.createDimension('lat', nlat)
+        nc.createDimension('lon', nlon)
+        nc.createDimension('bnds', 2)
+
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = TIME_UNITS
+        time.calendar = calendar
+        time.bounds = 'time_bnds'
+        time[:] = np.arange(days) + 0.5
+        nc.createVariable('time_bnds', 'f8', ('time', 'bnds'))[:] = np.column_stack([np.arange(days), np.arange(days) + 1])
+        nc.createVariable('lat', 'f8', ('lat',))[:] = np.linspace(-90, 90, nlat)
+        nc.createVariable('lon', 'f8', ('lon',))[:] = np.linspace(0, 360, nlon, endpoint=False)
+
+        kwargs = {'zlib': True, 'complevel': complevel} if complevel and format.startswith('NETCDF4') else {}
+        var = nc.createVariable(variable, 'f4', ('time', 'lat', 'lon'), fill_value=np.float32(1e20), **kwargs)
+        # A seasonal cycle plus noise, written a year at a time
+        for start in range(0, days, 365):
+            stop = min(start + 365, days)
+            season = np.cos(2 * np.pi * np.arange(start, stop) / 365.)[:, None, None]
+            noise = rs.randn(stop - start, nlat, nlon)
+            if variable == 'pr':
+                var[start:stop] = rs.gamma(1, 2, size=(stop - start, nlat, nlon))
+            else:
+                offset = 5 if variable == 'tasmax' else -5
+                var[start:stop] = 278.15 + offset - 15 * season + 5 * noise
+
+
+def make_cmip5_archive(base_dir, models=2, experiments=1, members=1, variables=('tasmax', 'tasmin', 'pr'),
+                       days=365, nlat=64, nlon=128, calendar='365_day', complevel=0, format='NETCDF4'):
+    '''
+    Writes a synthetic archive of daily base variables below base_dir
+
+    Returns:
+        list: Paths of the files written.
+    '''
+    end = num2date(days - 1, TIME_UNITS, calendar)
+    temporal_subset = '20060101-{:04d}{:02d}{:02d}'.format(end.year, end.month, end.day)
+
+    paths = []
+    for m in range(models):
+        for experiment in EXPERIMENTS[:experiments]:
+            for r in range(members):
+                model, member = 'MODEL{}'.format(m), 'r{}i1p1'.format(r + 1)
+                for i, variable in enumerate(variables):
+                    d = get_drs_dir(base_dir, model, experiment, member, variable)
+                    os.makedirs(d)
+                    fp = os.path.join(d, '{}_day_{}_{}_{}_{}.nc'.format(variable, model, experiment, member, temporal_subset))
+                    write_base_variable(fp, variable, model, days, nlat, nlon, calendar, complevel, format,
+                                        seed=len(paths))
+                    paths.append(fp)
+    return paths
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+Benchmarks iter_netcdf_files (os.walk) against the threaded os.scandir scanner on a synthetic
+datanode DRS tree of empty files.
+
+High-latency filesystems can be approximated with --latency-ms, which delays every directory
+listing made by either scanner.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from archive import make_drs_tree
+from pyclimate.path import iter_netcdf_files
+
+
+def delay_scandir(latency):
+    '''
+    Wraps os.scandir to sleep for `latency` seconds before every listing
+    '''
+    scandir = os.scandir
+    def delayed(path='.'):
+        time.sleep(latency)
+        return scandir(path)
+    os.scandir = delayed
+
+
+def time_scan(base_dir, threads, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        n = sum(1 for x in iter_netcdf_files(base_dir, threads=threads))
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return {'threads': threads, 'files': n, 'seconds': best}
+
+
+def main(args):
+    base_dir = tempfile.mkdtemp()
+    try:
+        nfiles = make_drs_tree(base_dir, args.models, args.experiments, args.members, args.variables, args.files_per_variable)
+        if args.latency_ms:
+            delay_scandir(args.latency_ms / 1000.)
+
+        results = [time_scan(base_dir, threads, args.repeat) for threads in args.threads]
+        for r in results:
+            r['speedup'] = results[0]['seconds'] / r['seconds']
+            assert r['files'] == nfiles
+        json.dump({'benchmark': 'scan', 'latency_ms': args.latency_ms, 'files': nfiles, 'results': results}, sys.stdout, indent=2)
+        print('')
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--models', default=4, type=int)
+    parser.add_argument('--experiments', default=3, type=int)
+    parser.add_argument('--members', default=2, type=int)
+    parser.add_argument('--variables', default=3, type=int)
+    parser.add_argument('--files-per-variable', default=2, type=int)
+    parser.add_argument('--threads', nargs='+', default=[1, 4, 16], type=int, help='Thread counts to time. The first is the baseline')
+    parser.add_argument('--latency-ms', default=0, type=float, help='Simulated latency per directory listing')
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+Times the end-to-end gen_degree_days.py run and its hot spots on a synthetic CMIP5 archive.
+
+Results are written as JSON (to stdout or --output) along with the commit, library versions and
+archive parameters, so runs on different commits can be compared with --compare.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import netCDF4
+from netCDF4 import Dataset
+
+from cfmeta import Cmip5File
+
+from archive import make_cmip5_archive, iter_drs_paths
+from pyclimate import timeindex
+from pyclimate.filters import Filter
+from pyclimate.nchelpers import nc_copy_var, nc_copy_dim, get_monthly_time_slices
+from pyclimate.path import group_files_by_model_set
+from pyclimate.variables import DERIVED_VARIABLES, DerivedVariableSet
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_call(name, fn, repeat, setup=None, **info):
+    '''
+    Times fn() `repeat` times, calling setup() (untimed) before each run
+    '''
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        t0 = time.time()
+        fn()
+        times.append(time.time() - t0)
+    result = {'name': name, 'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+    result.update(info)
+    sys.stderr.write('{:<40} {:10.4f}s\n'.format(name, result['best']))
+    return result
+
+
+def reset_dir(path):
+    def setup():
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    return setup
+
+
+def bench_derived_variables(base_variables, work_dir, repeat):
+    outdir = os.path.join(work_dir, 'derived')
+    input_bytes = sum(os.path.getsize(fp) for fp in base_variables.values())
+    results = []
+    for name, cls in DERIVED_VARIABLES.items():
+        results.append(time_call('derive.{}'.format(name), lambda: cls(base_variables, outdir)(), repeat, reset_dir(outdir)))
+    everything = lambda: DerivedVariableSet([cls(base_variables, outdir) for cls in DERIVED_VARIABLES.values()])()
+    results.append(time_call('derive.fused', everything, repeat, reset_dir(outdir), input_bytes=input_bytes))
+    return results
+
+
+def bench_nc_copy_var(fp, varname, work_dir, repeat):
+    outfp = os.path.join(work_dir, 'copy.nc')
+    def copy():
+        with Dataset(fp) as nc_in, Dataset(outfp, 'w') as nc_out:
+            for dimname in nc_in.variables[varname].dimensions:
+                nc_copy_dim(nc_in, nc_out, dimname)
+            nc_copy_var(nc_in, nc_out, varname, varname, copy_data=True, copy_attrs=True)
+    return [time_call('nc_copy_var', copy, repeat, bytes=os.path.getsize(fp))]
+
+
+def bench_monthly_time_slices(fp, repeat):
+    with Dataset(fp) as nc:
+        ncvar_time = nc.variables['time']
+        return [
+            time_call('get_monthly_time_slices', lambda: get_monthly_time_slices(ncvar_time), repeat,
+                      timeindex._time_index_cache.clear, steps=len(ncvar_time)),
+            time_call('get_monthly_time_slices.cached', lambda: get_monthly_time_slices(ncvar_time), repeat)
+        ]
+
+
+def bench_filter_and_grouping(args, repeat):
+    paths = list(iter_drs_paths('/archive', args.scan_models, 5, args.scan_members, 6, 4))
+    _filter = Filter([{'model': ['MODEL1', 'MODEL3'], 'experiment': 'rcp45'}, {'ensemble_member': 'r2i1p1'}])
+    cfs = [Cmip5File(datanode_fp=fp) for fp in paths]
+    return [
+        time_call('filter.contains', lambda: sum(1 for fp in paths if fp in _filter), repeat, files=len(paths)),
+        time_call('filter.matches', lambda: sum(1 for cf in cfs if _filter.matches(cf)), repeat, files=len(paths)),
+        time_call('group_files_by_model_set', lambda: group_files_by_model_set(paths), repeat, files=len(paths)),
+    ]
+
+
+def bench_gen_degree_days(archive_dir, work_dir, args, repeat):
+    outdir = os.path.join(work_dir, 'gen_degree_days')
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'scripts', 'gen_degree_days.py'), '-i', archive_dir, '-o', outdir,
+           '-v'] + sorted(DERIVED_VARIABLES) + ['-p', str(args.processes)] + args.script_args
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR, os.environ.get('PYTHONPATH', '')]))
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, env=env, stdout=devnull, stderr=devnull)
+    return [time_call('gen_degree_days', run, repeat, reset_dir(outdir), command=' '.join(cmd[1:]))]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    '''
+    Writes the ratio of each result to the same benchmark in a baseline run to stderr
+    '''
+    before = dict((r['name'], r['best']) for r in baseline['results'])
+    sys.stderr.write('\n{:<40} {:>10} {:>10} {:>8}\n'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for r in results:
+        if r['name'] in before:
+            sys.stderr.write('{:<40} {:10.4f} {:10.4f} {:8.2f}\n'.format(r['name'], before[r['name']], r['best'], r['best'] / before[r['name']]))
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        archive_dir = os.path.join(work_dir, 'archive')
+        t0 = time.time()
+        paths = make_cmip5_archive(archive_dir, args.models, args.experiments, args.members, days=args.days,
+                                   nlat=args.nlat, nlon=args.nlon, calendar=args.calendar, complevel=args.complevel,
+                                   format=args.format)
+        sys.stderr.write('Generated {} files ({:.1f} MB) in {:.1f}s\n'.format(
+            len(paths), sum(os.path.getsize(fp) for fp in paths) / 1e6, time.time() - t0))
+
+        base_variables = dict((os.path.basename(os.path.dirname(fp)), fp) for fp in paths[:3])
+        benchmarks = [
+            ('derive', lambda: bench_derived_variables(base_variables, work_dir, args.repeat)),
+            ('nc_copy_var', lambda: bench_nc_copy_var(base_variables['tasmax'], 'tasmax', work_dir, args.repeat)),
+            ('get_monthly_time_slices', lambda: bench_monthly_time_slices(base_variables['tasmax'], args.repeat)),
+            ('filter', lambda: bench_filter_and_grouping(args, args.repeat)),
+            ('gen_degree_days', lambda: bench_gen_degree_days(archive_dir, work_dir, args, args.repeat)),
+        ]
+
+        results = []
+        for name, run in benchmarks:
+            if re.search(args.only, name):
+                results.extend(run())
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'benchmark': 'suite',
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'netCDF4': netCDF4.__version__,
+                     'hdf5': netCDF4.__hdf5libversion__, 'netcdf': netCDF4.__netcdf4libversion__},
+        'platform': platform.platform(),
+        'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('output', 'compare')),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--models', default=2, type=int, help='Number of models in the archive')
+    parser.add_argument('--experiments', default=1, type=int, help='Number of experiments per model')
+    parser.add_argument('--members', default=1, type=int, help='Number of ensemble members per experiment')
+    parser.add_argument('--days', default=365, type=int, help='Length of the time axis')
+    parser.add_argument('--nlat', default=64, type=int)
+    parser.add_argument('--nlon', default=128, type=int)
+    parser.add_argument('--calendar', default='365_day')
+    parser.add_argument('--complevel', default=0, type=int, help='zlib compression level of the inputs')
+    parser.add_argument('--format', default='NETCDF4', choices=['NETCDF4', 'NETCDF4_CLASSIC', 'NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET'])
+    parser.add_argument('--scan-models', default=20, type=int, help='Number of models in the path list used for filter and grouping benchmarks')
+    parser.add_argument('--scan-members', default=5, type=int)
+    parser.add_argument('--processes', default=1, type=int, help='gen_degree_days.py --processes')
+    parser.add_argument('--script-args', nargs=argparse.REMAINDER, default=[], help='Further arguments to gen_degree_days.py')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--only', default='', help='Only run benchmark groups matching this regular expression')
+    parser.add_argument('-o', '--output', help='Write results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results of a previous run to compare against')
+    args = parser.parse_args()
+
+    main(args)
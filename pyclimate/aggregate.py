@@ -0,0 +1,96 @@
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+'''
+Streaming temporal aggregation of blocks of time steps into fixed periods (eg: monthly totals).
+
+Blocks do not need to line up with period boundaries: sums for the period still open at the
+end of a block are carried over to the next block.
+'''
+
+CELL_METHODS = ('sum', 'mean')
+
+
+class TimeAggregator(object):
+    """Accumulates consecutive blocks of time steps into the periods of a list of slices.
+
+    Completed periods are written to the output variable as soon as the block containing
+    their last time step is added. Any period containing a masked value is masked.
+
+    Attributes:
+        time_slices (list): Consecutive slices of the source time axis. One per output step.
+        ncvar_out (netCDF4.Variable): Output variable with one time step per slice.
+        method (str): How time steps are combined. One of ``CELL_METHODS``.
+    """
+
+    def __init__(self, time_slices, ncvar_out, method='sum'):
+        """Initializes a ``TimeAggregator``
+
+        Args:
+            Same as ``Attributes``
+        """
+        if method not in CELL_METHODS:
+            raise ValueError('Unknown aggregation method {}. Expected one of {}'.format(method, CELL_METHODS))
+        self.time_slices = time_slices
+        self.ncvar_out = ncvar_out
+        self.method = method
+
+        self.starts = np.array([s.start for s in time_slices])
+        self.stops = np.array([s.stop for s in time_slices])
+
+        # Running totals for the period left open by the previous block
+        self._open_sum = None
+        self._open_mask = None
+
+    def add(self, block_slice, data):
+        """Adds the data for a block of time steps.
+
+        Blocks must be added in order and together cover the source time axis.
+
+        Args:
+            block_slice (slice): Time steps of the source covered by `data`.
+            data (numpy.ndarray): Values for the block, time as the leading axis.
+        """
+        first = np.searchsorted(self.stops, block_slice.start, side='right')
+        last = np.searchsorted(self.starts, block_slice.stop, side='left')
+        if first == last:
+            return
+
+        offsets = np.maximum(self.starts[first:last], block_slice.start) - block_slice.start
+        sums = np.add.reduceat(np.ma.getdata(data), offsets, axis=0, dtype=np.float64)
+        mask = np.ma.getmask(data)
+        if mask is not np.ma.nomask:
+            mask = np.logical_or.reduceat(mask, offsets, axis=0)
+
+        if self._open_sum is not None:
+            sums[0] += self._open_sum
+            if self._open_mask is not None:
+                mask = self._open_mask_merged(mask, sums.shape)
+            self._open_sum = self._open_mask = None
+
+        ncomplete = last - first
+        if self.stops[last - 1] > block_slice.stop:
+            ncomplete -= 1
+            self._open_sum = sums[-1]
+            self._open_mask = mask[-1] if mask is not np.ma.nomask else None
+
+        if ncomplete:
+            self._write(slice(first, first + ncomplete), sums[:ncomplete], mask if mask is np.ma.nomask else mask[:ncomplete])
+
+    def _open_mask_merged(self, mask, shape):
+        if mask is np.ma.nomask:
+            mask = np.zeros(shape, dtype=bool)
+        mask[0] |= self._open_mask
+        return mask
+
+    def _write(self, period_slice, sums, mask):
+        if self.method == 'mean':
+            lengths = self.stops[period_slice] - self.starts[period_slice]
+            sums /= lengths.reshape((-1,) + (1,) * (sums.ndim - 1))
+        if mask is not np.ma.nomask:
+            sums = np.ma.masked_array(sums, mask=mask)
+        self.ncvar_out[period_slice] = sums
+        log.debug('Wrote aggregated periods {}-{}'.format(period_slice.start, period_slice.stop))
@@ -0,0 +1,203 @@
+import logging
+from functools import reduce
+
+import numpy as np
+from netCDF4 import num2date, date2num
+
+from pyclimate.concat import open_virtual_dataset
+from pyclimate.timeindex import parse_units
+
+log = logging.getLogger(__name__)
+
+'''
+Alignment of the time axes and grids of the base variables of a derivation.
+
+Derivations combine base variables step by step and cell by cell, which is only meaningful if
+their grids are identical and they are read over the same dates. Time coordinates are loaded
+once per variable, converted to the units of the first, and matched with vectorized set
+operations: variables covering different but overlapping periods are read over the period they
+share, each from its own offset.
+'''
+
+# Calendars that are the same under different names
+CALENDAR_ALIASES = {'gregorian': 'standard', 'noleap': '365_day', 'all_leap': '366_day'}
+
+# Coordinates are equal within this tolerance
+COORDINATE_ATOL = 1e-6
+
+
+class AlignmentError(ValueError):
+    """Raised for base variables whose grids or time axes can not be aligned.
+    """
+    pass
+
+
+def get_calendar(ncvar_time):
+    calendar = getattr(ncvar_time, 'calendar', 'standard').lower()
+    return CALENDAR_ALIASES.get(calendar, calendar)
+
+
+def get_time_seconds(ncvar_time, units=None):
+    '''
+    Returns the time coordinates of a variable as whole seconds since the reference date of `units`
+
+    Values are converted with a single scale and offset, so the conversion is vectorized
+    whatever the calendar. Defaults to the variable's own units.
+    '''
+    values = np.ma.getdata(ncvar_time[:]).astype(np.float64)
+    scale, ref = parse_units(ncvar_time.units)
+    days = values * scale
+    if units is not None and units != ncvar_time.units:
+        calendar = get_calendar(ncvar_time)
+        days += date2num(num2date(0, ncvar_time.units, calendar), 'days since {}'.format(parse_units(units)[1]), calendar)
+    return np.round(days * 86400).astype(np.int64)
+
+
+class TimeAlignment(object):
+    """Time steps shared by the base variables of a derivation.
+
+    Attributes:
+        offsets (dict): Base variable name to the index of its first shared time step.
+        nsteps (int): Number of shared time steps.
+        lengths (dict): Base variable name to the length of its time axis.
+    """
+
+    def __init__(self, offsets, nsteps, lengths):
+        """Initializes a ``TimeAlignment``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.offsets = offsets
+        self.nsteps = nsteps
+        self.lengths = lengths
+
+    @property
+    def is_identity(self):
+        """Whether every variable is read over its whole time axis.
+        """
+        return all(self.offsets[x] == 0 and self.lengths[x] == self.nsteps for x in self.offsets)
+
+    def get_slice(self, varname, block_slice=slice(None)):
+        """Returns the time steps of a variable for a slice of the shared time steps.
+        """
+        start, stop, _ = block_slice.indices(self.nsteps)
+        return slice(start + self.offsets[varname], stop + self.offsets[varname])
+
+
+def check_grids(nc_bases, varname=None):
+    '''
+    Checks that the base variables share the same non-time dimensions and coordinates
+
+    Args:
+        nc_bases (dict): Base variable name to its open Dataset.
+        varname (str): Name of the variable in every Dataset, if the keys of `nc_bases` are
+            not variable names (eg: the members of an ensemble).
+
+    Raises:
+        AlignmentError: If the grids differ.
+    '''
+    names = sorted(nc_bases)
+    reference = names[0]
+    ncvar_ref = nc_bases[reference].variables[varname or reference]
+    for x in names[1:]:
+        ncvar = nc_bases[x].variables[varname or x]
+        if ncvar.shape[1:] != ncvar_ref.shape[1:]:
+            raise AlignmentError('Grid of {} {} differs from {} {}'.format(x, ncvar.shape[1:], reference, ncvar_ref.shape[1:]))
+        for dim, dim_ref in zip(ncvar.dimensions[1:], ncvar_ref.dimensions[1:]):
+            if dim in nc_bases[x].variables and dim_ref in nc_bases[reference].variables:
+                coords = np.ma.getdata(nc_bases[x].variables[dim][:])
+                coords_ref = np.ma.getdata(nc_bases[reference].variables[dim_ref][:])
+                if not np.allclose(coords, coords_ref, rtol=0, atol=COORDINATE_ATOL):
+                    raise AlignmentError('{} coordinates of {} differ from those of {}'.format(dim, x, reference))
+
+
+def align_time_axes(nc_bases):
+    '''
+    Returns the TimeAlignment of the time steps shared by all base variables
+
+    Args:
+        nc_bases (dict): Base variable name to its open Dataset.
+
+    Raises:
+        AlignmentError: If calendars differ, a time axis is not increasing, no time step is
+            shared, or a variable is missing time steps within the shared period.
+    '''
+    names = sorted(nc_bases)
+    ncvar_times = dict((x, nc_bases[x].variables['time']) for x in names)
+    calendars = set(get_calendar(ncvar_time) for ncvar_time in ncvar_times.values())
+    if len(calendars) > 1:
+        raise AlignmentError('Base variables {} have different calendars {}'.format(names, sorted(calendars)))
+
+    units = ncvar_times[names[0]].units
+    seconds = dict((x, get_time_seconds(ncvar_times[x], units)) for x in names)
+    for x in names:
+        if np.any(np.diff(seconds[x]) <= 0):
+            raise AlignmentError('Time axis of {} is not strictly increasing'.format(x))
+
+    shared = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), seconds.values())
+    if len(shared) == 0:
+        raise AlignmentError('Base variables {} share no time steps'.format(names))
+
+    offsets = {}
+    for x in names:
+        start = int(np.searchsorted(seconds[x], shared[0]))
+        # The shared steps must be consecutive in every variable to be read as one range
+        if not np.array_equal(seconds[x][start:start + len(shared)], shared):
+            raise AlignmentError('{} is missing time steps within the period shared with {}'.format(x, names))
+        offsets[x] = start
+
+    alignment = TimeAlignment(offsets, len(shared), dict((x, len(seconds[x])) for x in names))
+    if not alignment.is_identity:
+        log.info('Reading the {} time steps shared by {} from offsets {}'.format(len(shared), names, offsets))
+    return alignment
+
+
+def group_by_shared_time_steps(nc_bases, var_groups):
+    '''
+    Groups sets of base variables by the time steps each of them shares
+
+    The base variables of every set in a group, taken together, share the same time steps as
+    those of each set on their own, so derivations from them can be read and aligned together.
+
+    Args:
+        nc_bases (dict): Base variable name to its open Dataset.
+        var_groups (list): Sets of base variable names, eg: the required variables of each output.
+
+    Returns:
+        list: Lists of indices into `var_groups`, in order of their first set.
+    '''
+    names = sorted(nc_bases)
+    units = nc_bases[names[0]].variables['time'].units
+    seconds = dict((x, get_time_seconds(nc_bases[x].variables['time'], units)) for x in names)
+    shared = [reduce(np.intersect1d, [seconds[x] for x in varnames]) for varnames in var_groups]
+
+    groups = []
+    for i, steps in enumerate(shared):
+        for group in groups:
+            if np.array_equal(shared[group[0]], steps):
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+    return groups
+
+
+def open_time_subset(nc_base, varname, time_slice):
+    '''
+    Returns a diskless stand in for the Dataset of a base variable over time steps `time_slice` only
+
+    See ``pyclimate.concat.open_virtual_dataset``.
+    '''
+    ncvar_time = nc_base.variables['time']
+    bounds_name = getattr(ncvar_time, 'bounds', None)
+    bounds = nc_base.variables[bounds_name][time_slice] if bounds_name in nc_base.variables else None
+    return open_virtual_dataset(nc_base, varname, ncvar_time[time_slice], bounds)
+
+
+def align_base_variables(nc_bases, varname=None):
+    '''
+    Checks the grids of the base variables and aligns their time axes. See ``check_grids`` and ``align_time_axes``
+    '''
+    check_grids(nc_bases, varname)
+    return align_time_axes(nc_bases)
@@ -0,0 +1,46 @@
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+'''
+Preallocated arrays reused from one block of time steps to the next.
+'''
+
+
+class BufferPool(object):
+    """Hands out reusable arrays by name, shape and type.
+
+    Each name is backed by a ring of ``size`` arrays, so an array is only handed out again
+    after ``size - 1`` more requests for the same name. A pool used by one stage of a pipeline
+    should have one array per block that can be in flight at once.
+
+    Attributes:
+        size (int): Number of arrays per name, shape and type.
+    """
+
+    def __init__(self, size=1):
+        """Initializes a ``BufferPool``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.size = max(1, size)
+        self._rings = {}
+
+    def get(self, name, shape, dtype):
+        """Returns the next array of a ring. Its contents are undefined.
+        """
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        ring = self._rings.get(key)
+        if ring is None:
+            log.debug('Allocating {} buffers {} {}'.format(self.size, name, key[1:]))
+            ring = self._rings[key] = [[np.empty(shape, dtype=dtype) for i in range(self.size)], 0]
+        arrays, position = ring
+        ring[1] = (position + 1) % self.size
+        return arrays[position]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for arrays, position in self._rings.values() for a in arrays)
@@ -0,0 +1,227 @@
+import os
+import json
+import fnmatch
+import logging
+import sqlite3
+
+from netCDF4 import Dataset
+
+from cfmeta import Cmip5File
+from cfmeta.cmip5file import get_datanode_fp_meta
+from cfmeta.exceptions import PathError
+from pyclimate.filters import Filter
+from pyclimate.path import group_cmip5_files_by_model_set
+
+log = logging.getLogger(__name__)
+
+'''
+A persistent SQLite catalog of the NetCDF files in an archive.
+
+Each file is stored with its parsed DRS facets, size, mtime and (optionally) dimension lengths and
+calendar. Rescans are incremental: a directory whose mtime is unchanged since it was last listed
+is not listed again, its known files and subdirectories are taken from the catalog instead. Files
+modified in place (which does not change their directory's mtime) are picked up with refresh(full=True).
+'''
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'pyclimate', 'catalog.sqlite')
+
+FACETS = ['activity', 'product', 'institute', 'model', 'experiment', 'frequency', 'modeling_realm',
+          'mip_table', 'ensemble_member', 'version_number', 'variable_name', 'temporal_subset']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT,
+    size INTEGER,
+    mtime REAL,
+    {facets},
+    dimensions TEXT,
+    calendar TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_model_set ON files (model, experiment, ensemble_member, temporal_subset);
+CREATE INDEX IF NOT EXISTS files_variable_name ON files (variable_name);
+'''.format(facets=',\n    '.join('{} TEXT'.format(x) for x in FACETS))
+
+
+class Catalog(object):
+    """A persistent catalog of the NetCDF files below one or more archive directories.
+
+    Attributes:
+        db_path (str): Location of the SQLite database.
+        read_headers (bool): Store dimension lengths and calendar of new or changed files.
+    """
+
+    def __init__(self, db_path=DEFAULT_CATALOG_PATH, read_headers=True):
+        """Initializes a ``Catalog``, creating the database if needed.
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.db_path = db_path
+        self.read_headers = read_headers
+
+        if db_path != ':memory:' and not os.path.exists(os.path.dirname(os.path.abspath(db_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)))
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def refresh(self, base_dir, pattern='*.nc', full=False):
+        """Brings the catalog up to date with the files below base_dir.
+
+        Args:
+            base_dir (str): Archive directory to scan.
+            pattern (str): Shell pattern of file names to catalog.
+            full (bool): List every directory and stat every file, regardless of directory mtimes.
+
+        Returns:
+            dict: Counts of 'listed' directories and 'added'/'updated'/'removed' files.
+        """
+        base_dir = os.path.abspath(base_dir)
+        stats = {'listed': 0, 'added': 0, 'updated': 0, 'removed': 0}
+
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO directories (path, parent, mtime) VALUES (?, NULL, NULL)', (base_dir,))
+            stack = [base_dir]
+            while stack:
+                path = stack.pop()
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    self._remove_tree(path, stats)
+                    continue
+
+                row = self.conn.execute('SELECT mtime FROM directories WHERE path = ?', (path,)).fetchone()
+                if not full and row and row['mtime'] == mtime:
+                    subdirs = [r['path'] for r in self.conn.execute('SELECT path FROM directories WHERE parent = ?', (path,))]
+                else:
+                    subdirs = self._list_directory(path, pattern, stats)
+                    self.conn.execute('UPDATE directories SET mtime = ? WHERE path = ?', (mtime, path))
+                    stats['listed'] += 1
+                stack.extend(subdirs)
+
+        log.info('Refreshed catalog for {}: {}'.format(base_dir, stats))
+        return stats
+
+    def _list_directory(self, path, pattern, stats):
+        entries = sorted(os.listdir(path))
+        subdirs = [os.path.join(path, x) for x in entries if os.path.isdir(os.path.join(path, x))]
+        files = [os.path.join(path, x) for x in fnmatch.filter(entries, pattern) if os.path.isfile(os.path.join(path, x))]
+
+        known_subdirs = set(r['path'] for r in self.conn.execute('SELECT path FROM directories WHERE parent = ?', (path,)))
+        for subdir in known_subdirs.difference(subdirs):
+            self._remove_tree(subdir, stats)
+        self.conn.executemany('INSERT OR IGNORE INTO directories (path, parent, mtime) VALUES (?, ?, NULL)',
+                              [(x, path) for x in subdirs])
+
+        known_files = dict((r['path'], (r['size'], r['mtime'])) for r in
+                           self.conn.execute('SELECT path, size, mtime FROM files WHERE directory = ?', (path,)))
+        for fp in set(known_files).difference(files):
+            self.conn.execute('DELETE FROM files WHERE path = ?', (fp,))
+            stats['removed'] += 1
+        for fp in files:
+            st = os.stat(fp)
+            if known_files.get(fp) == (st.st_size, st.st_mtime):
+                continue
+            stats['updated' if fp in known_files else 'added'] += 1
+            self._add_file(fp, path, st)
+
+        return subdirs
+
+    def _add_file(self, fp, directory, st):
+        try:
+            meta = get_datanode_fp_meta(fp)
+        except PathError:
+            log.warning('Unable to parse DRS facets from {}'.format(fp))
+            meta = {}
+
+        dimensions = calendar = None
+        if self.read_headers:
+            try:
+                with Dataset(fp) as nc:
+                    dimensions = json.dumps(dict((k, len(v)) for k, v in nc.dimensions.items()))
+                    if 'time' in nc.variables and 'calendar' in nc.variables['time'].ncattrs():
+                        calendar = nc.variables['time'].calendar
+            except (IOError, OSError, RuntimeError):
+                log.warning('Unable to read header of {}'.format(fp))
+
+        columns = ['path', 'directory', 'size', 'mtime'] + FACETS + ['dimensions', 'calendar']
+        values = [fp, directory, st.st_size, st.st_mtime] + [meta.get(x) for x in FACETS] + [dimensions, calendar]
+        self.conn.execute('INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(', '.join(columns), ', '.join('?' * len(columns))), values)
+
+    def _remove_tree(self, path, stats):
+        prefix = path.rstrip(os.sep) + os.sep
+        stats['removed'] += self.conn.execute('DELETE FROM files WHERE directory = ? OR substr(directory, 1, ?) = ?',
+                                              (path, len(prefix), prefix)).rowcount
+        self.conn.execute('DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(prefix), prefix))
+
+    def query(self, _filter=None, base_dir=None):
+        """Returns catalog rows included in a filter, ordered by path.
+
+        Filter entries on DRS facets are run as indexed SQL conditions. Entries on any other
+        Cmip5File attribute (eg: t_start) are matched in Python. The catalog may hold several
+        archives, so rows are restricted to those below `base_dir` when it is given.
+        """
+        _filter = Filter(_filter)
+        sql = 'SELECT * FROM files WHERE model IS NOT NULL'
+        params = []
+        if base_dir is not None:
+            prefix = os.path.abspath(base_dir).rstrip(os.sep) + os.sep
+            sql += ' AND substr(path, 1, ?) = ?'
+            params.extend([len(prefix), prefix])
+        exact = all(att in FACETS for entry in _filter.compiled for att in entry)
+
+        if _filter.compiled and exact:
+            clauses = []
+            for entry in _filter.compiled:
+                conditions = []
+                for att, vals in sorted(entry.items()):
+                    conditions.append('{} IN ({})'.format(att, ', '.join('?' * len(vals))))
+                    params.extend(sorted(vals))
+                clauses.append('({})'.format(' AND '.join(conditions) or '1'))
+            sql += ' AND ({})'.format(' OR '.join(clauses))
+
+        for row in self.conn.execute(sql + ' ORDER BY path', params):
+            if exact or _filter.matches(get_cmip5_file(row)):
+                yield row
+
+    def iter_matching_cmip5_file(self, _filter=None, base_dir=None):
+        """Yields the paths of cataloged files below base_dir included in a filter.
+
+        Equivalent to ``pyclimate.path.iter_matching_cmip5_file`` over a full scan of base_dir.
+        """
+        for row in self.query(_filter, base_dir):
+            yield row['path']
+
+    def group_files_by_model_set(self, _filter=None, concatenate=False, base_dir=None):
+        """Groups cataloged files below base_dir included in a filter into model sets.
+
+        Equivalent to ``pyclimate.path.group_files_by_model_set`` without re-parsing any path.
+        """
+        rows = self.query(_filter, base_dir)
+        return group_cmip5_files_by_model_set(((get_cmip5_file(row), row['path']) for row in rows), concatenate)
+
+    def get_header(self, fp):
+        """Returns the cataloged (dimensions, calendar) of a file, or None if it is not cataloged.
+        """
+        row = self.conn.execute('SELECT dimensions, calendar FROM files WHERE path = ?', (fp,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row['dimensions']) if row['dimensions'] else None, row['calendar']
+
+
+def get_cmip5_file(row):
+    '''
+    Builds a Cmip5File from the facets of a catalog row
+    '''
+    return Cmip5File(**dict((x, row[x]) for x in FACETS if row[x]))
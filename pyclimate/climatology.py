@@ -0,0 +1,298 @@
+import os
+import logging
+from collections import namedtuple
+
+import numpy as np
+from netCDF4 import Dataset, default_fillvals
+
+from pyclimate.concat import open_base_dataset
+from pyclimate.handles import release_dataset
+from pyclimate.nchelpers import get_monthly_time_slices, get_time_slice_bounds, get_time_block_size, iter_time_blocks, \
+    nc_copy_atts, nc_copy_dim
+from pyclimate.reader import open_variable
+from pyclimate.timeindex import get_time_index
+from pyclimate.variables import DEFAULT_MAX_BLOCK_MB, get_output_file_path_from_base
+
+log = logging.getLogger(__name__)
+
+'''
+Streaming multi-decade climatologies of daily base and derived variables.
+
+A file is read once, in blocks of time steps, and every month (or season) of every period is
+accumulated as it goes by: per grid cell running sums and counts of the valid values, and
+optionally sums of squared deviations for the variance. Memory holds one block and the
+accumulators, whatever the length of the record. Each period is written to its own CF
+climatology NetCDF, with ``climatology_bounds`` in place of time bounds.
+'''
+
+CLIMATOLOGY_FREQUENCIES = {
+    'monthly': 'monClim',
+    'seasonal': 'seaClim'
+}
+
+CLIMATOLOGY_METHODS = ('mean', 'sum')
+
+# The standard PCIC periods: baseline, 2050s and 2080s
+DEFAULT_PERIODS = ((1971, 2000), (2041, 2070), (2071, 2100))
+
+CELL_METHODS = {
+    'mean': 'time: mean within years time: mean over years',
+    'sum': 'time: sum within years time: mean over years',
+    'std': 'time: standard_deviation'
+}
+
+# Attributes of the source variable that do not apply to its climatology
+SKIPPED_ATTRIBUTES = ('_FillValue', 'missing_value', 'scale_factor', 'add_offset', 'valid_min', 'valid_max',
+                      'valid_range', 'cell_methods')
+
+# A month or season of a period. `months` indexes the monthly slices of the source time axis
+# belonging to it, `first` those of its first year and `years` its number of years
+Climatology = namedtuple('Climatology', ['period', 'group', 'months', 'first', 'years'])
+
+
+def get_climatologies(ncvar_time, periods, freq='monthly'):
+    '''
+    Returns a list of Climatology per period, one per month or season, from the monthly slices of a time axis
+
+    Seasons belong to the year they end in, so the DJF of a period starts with the December
+    before it. Periods the time axis does not cover in full are skipped.
+    '''
+    if freq not in CLIMATOLOGY_FREQUENCIES:
+        raise ValueError('Unknown climatology frequency {}. Expected one of {}'.format(freq, sorted(CLIMATOLOGY_FREQUENCIES)))
+    index = get_time_index(ncvar_time)
+    starts = np.array([s.start for s in get_monthly_time_slices(ncvar_time)], dtype=int)
+    years, months = index.years[starts], index.months[starts]
+    if freq == 'monthly':
+        groups, group_years, ngroups = months - 1, years, 12
+    else:
+        groups, group_years, ngroups = (months % 12) // 3, years + (months == 12), 4
+
+    climatologies = []
+    for start, end in periods:
+        nyears = end - start + 1
+        # A complete period has every month of every year
+        in_period = (group_years >= start) & (group_years <= end)
+        if np.count_nonzero(in_period) < nyears * 12:
+            log.warning('Time axis does not cover {}-{}, skipping it'.format(start, end))
+            continue
+        for group in range(ngroups):
+            selected = np.flatnonzero(in_period & (groups == group))
+            first = selected[group_years[selected] == start]
+            climatologies.append(Climatology((start, end), group, selected, first, nyears))
+    return climatologies
+
+
+class ClimatologyAccumulator(object):
+    """Running per cell statistics of the valid values of each of a number of climatologies.
+
+    Runs of time steps are merged into the running statistics with the pairwise form of
+    Welford's algorithm (Chan et al.), so variances are as accurate as with a two pass
+    algorithm without holding more than a run of time steps.
+
+    Attributes:
+        sums (numpy.ndarray): Sum of the valid values per climatology and cell.
+        counts (numpy.ndarray): Number of valid values per climatology and cell.
+        m2 (numpy.ndarray): Sum of squared deviations from the mean per climatology and cell,
+            or None if the variance is not needed.
+    """
+
+    def __init__(self, nclimatologies, grid_shape, variance=False):
+        """Initializes a ``ClimatologyAccumulator``
+
+        Args:
+            nclimatologies (int): Number of climatologies.
+            grid_shape (tuple): Shape of a time step.
+            variance (bool): Accumulate the sums of squared deviations.
+        """
+        shape = (nclimatologies,) + tuple(grid_shape)
+        self.sums = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.m2 = np.zeros(shape) if variance else None
+
+    def add(self, i, data, mask=None):
+        """Adds consecutive time steps of climatology `i`, ignoring those where `mask` is True.
+        """
+        valid = None if mask is None else ~mask
+        if valid is None:
+            sums = data.sum(axis=0, dtype=np.float64)
+            counts = len(data)
+        else:
+            sums = np.where(valid, data, 0).sum(axis=0, dtype=np.float64)
+            counts = valid.sum(axis=0)
+
+        if self.m2 is not None:
+            n = self.counts[i]
+            total = n + counts
+            mean = sums / np.maximum(counts, 1)
+            deviations = np.square(data - mean) if valid is None else np.where(valid, np.square(data - mean), 0)
+            delta = mean - self.sums[i] / np.maximum(n, 1)
+            self.m2[i] += deviations.sum(axis=0) + np.square(delta) * n * counts / np.maximum(total, 1)
+
+        self.sums[i] += sums
+        self.counts[i] += counts
+
+    def mean(self, i):
+        return np.ma.masked_array(self.sums[i] / np.maximum(self.counts[i], 1), mask=self.counts[i] == 0)
+
+    def std(self, i):
+        """Sample standard deviation, masked where there are fewer than two valid values.
+        """
+        return np.ma.masked_array(np.sqrt(self.m2[i] / np.maximum(self.counts[i] - 1, 1)), mask=self.counts[i] < 2)
+
+
+def get_climatology_output_path(fp, varname, outdir, freq, period):
+    return get_output_file_path_from_base(fp, varname, outdir, frequency=CLIMATOLOGY_FREQUENCIES[freq],
+                                          temporal_subset='{:04d}0101-{:04d}1231'.format(*period))
+
+
+def get_output_netcdf_climatology(nc_base, varname, outfp, freq, climatologies, lower, upper, variance=False, method='mean', complevel=4):
+    '''
+    Prepares a CF climatology NetCDF for the climatologies of one period of a variable
+
+    Args:
+        nc_base (netCDF4.Dataset): Source of the variable, its grid and attributes.
+        varname (str): Variable name.
+        outfp (str): Location to create the new netCDF4.Dataset
+        freq (str): One of ``CLIMATOLOGY_FREQUENCIES``.
+        climatologies (list): Climatology of each time step of the output.
+        lower, upper (numpy.ndarray): Time bounds of each monthly slice of the source.
+        variance (bool): Also create a variable for the standard deviation.
+        method (str): One of ``CLIMATOLOGY_METHODS``.
+        complevel (int): zlib compression level. 0 disables compression.
+
+    Returns:
+        netCDF4.Dataset: The new netCDF4.Dataset
+    '''
+    if not os.path.exists(os.path.dirname(outfp)):
+        os.makedirs(os.path.dirname(outfp))
+    ncvar_base = nc_base.variables[varname]
+    nc = Dataset(outfp, 'w')
+    nc_copy_atts(nc_base, nc)
+    nc.frequency = CLIMATOLOGY_FREQUENCIES[freq]
+
+    nc.createDimension('time', len(climatologies))
+    nc.createDimension('bnds', 2)
+    for dim in ncvar_base.dimensions[1:]:
+        nc_copy_dim(nc_base, nc, dim)
+
+    # Each step is placed in the middle of its first year and bounded by the whole period
+    ncvar_time_base = nc_base.variables['time']
+    ncvar_time = nc.createVariable('time', 'f8', ('time',))
+    ncvar_time.setncatts(dict((k, ncvar_time_base.getncattr(k)) for k in ncvar_time_base.ncattrs() if k not in ('_FillValue', 'bounds')))
+    ncvar_time.climatology = 'climatology_bounds'
+    ncvar_time[:] = [(lower[c.first[0]] + upper[c.first[-1]]) / 2. for c in climatologies]
+    ncvar_bounds = nc.createVariable('climatology_bounds', 'f8', ('time', 'bnds'))
+    ncvar_bounds[:] = [(lower[c.months[0]], upper[c.months[-1]]) for c in climatologies]
+
+    atts = dict((k, ncvar_base.getncattr(k)) for k in ncvar_base.ncattrs() if k not in SKIPPED_ATTRIBUTES)
+    create_kwargs = {'fill_value': default_fillvals['f4'], 'zlib': bool(complevel), 'complevel': complevel or 4}
+    ncvar = nc.createVariable(varname, 'f4', ncvar_base.dimensions, **create_kwargs)
+    ncvar.setncatts(atts)
+    ncvar.cell_methods = CELL_METHODS[method]
+    if variance:
+        ncvar_std = nc.createVariable(varname + '_std', 'f4', ncvar_base.dimensions, **create_kwargs)
+        ncvar_std.setncatts(atts)
+        if 'long_name' in atts:
+            ncvar_std.long_name = 'Standard deviation of {}'.format(atts['long_name'])
+        ncvar_std.cell_methods = CELL_METHODS['std']
+    return nc
+
+
+def generate_climatologies(fp, varname, outdir, periods=DEFAULT_PERIODS, freq='monthly', method='mean', variance=False,
+                           max_block_mb=DEFAULT_MAX_BLOCK_MB, reader='auto', complevel=4):
+    '''
+    Generates the climatologies of a daily variable for each period, in a single pass over the variable
+
+    Only the time steps within the periods are read. Masked values are left out; a cell is
+    masked where a month or season has no valid values.
+
+    Args:
+        fp (str): File of the variable, or a list of its temporal pieces.
+        varname (str): Variable name. eg: 'gdd'
+        outdir (str): Root directory to place output files.
+        periods (list): (first year, last year) of each period.
+        freq (str): Climatologies of each month or season. One of ``CLIMATOLOGY_FREQUENCIES``.
+        method (str): 'mean' for the mean of the time steps, or 'sum' for the mean over years
+            of the total of each month or season (the mean times the average number of time
+            steps in a month or season).
+        variance (bool): Also write the standard deviation of the time steps as `varname`_std.
+        max_block_mb (float): Memory budget (MB) for each block of time steps read.
+        reader (str): How the variable is read. See ``pyclimate.reader``.
+        complevel (int): zlib compression level of the outputs. 0 disables compression.
+
+    Returns:
+        list: Locations of the generated NetCDFs, one per period the variable covers.
+
+    Raises:
+        ValueError: If the variable covers none of the periods.
+    '''
+    if method not in CLIMATOLOGY_METHODS:
+        raise ValueError('Unknown climatology method {}. Expected one of {}'.format(method, CLIMATOLOGY_METHODS))
+
+    outputs = []
+    nc_base = open_base_dataset(fp, varname)
+    try:
+        ncvar_time = nc_base.variables['time']
+        climatologies = get_climatologies(ncvar_time, periods, freq)
+        if not climatologies:
+            raise ValueError('{} covers none of the periods {}'.format(fp, list(periods)))
+        month_slices = get_monthly_time_slices(ncvar_time)
+        lower, upper = get_time_slice_bounds(nc_base, month_slices)
+        ncvar = nc_base.variables[varname]
+        grid_shape = ncvar.shape[1:]
+        # The block read, its mask and the deviations from the mean
+        block_size = get_time_block_size(ncvar, max_block_mb, 3)
+
+        for period in sorted(set(c.period for c in climatologies)):
+            outfp = get_climatology_output_path(fp, varname, outdir, freq, period)
+            selected = [c for c in climatologies if c.period == period]
+            nc_out = get_output_netcdf_climatology(nc_base, varname, outfp, freq, selected, lower, upper, variance, method, complevel)
+            outputs.append((outfp, nc_out, [climatologies.index(c) for c in selected]))
+    except Exception:
+        for outfp, nc_out, indices in outputs:
+            nc_out.close()
+        raise
+    finally:
+        release_dataset(nc_base)
+
+    try:
+        # Climatology of each monthly slice, or -1 for slices outside of every period
+        keys = np.full(len(month_slices), -1)
+        for i, c in enumerate(climatologies):
+            keys[c.months] = i
+        starts = np.array([s.start for s in month_slices], dtype=int)
+        stops = np.array([s.stop for s in month_slices], dtype=int)
+        needed = np.flatnonzero(keys >= 0)
+        first_step, last_step = starts[needed[0]], stops[needed[-1]]
+
+        accumulator = ClimatologyAccumulator(len(climatologies), grid_shape, variance)
+        variable = open_variable(fp, varname, reader)
+        try:
+            for block_slice in iter_time_blocks(last_step - first_step, block_size):
+                block_slice = slice(block_slice.start + first_step, block_slice.stop + first_step)
+                data, mask = variable.read(block_slice)
+                first = np.searchsorted(stops, block_slice.start, side='right')
+                last = np.searchsorted(starts, block_slice.stop, side='left')
+                for i in range(first, last):
+                    if keys[i] < 0:
+                        continue
+                    local = slice(max(starts[i], block_slice.start) - block_slice.start, min(stops[i], block_slice.stop) - block_slice.start)
+                    accumulator.add(keys[i], data[local], None if mask is None else mask[local])
+        finally:
+            variable.close()
+
+        for outfp, nc_out, indices in outputs:
+            for t, i in enumerate(indices):
+                c = climatologies[i]
+                mean = accumulator.mean(i)
+                if method == 'sum':
+                    mean *= (stops[c.months] - starts[c.months]).sum() / float(c.years)
+                nc_out.variables[varname][t] = mean
+                if variance:
+                    nc_out.variables[varname + '_std'][t] = accumulator.std(i)
+    finally:
+        for outfp, nc_out, indices in outputs:
+            nc_out.close()
+
+    log.info('Generated {} climatologies of {}'.format(len(outputs), varname))
+    return [outfp for outfp, nc_out, indices in outputs]
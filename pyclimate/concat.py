@@ -0,0 +1,241 @@
+import os
+import logging
+from collections import namedtuple
+
+import numpy as np
+from netCDF4 import Dataset, num2date, date2num
+
+from pyclimate.handles import acquire_dataset, release_dataset
+from pyclimate.nchelpers import nc_copy_atts, nc_copy_dim
+from pyclimate.reader import open_variable
+
+log = logging.getLogger(__name__)
+
+'''
+Virtual concatenation along time of base variables published in several files.
+
+CMIP5 variables are often split into temporal pieces (eg: 10 years per file), and not always
+in the same way for every variable of a model run. A base variable given as a list of files is
+treated as the concatenation of its pieces, ordered by their time coordinate: a diskless
+Dataset with the concatenated time axis stands in for a single file when outputs are set up,
+and a ``ConcatenatedVariable`` reads blocks of time steps across file boundaries.
+'''
+
+TimePiece = namedtuple('TimePiece', ['fp', 'start', 'stop', 'values', 'bounds'])
+
+
+def is_concatenation(fp):
+    '''
+    Checks whether a base variable location is a list of temporal pieces rather than a single file
+    '''
+    return isinstance(fp, (list, tuple))
+
+
+def get_files(fp):
+    '''
+    Returns the files of a base variable location, a single file or a list of temporal pieces
+    '''
+    return list(fp) if is_concatenation(fp) else [fp]
+
+
+def get_time_pieces(fps):
+    '''
+    Returns a TimePiece for each file, in order of time
+
+    Each piece covers time steps [start, stop) of the concatenated axis. Its time values and
+    bounds (None if the files have none) are converted to the units of the first piece.
+
+    Raises:
+        ValueError: If the pieces overlap in time or their calendars differ.
+    '''
+    axes = []
+    for fp in fps:
+        nc = acquire_dataset(fp)
+        try:
+            ncvar_time = nc.variables['time']
+            bounds_name = getattr(ncvar_time, 'bounds', None)
+            axes.append((fp, np.ma.getdata(ncvar_time[:]), ncvar_time.units, getattr(ncvar_time, 'calendar', 'standard'),
+                         np.ma.getdata(nc.variables[bounds_name][:]) if bounds_name in nc.variables else None))
+        finally:
+            release_dataset(nc)
+    axes = [x for x in axes if len(x[1])]
+    if not axes:
+        raise ValueError('No time steps in {}'.format(', '.join(fps)))
+
+    units, calendar = axes[0][2], axes[0][3]
+    def convert(values, from_units):
+        if values is None or from_units == units:
+            return values
+        return date2num(num2date(values, from_units, calendar), units, calendar)
+    for fp, values, piece_units, piece_calendar, bounds in axes:
+        if piece_calendar != calendar:
+            raise ValueError('Calendar {} of {} differs from {}'.format(piece_calendar, fp, calendar))
+    axes = [(fp, convert(values, u), convert(bounds, u)) for fp, values, u, c, bounds in axes]
+    # Order by the first date of each piece
+    axes.sort(key=lambda x: x[1][0])
+
+    pieces = []
+    start = 0
+    for fp, values, bounds in axes:
+        if pieces and values[0] <= pieces[-1].values[-1]:
+            raise ValueError('{} overlaps in time with {}'.format(fp, pieces[-1].fp))
+        pieces.append(TimePiece(fp, start, start + len(values), values, bounds))
+        start += len(values)
+    return pieces
+
+
+def open_virtual_dataset(nc_template, varname, time_values, time_bounds=None):
+    '''
+    Returns a diskless Dataset with the structure of a variable of `nc_template` over another time axis
+
+    It holds the global attributes and the non-time coordinates of the template, the given time
+    values (and bounds, if given) with the template's time attributes, and an unwritten variable
+    of the full shape. It can stand in for a base file when setting up outputs, but its data must
+    be read from the files it describes.
+    '''
+    nc = Dataset(os.path.basename(nc_template.filepath()), 'w', diskless=True, persist=False)
+    nc_copy_atts(nc_template, nc)
+    ncvar_in = nc_template.variables[varname]
+    ncvar_time_in = nc_template.variables['time']
+
+    nc.createDimension('time', None)
+    for dim in ncvar_in.dimensions:
+        if dim != 'time':
+            nc_copy_dim(nc_template, nc, dim)
+
+    ncvar_time = nc.createVariable('time', ncvar_time_in.datatype, ('time',))
+    ncvar_time.setncatts(dict((k, ncvar_time_in.getncattr(k)) for k in ncvar_time_in.ncattrs() if k != '_FillValue'))
+    ncvar_time[:] = time_values
+    bounds_name = getattr(ncvar_time_in, 'bounds', None)
+    if time_bounds is not None and bounds_name in nc_template.variables:
+        bounds_dim = nc_template.variables[bounds_name].dimensions[1]
+        if bounds_dim not in nc.dimensions:
+            nc.createDimension(bounds_dim, 2)
+        nc.createVariable(bounds_name, 'f8', ('time', bounds_dim))[:] = time_bounds
+    elif bounds_name:
+        del ncvar_time.bounds
+
+    fill_value = ncvar_in._FillValue if hasattr(ncvar_in, '_FillValue') else None
+    ncvar = nc.createVariable(varname, ncvar_in.datatype, ncvar_in.dimensions, fill_value=fill_value)
+    ncvar.setncatts(dict((k, ncvar_in.getncattr(k)) for k in ncvar_in.ncattrs() if k != '_FillValue'))
+    return nc
+
+
+def open_concatenated_dataset(fps, varname):
+    '''
+    Returns a diskless Dataset with the structure of a variable concatenated over its temporal pieces
+
+    See ``open_virtual_dataset``. Its data must be read with a ``ConcatenatedVariable``.
+    '''
+    pieces = get_time_pieces(fps)
+    values = np.concatenate([piece.values for piece in pieces])
+    has_bounds = all(piece.bounds is not None for piece in pieces)
+    bounds = np.concatenate([piece.bounds for piece in pieces]) if has_bounds else None
+    nc_first = acquire_dataset(pieces[0].fp)
+    try:
+        nc = open_virtual_dataset(nc_first, varname, values, bounds)
+    finally:
+        release_dataset(nc_first)
+    log.debug('Concatenated {} pieces of {} into {} time steps'.format(len(pieces), varname, len(values)))
+    return nc
+
+
+def open_base_dataset(fp, varname):
+    '''
+    Opens the Dataset of a base variable, or a diskless stand in if it is a list of temporal pieces
+
+    Either is given back with ``pyclimate.handles.release_dataset``.
+    '''
+    return open_concatenated_dataset(fp, varname) if is_concatenation(fp) else acquire_dataset(fp)
+
+
+class ConcatenatedVariable(object):
+    """A variable read across its temporal pieces, with the same interface as ``MemmapVariable``.
+
+    Keys must select along time with a slice of step 1. Only the pieces overlapping the last
+    block read are kept open.
+
+    Attributes:
+        fps (list): Files of the pieces.
+        varname (str): Variable name.
+        backend (str): Reader backend of each piece. See ``pyclimate.reader.BACKENDS``.
+        pieces (list): ``TimePiece`` of each file, in order of time.
+        shape (tuple): Shape of the concatenated variable.
+        dtype (numpy.dtype): Type of the variable.
+    """
+
+    def __init__(self, fps, varname, backend='auto', pieces=None):
+        """Initializes a ``ConcatenatedVariable``
+
+        Args:
+            Same as ``Attributes``. The pieces are read from the files if not given.
+        """
+        self.fps = list(fps)
+        self.varname = varname
+        self.backend = backend
+        self.pieces = pieces or get_time_pieces(self.fps)
+        self._open = {}
+        first = self._open_piece(self.pieces[0])
+        self.shape = (self.pieces[-1].stop,) + tuple(first.shape[1:])
+        self.dtype = first.dtype
+
+    def _open_piece(self, piece):
+        if piece.fp not in self._open:
+            log.debug('Opening {} of {}'.format(piece.fp, self.varname))
+            self._open[piece.fp] = open_variable(piece.fp, self.varname, self.backend)
+        return self._open[piece.fp]
+
+    def _split(self, key):
+        """Returns the time slice of a key, the rest of the key and (piece, local time slice) of each piece it covers.
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        time_slice, rest = key[0], key[1:]
+        if not isinstance(time_slice, slice) or time_slice.step not in (None, 1):
+            raise IndexError('Concatenated variables can only be read along time with a slice')
+        start, stop, _ = time_slice.indices(self.shape[0])
+        parts = [(piece, slice(max(start, piece.start) - piece.start, min(stop, piece.stop) - piece.start))
+                 for piece in self.pieces if piece.start < stop and piece.stop > start]
+
+        # Close the pieces this block does not need
+        needed = set(piece.fp for piece, local in parts)
+        for fp in [fp for fp in self._open if fp not in needed]:
+            self._open.pop(fp).close()
+        return slice(start, stop), rest, parts
+
+    def __getitem__(self, key):
+        time_slice, rest, parts = self._split(key)
+        arrays = [self._open_piece(piece)[(local,) + rest] for piece, local in parts]
+        if len(arrays) == 1:
+            return arrays[0]
+        return np.ma.concatenate(arrays, axis=0)
+
+    def read(self, key, pool=None):
+        """Reads a block as (data, mask) like ``pyclimate.reader.read_raw``.
+
+        A block within one piece is read as it would be from that file. A block spanning pieces
+        is assembled into arrays of the pool, if given.
+        """
+        time_slice, rest, parts = self._split(key)
+        if len(parts) == 1:
+            piece, local = parts[0]
+            return self._open_piece(piece).read((local,) + rest, pool)
+
+        # Pieces of the same length would share the pool's arrays for their masks
+        reads = [self._open_piece(piece).read((local,) + rest) for piece, local in parts]
+
+        shape = (time_slice.stop - time_slice.start,) + reads[0][0].shape[1:]
+        data = pool.get(self.varname + '.concat', shape, self.dtype) if pool else np.empty(shape, self.dtype)
+        np.concatenate([x for x, mask in reads], axis=0, out=data)
+        if all(mask is None for x, mask in reads):
+            return data, None
+        mask = pool.get(self.varname + '.concat_mask', shape, bool) if pool else np.empty(shape, bool)
+        offset = 0
+        for x, piece_mask in reads:
+            mask[offset:offset + len(x)] = False if piece_mask is None else piece_mask
+            offset += len(x)
+        return data, mask
+
+    def close(self):
+        for variable in self._open.values():
+            variable.close()
+        self._open = {}
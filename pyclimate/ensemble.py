@@ -0,0 +1,223 @@
+import re
+import logging
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+from pyclimate.alignment import align_base_variables, open_time_subset
+from pyclimate.buffers import BufferPool
+from pyclimate.concat import get_files, open_base_dataset
+from pyclimate.handles import release_dataset
+from pyclimate.nchelpers import iter_hyperslabs
+from pyclimate.output import OutputPolicy
+from pyclimate.reader import open_variable
+from pyclimate.variables import DEFAULT_MAX_BLOCK_MB, get_output_file_path_from_base, get_output_netcdf_from_base
+
+log = logging.getLogger(__name__)
+
+'''
+Ensemble statistics of a variable across the model runs of an experiment.
+
+The members of an ensemble (eg: the twelve runs of the pcic12 preset) are read block by block:
+the same hyperslab of every member is stacked along a leading member axis, its statistics are
+computed along that axis in a single vectorized call, and written to the outputs before the next
+hyperslab is read. Hyperslabs are sized from the memory budget and the number of members, and
+split along the grid as well as time when needed, so memory stays bounded whatever the size of
+the ensemble and the length of the record.
+'''
+
+DEFAULT_STATISTICS = ('mean', 'median', 'p10', 'p90')
+
+# Model, and institute, of the outputs in the DRS
+ENSEMBLE_MODEL = 'ensemble'
+
+# Attributes of the members' variable that do not apply to its statistics
+SKIPPED_ATTRIBUTES = ('_FillValue', 'missing_value', 'scale_factor', 'add_offset', 'valid_min', 'valid_max', 'valid_range')
+
+# Arrays of the size of a member's hyperslab held per member: the stack and the copy
+# partitioned to compute percentiles
+ARRAYS_PER_MEMBER = 2
+
+
+def get_percentile(statistic):
+    '''
+    Returns the percentile computed for a statistic, or None for the mean
+
+    Raises:
+        ValueError: If the statistic is not 'mean', 'median' or 'p' followed by a percentile. eg: 'p10'
+    '''
+    if statistic == 'mean':
+        return None
+    elif statistic == 'median':
+        return 50.
+    match = re.match(r'^p(\d+(\.\d+)?)$', statistic)
+    if match and 0 <= float(match.group(1)) <= 100:
+        return float(match.group(1))
+    raise ValueError("Unknown statistic {}. Expected 'mean', 'median' or a percentile such as 'p10'".format(statistic))
+
+
+def get_cell_method(statistic):
+    percentile = get_percentile(statistic)
+    if percentile is None or percentile == 50:
+        return 'realization: {}'.format(statistic)
+    return 'realization: percentile (comment: {:g}th)'.format(percentile)
+
+
+def get_ensemble_members(model_sets, experiment, varname, frequency='day'):
+    '''
+    Returns an OrderedDict of model run to the location of a variable for the runs of an experiment
+
+    Model sets of the same run (model and ensemble member) that hold different temporal subsets
+    are joined into a list of temporal pieces (see ``pyclimate.concat``). Only model sets of one
+    frequency are kept, as a directory may hold both the daily and the aggregated outputs of a
+    run (eg: of gen_degree_days.py with --aggregate).
+
+    Args:
+        model_sets (dict): ``DerivableBase`` by key, as from ``pyclimate.path.group_files_by_model_set``.
+        experiment (str): Experiment of the ensemble. eg: 'rcp85'
+        varname (str): Variable to summarize. eg: 'gdd'
+        frequency (str): DRS frequency of the files to summarize. eg: 'day' or 'mon'
+    '''
+    members = OrderedDict()
+    for key, base in sorted(model_sets.items()):
+        if base.experiment != experiment or base.frequency != frequency or varname not in base.variables:
+            continue
+        run = '{}_{}'.format(base.model, base.ensemble_member)
+        members.setdefault(run, []).extend(get_files(base.variables[varname]))
+    return OrderedDict((run, sorted(fps) if len(fps) > 1 else fps[0]) for run, fps in members.items())
+
+
+def get_ensemble_block_shape(shape, nmembers, nstatistics, max_block_mb):
+    '''
+    Returns the shape of the hyperslabs read from every member within a memory budget
+
+    Whole time steps are kept for as long as possible, then whole rows of the grid.
+    '''
+    arrays = nmembers * ARRAYS_PER_MEMBER + nstatistics
+    max_values = max_block_mb * 1024 * 1024 // (8 * arrays)
+    block = list(shape)
+    for d in range(len(shape)):
+        n = int(max_values // max(int(np.prod(block[d + 1:])), 1))
+        if n >= shape[d]:
+            break
+        block[d] = max(n, 1)
+        if n >= 1:
+            break
+    return block
+
+
+def compute_statistics(stack, statistics):
+    '''
+    Computes statistics along the leading (member) axis of a stack of members
+
+    Missing values are NaN. Cells that are missing in every member are masked.
+
+    Returns:
+        list: Masked array of each statistic, ordered as `statistics`
+    '''
+    missing = np.isnan(stack).any()
+    results = {}
+    percentiles = [(s, get_percentile(s)) for s in statistics if get_percentile(s) is not None]
+    with warnings.catch_warnings():
+        # All-NaN cells are masked below
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if 'mean' in statistics:
+            results['mean'] = (np.nanmean if missing else np.mean)(stack, axis=0)
+        if percentiles:
+            # Every percentile from a single partition of the stack
+            values = (np.nanpercentile if missing else np.percentile)(stack, [q for s, q in percentiles], axis=0)
+            results.update((s, x) for (s, q), x in zip(percentiles, values))
+    return [np.ma.masked_invalid(results[s]) for s in statistics]
+
+
+def generate_ensemble_statistics(members, varname, outdir, statistics=DEFAULT_STATISTICS, max_block_mb=DEFAULT_MAX_BLOCK_MB,
+                                 reader='auto', output_policy=None):
+    '''
+    Generates statistics of a variable across the members of an ensemble, one output per statistic
+
+    Members must be on the same grid and calendar. They are read over the time steps they all
+    share (see ``pyclimate.alignment``).
+
+    Args:
+        members (dict): Model run to the location of the variable (a file or a list of temporal pieces).
+        varname (str): Variable to summarize. eg: 'gdd'
+        outdir (str): Root directory to place output files.
+        statistics (list): Any of 'mean', 'median' and percentiles such as 'p10'.
+        max_block_mb (float): Memory budget (MB) for the hyperslabs of all members and their statistics.
+        reader (str): How members are read. See ``pyclimate.reader``.
+        output_policy (OutputPolicy): Compression, chunking and storage type of the outputs.
+            Defaults to single precision floats.
+
+    Returns:
+        OrderedDict: Location of the output of each statistic.
+
+    Raises:
+        AlignmentError: If the grids or calendars of the members differ, or they share no time steps.
+    '''
+    for statistic in statistics:
+        get_percentile(statistic)
+    if not members:
+        raise ValueError('No ensemble members for {}'.format(varname))
+    runs = list(members)
+    output_policy = output_policy or OutputPolicy(dtypes={varname: 'f4'})
+
+    nc_members = {}
+    nc_template = None
+    outfps = OrderedDict()
+    nc_outs = OrderedDict()
+    try:
+        for run in runs:
+            nc_members[run] = open_base_dataset(members[run], varname)
+        alignment = align_base_variables(nc_members, varname)
+        # Outputs cover the shared time steps only
+        nc_base = nc_members[runs[0]]
+        nc_template = nc_base if alignment.is_identity else open_time_subset(nc_base, varname, alignment.get_slice(runs[0]))
+
+        template_fp = members[runs[0]]
+        ncvar_template = nc_template.variables[varname]
+        atts = dict((k, ncvar_template.getncattr(k)) for k in ncvar_template.ncattrs() if k not in SKIPPED_ATTRIBUTES)
+        shape = (alignment.nsteps,) + ncvar_template.shape[1:]
+        block_shape = get_ensemble_block_shape(shape, len(runs), len(statistics), max_block_mb)
+        for statistic in statistics:
+            outfp = get_output_file_path_from_base(template_fp, varname, outdir, model=ENSEMBLE_MODEL, institute=ENSEMBLE_MODEL,
+                                                   ensemble_member=statistic)
+            cell_methods = ' '.join(x for x in (atts.get('cell_methods'), get_cell_method(statistic)) if x)
+            nc_out = get_output_netcdf_from_base(nc_template, varname, varname, dict(atts, cell_methods=cell_methods), outfp,
+                                                 output_policy=output_policy, max_time_chunk=block_shape[0])
+            nc_out.ensemble_members = ', '.join(runs)
+            outfps[statistic] = outfp
+            nc_outs[statistic] = nc_out
+    except Exception:
+        for nc in nc_outs.values():
+            nc.close()
+        raise
+    finally:
+        if nc_template is not None and nc_template is not nc_members.get(runs[0]):
+            release_dataset(nc_template)
+        for nc in nc_members.values():
+            release_dataset(nc)
+
+    log.info('Computing {} of {} across {} members in hyperslabs of {}'.format(', '.join(statistics), varname, len(runs), block_shape))
+    buffers = BufferPool()
+    variables = OrderedDict()
+    try:
+        for run in runs:
+            variables[run] = open_variable(members[run], varname, reader)
+        for hyperslab in iter_hyperslabs(shape, block_shape):
+            stack = buffers.get('stack', (len(runs),) + tuple(s.stop - s.start for s in hyperslab), np.float64)
+            for i, run in enumerate(runs):
+                data, mask = variables[run].read((alignment.get_slice(run, hyperslab[0]),) + hyperslab[1:], buffers)
+                stack[i] = data
+                if mask is not None:
+                    stack[i][mask] = np.nan
+            for statistic, result in zip(statistics, compute_statistics(stack, statistics)):
+                nc_outs[statistic].variables[varname][hyperslab] = result
+    finally:
+        for variable in variables.values():
+            variable.close()
+        for nc in nc_outs.values():
+            nc.close()
+
+    log.info('Generated ensemble {} of {}'.format(', '.join(statistics), varname))
+    return outfps
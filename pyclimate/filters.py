@@ -38,6 +38,8 @@ class Filter(object):
 #     __metaclass__ = FilterMetaclass
 
     def __init__(self, _filter=None):
+        if isinstance(_filter, Filter):
+            _filter = _filter.filter
         preset = get_preset_filter(_filter)
         if preset:
             self.filter = preset
@@ -49,24 +51,60 @@ class Filter(object):
         else:
             self.filter = _filter
 
+        self.compiled = compile_filter(self.filter)
 
     def __contains__(self, fp):
         '''
         Returns true if a file path is included in a filter
         '''
-        if not self.filter: return True
+        if not self.compiled: return True
 
         cf = Cmip5File(datanode_fp = fp)
-        for entry in self.filter:
-            if all([(hasattr(cf, att) and (getattr(cf, att) == val or getattr(cf, att) in val)) for att, val in entry.items()]):
+        return self.matches(cf)
+
+    def matches(self, cf):
+        '''
+        Returns true if an object with Cmip5File attributes is included in a filter
+        '''
+        if not self.compiled: return True
+
+        for entry in self.compiled:
+            if all(getattr(cf, att, None) in vals for att, vals in entry.items()):
+                return True
+
+        return False
+
+    def allows_facets(self, facets):
+        '''
+        Returns true if any file with the given (partial) dict of DRS facets could be included in a filter
+
+        Used to prune whole directories while walking a DRS tree.
+        '''
+        if not self.compiled: return True
+
+        for entry in self.compiled:
+            if all(facets[att] in vals for att, vals in entry.items() if att in facets):
                 return True
 
         return False
 
+def compile_filter(_filter):
+    '''
+    Compiles a filter to a list of dictionaries of Cmip5File attribute to a frozenset of acceptable values
+    '''
+    if not _filter:
+        return []
+
+    compiled = []
+    for entry in _filter:
+        compiled.append({att: frozenset(val) if isinstance(val, (list, tuple, set, frozenset)) else frozenset([val])
+                         for att, val in entry.items()})
+    return compiled
+
 def get_preset_filter(_filter):
-    if _filter in presets.keys():
-        return presets[_filter]
-    else:
+    try:
+        return presets.get(_filter)
+    except TypeError: # Unhashable filters (eg: lists) can not be preset names
         return None
 
 
@@ -0,0 +1,192 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from netCDF4 import Dataset
+
+log = logging.getLogger(__name__)
+
+'''
+A per-process pool of open, read-only netCDF4 Dataset handles.
+
+Opening an HDF5 backed file parses its metadata, and closing it throws away its chunk cache.
+Jobs that read the same inputs one after the other (eg: tas, gdd and hdd of a model set run as
+separate jobs on one worker) can instead reuse a handle that is still open, with a warm cache.
+Handles not in use are kept open up to the size of the pool and closed least recently used
+first. The pool is disabled (size 0) unless configured, so that files are not held open
+unexpectedly, eg: while another part of the same process rewrites them.
+'''
+
+# Fraction of fully read chunks preempted first from the chunk cache
+CHUNK_CACHE_PREEMPTION = 0.75
+
+
+def get_file_key(fp):
+    st = os.stat(fp)
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+def get_chunk_cache_slots(cache_bytes, chunk_bytes):
+    '''
+    Returns the number of hash table slots for a chunk cache
+
+    HDF5 recommends a prime number of at least 10 times the number of chunks the cache can hold.
+    '''
+    n = max(11, 10 * int(cache_bytes // max(chunk_bytes, 1)))
+    while any(n % i == 0 for i in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def set_chunk_cache(ncvar, chunk_cache_mb):
+    '''
+    Sizes the chunk cache of a chunked variable to hold `chunk_cache_mb` MB. Other variables are left alone
+    '''
+    chunking = ncvar.chunking()
+    if not isinstance(chunking, (list, tuple)):
+        return
+    cache_bytes = int(chunk_cache_mb * 1024 * 1024)
+    chunk_bytes = ncvar.dtype.itemsize
+    for n in chunking:
+        chunk_bytes *= n
+    ncvar.set_var_chunk_cache(size=cache_bytes, nelems=get_chunk_cache_slots(cache_bytes, chunk_bytes),
+                              preemption=CHUNK_CACHE_PREEMPTION)
+
+
+class DatasetPool(object):
+    """Open Dataset handles of this process, reused while their files are unchanged.
+
+    A handle is shared by everything that acquires its file until each has released it. A
+    handle whose file was replaced or changed size or mtime is not handed out again: the file
+    is opened anew, and the stale handle is closed once its last user has released it. Handles
+    are not shared with forked worker processes, which start with an empty pool of the same
+    settings.
+
+    Attributes:
+        size (int): Number of handles not in use kept open. 0 closes handles when released.
+        chunk_cache_mb (float): Size of the chunk cache of each variable read through the pool,
+            or None to keep the library's default.
+        hits (int): Number of acquisitions served by a handle that was already open.
+        misses (int): Number of acquisitions that opened the file.
+    """
+
+    def __init__(self, size=0, chunk_cache_mb=None):
+        """Initializes a ``DatasetPool``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.size = size
+        self.chunk_cache_mb = chunk_cache_mb
+        self.hits = 0
+        self.misses = 0
+        self._handles = OrderedDict()
+        # Handles of files changed since they were opened, still in use
+        self._stale = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        # Forked workers forget the parent's handles rather than use or close its HDF5 state
+        if self._pid != os.getpid():
+            self._handles = OrderedDict()
+            self._stale = []
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def configure(self, size, chunk_cache_mb=None):
+        """Changes the size and chunk cache of the pool, closing any handles that no longer fit.
+        """
+        self._check_process()
+        with self._lock:
+            self.size = size
+            self.chunk_cache_mb = chunk_cache_mb
+            self._evict()
+
+    def acquire(self, fp):
+        """Returns an open Dataset of a file, to be given back with ``release``.
+        """
+        self._check_process()
+        fp = os.path.abspath(fp)
+        key = get_file_key(fp)
+        with self._lock:
+            entry = self._handles.get(fp)
+            if entry is not None and entry['key'] != key:
+                log.debug('{} changed since it was opened, reopening'.format(fp))
+                del self._handles[fp]
+                if entry['users']:
+                    self._stale.append(entry)
+                else:
+                    entry['nc'].close()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                entry = {'nc': Dataset(fp), 'key': key, 'users': 0}
+            else:
+                self.hits += 1
+            self._handles[fp] = entry
+            self._handles.move_to_end(fp)
+            entry['users'] += 1
+            return entry['nc']
+
+    def release(self, nc):
+        """Gives back a Dataset from ``acquire``. Anything else is closed.
+        """
+        self._check_process()
+        with self._lock:
+            for fp, entry in self._handles.items():
+                if entry['nc'] is nc:
+                    entry['users'] -= 1
+                    # Most recently used last
+                    self._handles.move_to_end(fp)
+                    self._evict()
+                    return
+            for entry in self._stale:
+                if entry['nc'] is nc:
+                    entry['users'] -= 1
+                    if not entry['users']:
+                        self._stale.remove(entry)
+                        nc.close()
+                    return
+        nc.close()
+
+    def _evict(self):
+        idle = [fp for fp, entry in self._handles.items() if entry['users'] == 0]
+        for fp in idle[:max(0, len(idle) - self.size)]:
+            log.debug('Closing pooled handle of {}'.format(fp))
+            self._handles.pop(fp)['nc'].close()
+
+    def clear(self):
+        """Closes every handle not in use.
+        """
+        self._check_process()
+        with self._lock:
+            size, self.size = self.size, 0
+            self._evict()
+            self.size = size
+
+    def __len__(self):
+        return len(self._handles)
+
+
+# The pool of this process. Worker processes forked after it is configured inherit its settings
+_pool = DatasetPool()
+
+
+def get_dataset_pool():
+    return _pool
+
+
+def acquire_dataset(fp):
+    '''
+    Returns an open Dataset of a file from this process' pool. See ``DatasetPool.acquire``
+    '''
+    return _pool.acquire(fp)
+
+
+def release_dataset(nc):
+    '''
+    Gives back a Dataset from ``acquire_dataset``, or closes any other Dataset
+    '''
+    _pool.release(nc)
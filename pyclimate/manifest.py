@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import logging
+
+from pyclimate.concat import is_concatenation
+
+log = logging.getLogger(__name__)
+
+'''
+Manifests recording what each derived output was generated from.
+
+A manifest is a JSON file stored next to its output (``<outfp>.manifest.json``) holding the
+path, size and mtime (and optionally a sha256 digest) of every input, the size and mtime of
+the output itself, and the derivation parameters. An output is up to date while all of these
+still match, which can be checked with a few stat calls and without opening any NetCDF.
+'''
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+
+DIGEST_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def get_manifest_path(outfp):
+    '''
+    Returns the location of the manifest of an output file
+    '''
+    return outfp + MANIFEST_SUFFIX
+
+
+def get_file_digest(fp, block_size=DIGEST_BLOCK_SIZE):
+    '''
+    Returns the hex sha256 digest of a file's contents
+    '''
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for data in iter(lambda: f.read(block_size), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+def get_file_state(fp, digest=False):
+    '''
+    Returns the path, size, mtime and optionally the digest of a file
+    '''
+    st = os.stat(fp)
+    state = {'path': os.path.abspath(fp), 'size': st.st_size, 'mtime': st.st_mtime}
+    if digest:
+        state['sha256'] = get_file_digest(fp)
+    return state
+
+
+def get_input_state(fp, digest=False):
+    '''
+    Returns the state of a base variable's file, or a list of the states of its temporal pieces
+    '''
+    if is_concatenation(fp):
+        return [get_file_state(x, digest) for x in fp]
+    return get_file_state(fp, digest)
+
+
+def build_manifest(derived, digest=False):
+    '''
+    Builds the manifest of a DerivedVariable whose output has just been written
+    '''
+    return {
+        'version': MANIFEST_VERSION,
+        'inputs': dict((x, get_input_state(derived.base_variables[x], digest)) for x in derived.required_vars),
+        'output': get_file_state(derived.outfp),
+        'parameters': derived.parameters
+    }
+
+
+def write_manifest(derived, digest=False):
+    '''
+    Writes the manifest of a DerivedVariable next to its output
+
+    The manifest is written to a temporary file first and renamed into place, so an
+    interrupted write never leaves a manifest that parses.
+    '''
+    manifest = build_manifest(derived, digest)
+    manifest_fp = get_manifest_path(derived.outfp)
+    tmp_fp = '{}.{}.tmp'.format(manifest_fp, os.getpid())
+    with open(tmp_fp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_fp, manifest_fp)
+    log.debug('Wrote manifest {}'.format(manifest_fp))
+    return manifest_fp
+
+
+def read_manifest(outfp):
+    '''
+    Returns the manifest of an output file, or None if it is missing or unreadable
+    '''
+    try:
+        with open(get_manifest_path(outfp)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def remove_manifest(outfp):
+    '''
+    Removes the manifest of an output file, if any
+    '''
+    try:
+        os.remove(get_manifest_path(outfp))
+    except OSError:
+        pass
+
+
+def file_matches(recorded, fp, digest=False):
+    '''
+    Checks a file against its recorded state
+
+    Files with the recorded size and mtime match. With `digest`, a file whose mtime changed
+    (eg: copied or touched) but whose size and contents are unchanged matches as well.
+    '''
+    try:
+        current = get_file_state(fp)
+    except OSError:
+        return False
+    if current['path'] != recorded.get('path') or current['size'] != recorded.get('size'):
+        return False
+    if current['mtime'] == recorded.get('mtime'):
+        return True
+    return digest and 'sha256' in recorded and get_file_digest(fp) == recorded['sha256']
+
+
+def input_matches(recorded, fp, digest=False):
+    '''
+    Checks a base variable's file, or every one of its temporal pieces, against its recorded state
+    '''
+    if is_concatenation(fp):
+        return isinstance(recorded, list) and len(recorded) == len(fp) and \
+            all(file_matches(r, x, digest) for r, x in zip(recorded, fp))
+    return isinstance(recorded, dict) and file_matches(recorded, fp, digest)
+
+
+def is_up_to_date(derived, digest=False):
+    '''
+    Checks whether the output of a DerivedVariable matches its manifest
+
+    The output must exist unmodified, every required base variable must still be the file
+    it was generated from, and the derivation parameters must be unchanged.
+    '''
+    manifest = read_manifest(derived.outfp)
+    if not manifest or manifest.get('version') != MANIFEST_VERSION:
+        return False
+    if not file_matches(manifest['output'], derived.outfp):
+        return False
+    if sorted(manifest['inputs']) != sorted(derived.required_vars):
+        return False
+    for x in derived.required_vars:
+        if x not in derived.base_variables or not input_matches(manifest['inputs'][x], derived.base_variables[x], digest):
+            return False
+    # Compare as JSON so tuples and lists (and int and float keys) are treated alike
+    return manifest['parameters'] == json.loads(json.dumps(derived.parameters))
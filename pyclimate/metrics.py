@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+'''
+Instrumentation of derivations: wall time per phase, bytes moved and peak memory.
+
+Phases may overlap (eg: in a pipelined derivation, reading runs while computing), in which
+case their sum exceeds the total wall time. Time spent decompressing inputs and compressing
+outputs happens inside the netCDF library and is counted in 'read' and 'write'.
+'''
+
+PHASES = ('open', 'read', 'compute', 'write', 'close')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_rss_mb():
+    '''
+    Returns the peak resident set size of this process in MB, or None where unavailable
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+def get_worker_identity():
+    '''
+    Returns a dict identifying the process (and host) doing the work
+    '''
+    return {'host': socket.gethostname(), 'pid': os.getpid(), 'process': multiprocessing.current_process().name}
+
+
+class Metrics(object):
+    """Accumulated wall time per phase and bytes read and written by a derivation.
+
+    Attributes:
+        seconds (dict): Wall time per phase. See ``PHASES``.
+        bytes_read (int): Bytes of base variable data read.
+        bytes_written (int): Bytes of derived data written, before any compression or packing.
+        blocks (int): Number of blocks of time steps processed.
+    """
+
+    def __init__(self):
+        self.seconds = dict((phase, 0.) for phase in PHASES)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.blocks = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent in its body to a phase.
+        """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            with self._lock:
+                self.seconds[name] += elapsed
+
+    def add(self, **counts):
+        """Adds to ``bytes_read``, ``bytes_written`` or ``blocks``.
+        """
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def merge(self, other):
+        """Adds the times and counts of another ``Metrics``, eg: of a process doing part of the work.
+        """
+        with self._lock:
+            for phase, seconds in other.seconds.items():
+                self.seconds[phase] += seconds
+            self.bytes_read += other.bytes_read
+            self.bytes_written += other.bytes_written
+            self.blocks += other.blocks
+
+    def as_dict(self):
+        return {
+            'seconds': dict(self.seconds),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'blocks': self.blocks
+        }
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def format_summary(records):
+    '''
+    Formats a table of job metrics records (as written by gen_degree_days.py --metrics)
+    '''
+    header = '{:<48} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} {:>9} {:>9} {:>8}  {}'.format(
+        'job', 'total', 'open', 'read', 'compute', 'write', 'close', 'read MB', 'write MB', 'RSS MB', 'worker')
+    lines = [header, '-' * len(header)]
+    for r in records:
+        s = r['seconds']
+        lines.append('{:<48} {:7.2f} {:7.2f} {:7.2f} {:7.2f} {:7.2f} {:7.2f} {:9.1f} {:9.1f} {:8.1f}  {}'.format(
+            r['job'][:48], r['total_seconds'], s['open'], s['read'], s['compute'], s['write'], s['close'],
+            r['bytes_read'] / 1e6, r['bytes_written'] / 1e6, r['peak_rss_mb'] or 0., r['worker']['process']))
+    return '\n'.join(lines)
@@ -1,35 +1,90 @@
 import logging
+import itertools
 
-from netCDF4 import num2date
+import numpy as np
+
+from pyclimate.timeindex import get_time_index
 
 log = logging.getLogger(__name__)
 
+# Default memory budget for each hyperslab copied by nc_copy_var
+DEFAULT_COPY_BLOCK_MB = 64
+
 def get_monthly_time_slices(ncvar_time):
     '''
     Based on an input NetCDF4 time variable returns calendar appropriate monthly slices
     '''
-    assert 'calendar' in ncvar_time.ncattrs(), "Time variable does not have a defined calendar"
-    cal = ncvar_time.calendar
+    return get_time_index(ncvar_time).monthly_slices()
+
+
+def get_time_block_size(ncvar, max_block_mb, arrays_per_step=1, bytes_per_value=8):
+    '''
+    Returns the number of leading (time) indices of a variable that fit within a memory budget
 
-    assert 'units' in ncvar_time.ncattrs(), "Time variable must have 'unit' attribute"
-    units = ncvar_time.units
+    Each time step is assumed to hold `arrays_per_step` arrays the size of one time step of
+    `ncvar`, with every value taking `bytes_per_value` bytes. At least one step is always returned.
+    '''
+    step_bytes = int(np.prod(ncvar.shape[1:])) * bytes_per_value * arrays_per_step
+    max_bytes = max_block_mb * 1024 * 1024
+    return int(max(1, min(ncvar.shape[0], max_bytes // max(step_bytes, 1))))
+
+
+def iter_time_blocks(nsteps, block_size):
+    '''
+    Yields consecutive slices of at most `block_size` covering `nsteps` time steps
+    '''
+    for start in range(0, nsteps, block_size):
+        yield slice(start, min(start + block_size, nsteps))
 
-    assert len(ncvar_time.dimensions) == 1, "Time varaible must be single dimension"
 
-    slices = []
+def get_time_slice_bounds(dsin, time_slices, dimname='time'):
+    '''
+    Returns arrays of the lower and upper time bounds of each slice of the dsin time axis
+
+    Each slice is bounded by the bounds of its first and last time steps if dsin has them.
+    Otherwise time steps are taken to cover one step each, starting at the same offset
+    within a step as the first one (eg: 12:00 of daily time steps is half a step in).
+    '''
+    ncvarin = dsin.variables[dimname]
+    values = ncvarin[:]
+    starts = np.array([s.start for s in time_slices], dtype=int)
+    stops = np.array([s.stop for s in time_slices], dtype=int)
+
+    bounds_name = ncvarin.getncattr('bounds') if 'bounds' in ncvarin.ncattrs() else None
+    if bounds_name in dsin.variables:
+        bounds_in = dsin.variables[bounds_name][:]
+        return bounds_in[starts, 0], bounds_in[stops - 1, 1]
+    step = np.median(np.diff(values)) if len(values) > 1 else 1
+    offset = np.mod(values[0], step) if len(values) else 0
+    return values[starts] - offset, values[stops - 1] - offset + step
+
+
+def nc_create_aggregated_time(dsin, dsout, time_slices, dimname='time'):
+    '''
+    Creates a time dimension, variable and bounds in dsout with one step per slice of the dsin time axis
+
+    Each step is bounded by its first and last source time steps (see ``get_time_slice_bounds``)
+    and placed at the middle of its bounds.
+    '''
+    ncvarin = dsin.variables[dimname]
+    lower, upper = get_time_slice_bounds(dsin, time_slices, dimname)
+    bounds_name = ncvarin.getncattr('bounds') if 'bounds' in ncvarin.ncattrs() else None
+    bounds_name = bounds_name or '{}_bnds'.format(dimname)
 
-    d_start = num2date(ncvar_time[0], units, cal)
-    current_month = d_start.month
-    t_start = 0
-    for i, val in enumerate(ncvar_time):
-        d = num2date(val, units, cal)
-        if d.month != current_month:
-            slices.append(slice(t_start, i))
-            t_start = i
-            current_month = d.month
-    slices.append(slice(t_start, i+1))
+    dsout.createDimension(dimname, None if dsin.dimensions[dimname].isunlimited() else len(time_slices))
+    if 'bnds' not in dsout.dimensions:
+        dsout.createDimension('bnds', 2)
 
-    return slices
+    ncvarout = dsout.createVariable(dimname, 'f8', (dimname,))
+    ncvarout.setncatts({k: ncvarin.getncattr(k) for k in ncvarin.ncattrs() if k not in ('_FillValue', 'bounds')})
+    ncvarout.bounds = bounds_name
+    ncvarout[:] = (lower + upper) / 2.
+
+    ncvarbnds = dsout.createVariable(bounds_name, 'f8', (dimname, 'bnds'))
+    ncvarbnds[:] = np.column_stack([lower, upper])
+    log.debug('Created aggregated time axis with {} steps'.format(len(time_slices)))
+
+    return ncvarout
 
 
 def nc_copy_atts(dsin, dsout, varin=False, varout=False):
@@ -59,9 +114,67 @@ def nc_copy_dim(dsin, dsout, dimname):
         log.debug('Copying dimvar for {}'.format(dimname))
         nc_copy_var(dsin, dsout, dimname, dimname, copy_data=True, copy_attrs=True)
 
-def nc_copy_var(dsin, dsout, varin, varout, copy_data=False, copy_attrs=False):
+def get_copy_block_shape(ncvar, max_block_mb):
+    '''
+    Returns the shape of the hyperslabs used to copy a variable within a memory budget
+
+    Trailing dimensions are kept whole for as long as possible. The first dimension that has to
+    be split is split into multiples of the variable's on-disk chunk size where the budget allows.
+    A variable that fits within the budget is copied as a single hyperslab.
+    '''
+    shape = ncvar.shape
+    chunking = ncvar.chunking()
+    chunks = chunking if isinstance(chunking, (list, tuple)) else None
+    max_bytes = max_block_mb * 1024 * 1024
+
+    block = list(shape)
+    for d in range(len(shape)):
+        slab_bytes = int(np.prod(block[d+1:])) * ncvar.dtype.itemsize
+        n = int(max_bytes // max(slab_bytes, 1))
+        if n >= shape[d]:
+            break
+        if chunks and n >= chunks[d]:
+            n = n // chunks[d] * chunks[d]
+        block[d] = max(n, 1)
+        if n >= 1:
+            break
+
+    return block
+
+
+def iter_hyperslabs(shape, block_shape):
+    '''
+    Yields tuples of slices covering an array of `shape` in blocks of at most `block_shape`
+    '''
+    ranges = [range(0, size, step) for size, step in zip(shape, block_shape)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, min(start + step, size)) for start, step, size in zip(starts, block_shape, shape))
+
+
+def nc_copy_var_data(ncvarin, ncvarout, max_block_mb=DEFAULT_COPY_BLOCK_MB, bulk=False):
+    '''
+    Copies the data of a variable of any rank in hyperslabs sized to a memory budget
+
+    If bulk is True, or the variable is scalar or has a variable length type, it is copied with a single read and write.
+    '''
+    if bulk or len(ncvarin.shape) == 0 or not isinstance(ncvarin.dtype, np.dtype):
+        ncvarout[...] = ncvarin[...]
+        log.debug('Copied {} in bulk'.format(ncvarin.name))
+        return
+
+    block_shape = get_copy_block_shape(ncvarin, max_block_mb)
+    for hyperslab in iter_hyperslabs(ncvarin.shape, block_shape):
+        ncvarout[hyperslab] = ncvarin[hyperslab]
+    log.debug('Copied {} in hyperslabs of {}'.format(ncvarin.name, block_shape))
+
+
+def nc_copy_var(dsin, dsout, varin, varout, copy_data=False, copy_attrs=False, max_block_mb=DEFAULT_COPY_BLOCK_MB, bulk=False, **kwargs):
     '''
     Copies a variable from one NetCDF to another with dimensions, dimvars, and attributes
+
+    Data of any rank is copied in hyperslabs within max_block_mb (see nc_copy_var_data).
+    Any other keyword arguments are passed to createVariable for the new variable only (eg: zlib,
+    complevel, chunksizes) and may override the source's datatype and fill_value.
     '''
 
     log.debug('nc_copy_var: Copying variable {} to {}'.format(varin, varout))
@@ -75,7 +188,9 @@ def nc_copy_var(dsin, dsout, varin, varout, copy_data=False, copy_attrs=False):
 
     ncvarin = dsin.variables[varin]
     fv = ncvarin._FillValue if hasattr(ncvarin, '_FillValue') else None
-    ncvarout = dsout.createVariable(varout, ncvarin.datatype, ncvarin.dimensions, fill_value = fv)
+    create_kwargs = {'datatype': ncvarin.datatype, 'fill_value': fv}
+    create_kwargs.update(kwargs)
+    ncvarout = dsout.createVariable(varout, dimensions=ncvarin.dimensions, **create_kwargs)
 
     if 'bounds' in ncvarin.ncattrs():
         log.debug('found bounds: {}'.format(ncvarin.getncattr('bounds')))
@@ -84,12 +199,7 @@ def nc_copy_var(dsin, dsout, varin, varout, copy_data=False, copy_attrs=False):
     if copy_attrs:
         nc_copy_atts(dsin, dsout, varin, varout)
     if copy_data:
-        if len(ncvarin.dimensions) > 3:
-            raise AssertionError('This function does not support copying data for a variable with 4+ dimensions')
-        # Itteratively copy data if 3 dimensions
-        if len(ncvarin.shape) > 2:
-            for i in range(ncvarin.shape[0]):
-                ncvarout[i,:,:] = ncvarin[i,:,:]
+        nc_copy_var_data(ncvarin, ncvarout, max_block_mb, bulk)
         log.debug('Copied variable data')
 
     log.debug('Done copying variable')
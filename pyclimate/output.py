@@ -0,0 +1,133 @@
+import logging
+
+import numpy as np
+from netCDF4 import default_fillvals
+
+log = logging.getLogger(__name__)
+
+'''
+Storage policy (compression, chunk shape and storage type) for derived output variables.
+'''
+
+CHUNK_LAYOUTS = ('map', 'timeseries')
+
+# Approximate size of each chunk for the 'timeseries' layout
+TARGET_CHUNK_BYTES = 1024 * 1024
+
+
+class OutputPolicy(object):
+    """Describes how derived variables are stored in their output NetCDF.
+
+    Attributes:
+        complevel (int): zlib compression level (1-9). 0 disables compression.
+        shuffle (bool): Apply the HDF5 shuffle filter when compressing.
+        chunking (str or tuple): 'map' for one time step per chunk, 'timeseries' for long
+            time series of small tiles, an explicit tuple of chunk sizes, or None to let
+            the library decide. 'timeseries' chunks span no more time steps than are written
+            at once, as a chunk written over several blocks is recompressed for each.
+        dtypes (dict): Storage type per variable name. eg: {'ffd': 'i1'}
+        packing (dict): (scale_factor, add_offset) per variable name. Packed variables are
+            stored as 'i2' unless ``dtypes`` says otherwise.
+            eg: {'gdd': (0.01, 0.)}
+    """
+
+    def __init__(self, complevel=0, shuffle=True, chunking=None, dtypes=None, packing=None):
+        """Initializes an ``OutputPolicy``
+
+        Args:
+            Same as ``Attributes``
+        """
+        if chunking is not None and not isinstance(chunking, (list, tuple)) and chunking not in CHUNK_LAYOUTS:
+            raise ValueError('Unknown chunking {}. Expected one of {} or chunk sizes'.format(chunking, CHUNK_LAYOUTS))
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.chunking = chunking
+        self.dtypes = dtypes or {}
+        self.packing = packing or {}
+
+    def __repr__(self):
+        return 'OutputPolicy(complevel={}, shuffle={}, chunking={}, dtypes={}, packing={})'.format(
+            self.complevel, self.shuffle, self.chunking, self.dtypes, self.packing)
+
+    def as_dict(self):
+        """Returns the policy as a JSON serializable dict.
+        """
+        return {
+            'complevel': self.complevel,
+            'shuffle': self.shuffle,
+            'chunking': list(self.chunking) if isinstance(self.chunking, (list, tuple)) else self.chunking,
+            'dtypes': dict((k, np.dtype(v).str[1:]) for k, v in self.dtypes.items()),
+            'packing': dict((k, list(v)) for k, v in self.packing.items())
+        }
+
+    def get_datatype(self, variable_name, base_datatype):
+        """Returns the storage type of a variable.
+        """
+        if variable_name in self.dtypes:
+            return np.dtype(self.dtypes[variable_name])
+        elif variable_name in self.packing:
+            return np.dtype('i2')
+        return base_datatype
+
+    def get_chunksizes(self, shape, itemsize, max_time_chunk=None):
+        """Returns chunk sizes for a (time, ...) variable of `shape`, or None for the library default.
+
+        'timeseries' chunks span at most `max_time_chunk` time steps, if given.
+        """
+        if self.chunking is None or len(shape) < 2:
+            return None
+        elif self.chunking == 'map':
+            return [1] + list(shape[1:])
+        elif self.chunking == 'timeseries':
+            ntime = max(1, shape[0] if max_time_chunk is None else min(shape[0], max_time_chunk))
+            cells = max(1, TARGET_CHUNK_BYTES // (itemsize * ntime))
+            chunks = [ntime]
+            # Split the remaining cells as evenly as possible over the spatial dimensions
+            for i, size in enumerate(shape[1:]):
+                remaining_dims = len(shape) - 2 - i
+                side = int(round(cells ** (1. / (remaining_dims + 1))))
+                chunk = max(1, min(size, side))
+                chunks.append(chunk)
+                cells = max(1, cells // chunk)
+            return chunks
+        return list(self.chunking)
+
+    def get_create_kwargs(self, variable_name, base_ncvar, shape, max_time_chunk=None):
+        """Returns keyword arguments for ``createVariable`` for a variable of `shape` based on `base_ncvar`.
+
+        `max_time_chunk` is the number of time steps written at once. See ``get_chunksizes``.
+        """
+        datatype = self.get_datatype(variable_name, base_ncvar.datatype)
+        kwargs = {'datatype': datatype}
+        if datatype != base_ncvar.datatype:
+            kwargs['fill_value'] = default_fillvals[np.dtype(datatype).str[1:]]
+        if self.complevel:
+            kwargs.update({'zlib': True, 'complevel': self.complevel, 'shuffle': self.shuffle})
+        chunksizes = self.get_chunksizes(shape, np.dtype(datatype).itemsize, max_time_chunk)
+        if chunksizes:
+            kwargs['chunksizes'] = chunksizes
+        return kwargs
+
+    def get_packed_range(self, variable_name):
+        """Returns the (min, max) values a packed variable can hold, or None if it is not packed into integers.
+        """
+        if variable_name not in self.packing:
+            return None
+        datatype = self.get_datatype(variable_name, np.dtype('i2'))
+        if datatype.kind not in 'iu':
+            return None
+        scale_factor, add_offset = self.packing[variable_name]
+        info = np.iinfo(datatype)
+        bounds = sorted([info.min * scale_factor + add_offset, info.max * scale_factor + add_offset])
+        return bounds[0], bounds[1]
+
+    def apply_packing(self, variable_name, ncvar):
+        """Sets packing attributes on a newly created variable, if it is packed.
+
+        netCDF4 then packs values as they are written.
+        """
+        if variable_name in self.packing:
+            scale_factor, add_offset = self.packing[variable_name]
+            ncvar.scale_factor = scale_factor
+            ncvar.add_offset = add_offset
+            log.debug('Packing {} with scale_factor {} add_offset {}'.format(variable_name, scale_factor, add_offset))
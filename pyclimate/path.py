@@ -1,19 +1,206 @@
 import os
 import fnmatch
+import logging
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from cfmeta import Cmip5File
+from cfmeta.cmip5file import CMIP5_DATANODE_FP_ATTS, CMIP5_FNAME_REQUIRED_ATTS, get_cmor_fname_meta
+from cfmeta.exceptions import PathError
 from pyclimate.filters import Filter
 from pyclimate.variables import DerivableBase
 
+log = logging.getLogger(__name__)
+
+
+def iter_netcdf_files(base_dir, pattern="*.nc", _filter=None, threads=1):
+    '''
+    Yields files below base_dir matching pattern
+
+    If a filter is supplied, directories whose DRS path components already rule out every
+    entry of the filter are not descended into (see DrsPruner). Files are not otherwise filtered.
+
+    With threads > 1 directories are listed concurrently by a pool of threads, which hides the
+    per-directory latency of network filesystems. Files are yielded as their directory is listed,
+    in no particular order.
+    '''
+    _filter = Filter(_filter)
+    prune = DrsPruner(base_dir, _filter, pattern) if _filter.compiled else None
+
+    if threads > 1:
+        for fp in iter_scandir_parallel(base_dir, pattern, threads, prune):
+            yield fp
+        return
 
-def iter_netcdf_files(base_dir, pattern="*.nc"):
     for root, dirnames, filenames in os.walk(base_dir):
+        if prune:
+            dirnames[:] = prune(root, dirnames)
         for filename in fnmatch.filter(filenames, pattern):
             yield os.path.join(root, filename)
 
 
+def scan_directory(root, pattern="*.nc"):
+    '''
+    Lists a directory once, returning the names of its subdirectories and the paths of its files matching pattern
+
+    Like os.walk, symbolic links to directories are not treated as subdirectories to descend into
+    and unreadable directories are skipped.
+    '''
+    dirnames = []
+    filenames = []
+    try:
+        for entry in os.scandir(root):
+            if entry.is_dir() and not entry.is_symlink():
+                dirnames.append(entry.name)
+            elif not entry.is_dir():
+                filenames.append(entry.name)
+    except OSError as e:
+        log.warning('Unable to list {}: {}'.format(root, e))
+    return dirnames, [os.path.join(root, x) for x in fnmatch.filter(filenames, pattern)]
+
+
+def iter_scandir_parallel(base_dir, pattern="*.nc", threads=8, prune=None):
+    '''
+    Yields files below base_dir matching pattern, listing up to `threads` directories at a time
+
+    prune, if supplied, is called with each directory and its subdirectory names and returns the
+    subdirectory names to descend into.
+    '''
+    def scan(root):
+        dirnames, fps = scan_directory(root, pattern)
+        if prune:
+            dirnames = prune(root, dirnames)
+        return [os.path.join(root, x) for x in dirnames], fps
+
+    executor = ThreadPoolExecutor(threads)
+    pending = set([executor.submit(scan, base_dir)])
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, fps = future.result()
+                pending.update(executor.submit(scan, subdir) for subdir in subdirs)
+                for fp in fps:
+                    yield fp
+    finally:
+        # Stop listing if the caller stops consuming early
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def get_drs_depth(root, pattern="*.nc"):
+    '''
+    Returns the number of directory levels from root down to the files of its first branch
+
+    The first file found along the first branch of the tree must be named after the DRS facets
+    of the directories it sits in (its model, experiment, mip_table, ensemble_member and
+    variable_name). Returns None if no such file is found.
+    '''
+    path = root
+    depth = 0
+    while True:
+        try:
+            path, dirnames, filenames = next(os.walk(path))
+        except StopIteration:
+            return None
+        filenames = sorted(fnmatch.filter(filenames, pattern))
+        if filenames:
+            break
+        if not dirnames:
+            return None
+        path = os.path.join(path, sorted(dirnames)[0])
+        depth += 1
+
+    try:
+        meta = get_cmor_fname_meta(filenames[0])
+    except PathError:
+        return None
+    parts = os.path.abspath(path).split(os.sep)
+    dir_meta = dict(zip(CMIP5_DATANODE_FP_ATTS[::-1], parts[::-1]))
+    if any(dir_meta.get(att) != meta[att] for att in CMIP5_FNAME_REQUIRED_ATTS):
+        return None
+    return depth
+
+
+def get_drs_level(root, pattern="*.nc"):
+    '''
+    Returns the index in CMIP5_DATANODE_FP_ATTS of the facet named by root, or None if unknown
+
+    The level is worked out from the files of root's own first branch (see get_drs_depth). -1
+    is the directory holding the activity directories.
+    '''
+    depth = get_drs_depth(root, pattern)
+    if depth is None or depth > len(CMIP5_DATANODE_FP_ATTS):
+        return None
+    return len(CMIP5_DATANODE_FP_ATTS) - 1 - depth
+
+
+def get_drs_dir_facets(base_dir, pattern="*.nc"):
+    '''
+    Returns the datanode DRS facet named by each directory level below base_dir
+
+    The layout is that of the first branch of the tree. Returns None if it does not fit the DRS.
+    '''
+    level = get_drs_level(base_dir, pattern)
+    if level is None:
+        return None
+    return CMIP5_DATANODE_FP_ATTS[level + 1:]
+
+
+class DrsPruner(object):
+    """Drops the subdirectories of a DRS tree whose path components rule out every entry of a filter.
+
+    A subdirectory is only dropped once the files of its own first branch confirm the facet it
+    was matched as, so branches of another depth (eg: with or without the activity and product
+    levels) or holding stray files are listed rather than mislabeled. The directories that are
+    kept take the next level down, and only those whose level is unknown are probed.
+
+    Attributes:
+        base_dir (str): Root of the tree.
+        filter (Filter): Files to look for.
+        pattern (str): Shell pattern of the files.
+    """
+
+    def __init__(self, base_dir, _filter, pattern="*.nc"):
+        """Initializes a ``DrsPruner``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.base_dir = base_dir
+        self.filter = _filter
+        self.pattern = pattern
+        # Levels of directories not listed yet
+        self._levels = {}
+
+    def __call__(self, root, dirnames):
+        """Returns the subdirectories of root that may contain files included in the filter
+        """
+        level = self._levels.pop(root) if root in self._levels else get_drs_level(root, self.pattern)
+        if level is None or level + 1 >= len(CMIP5_DATANODE_FP_ATTS):
+            return dirnames
+
+        parts = [] if root == self.base_dir else os.path.relpath(root, self.base_dir).split(os.sep)
+        facets = dict((CMIP5_DATANODE_FP_ATTS[level - i], part) for i, part in enumerate(reversed(parts)) if level - i >= 0)
+        facet = CMIP5_DATANODE_FP_ATTS[level + 1]
+        keep = []
+        for dirname in dirnames:
+            path = os.path.join(root, dirname)
+            facets[facet] = dirname
+            if self.filter.allows_facets(facets):
+                self._levels[path] = level + 1
+                keep.append(dirname)
+                continue
+            actual = get_drs_level(path, self.pattern)
+            if actual != level + 1:
+                log.debug('{} does not fit the DRS layout of {}, not pruning it'.format(dirname, root))
+                self._levels[path] = actual
+                keep.append(dirname)
+        return keep
+
+
 def model_run_filter(fpath, valid_model_runs):
     '''
     Determines if a file path is within the provided filter
@@ -34,16 +221,67 @@ def iter_matching_cmip5_file(file_iter, _filter=None):
             yield fp
 
 
-def group_files_by_model_set(file_iter):
+def group_files_by_model_set(file_iter, concatenate=False):
 
+    return group_cmip5_files_by_model_set(((Cmip5File(datanode_fp = fp), fp) for fp in file_iter), concatenate)
+
+
+def get_subset_date_key(date, end=False):
+    '''
+    Returns a sort key for a date of a CMOR temporal subset (YYYY[MM[DD[hh[mm]]]])
+
+    Dates of different precisions are compared by the first (or with end, the last) moment of
+    the period they name, eg: 200601 sorts before 20060101 and end 210012 after 21001231.
+    '''
+    return date.ljust(12, '9' if end else '0')
+
+
+def group_cmip5_files_by_model_set(cf_iter, concatenate=False):
+    '''
+    Groups (Cmip5File, file path) pairs into DerivableBase model sets
+
+    Files are grouped by model, experiment, ensemble member and temporal subset. With
+    `concatenate`, all temporal subsets of a run at one frequency and MIP table are grouped
+    together and each base variable is a list of its temporal pieces (see pyclimate.concat), so
+    variables that are split into files differently can still be derived together. The temporal
+    subset of such a model set spans all of its files.
+
+    Only the latest version of each base variable is used and the files of older versions are
+    dropped with a warning.
+    '''
+
+    # Files of the latest version of each base variable, by model set key
+    groups = defaultdict(dict)
     model_sets = defaultdict(dict)
-    for fp in file_iter:
-        cf = Cmip5File(datanode_fp = fp)
-        key = '{}_{}_{}_{}-{}'.format(cf.model, cf.experiment, cf.ensemble_member, cf.t_start, cf.t_end)
+    for cf, fp in cf_iter:
+        if concatenate:
+            key = '{}_{}_{}_{}_{}'.format(cf.model, cf.experiment, cf.ensemble_member, cf.frequency, cf.mip_table)
+        else:
+            key = '{}_{}_{}_{}-{}'.format(cf.model, cf.experiment, cf.ensemble_member, cf.t_start, cf.t_end)
 
         if key not in model_sets:
             model_sets[key] = DerivableBase(**{k: cf.__dict__[k] for k in ('institute', 'model', 'experiment', 'frequency', 'modeling_realm', 'mip_table', 'ensemble_member', 'version_number', 'temporal_subset')})
 
-        model_sets[key].add_base_variable(cf.variable_name, fp)
+        version, files = groups[key].get(cf.variable_name, (cf.version_number, []))
+        if cf.version_number < version:
+            log.warning('Using version {} of {} in {}, dropping {}'.format(version, cf.variable_name, key, fp))
+            continue
+        if cf.version_number > version:
+            log.warning('Using version {} of {} in {}, dropping {}'.format(cf.version_number, cf.variable_name, key, ', '.join(x for _, x in files)))
+            files = []
+        groups[key][cf.variable_name] = (cf.version_number, files + [(cf, fp)])
+
+    for key, variables in groups.items():
+        base = model_sets[key]
+        if concatenate:
+            cfs = [cf for _, files in variables.values() for cf, _ in files]
+            t_start = min((cf.t_start for cf in cfs), key=get_subset_date_key)
+            t_end = max((cf.t_end for cf in cfs), key=lambda x: get_subset_date_key(x, end=True))
+            base.temporal_subset = '{}-{}'.format(t_start, t_end)
+            for variable_name, (version, files) in variables.items():
+                base.add_base_variable(variable_name, sorted(fp for _, fp in files))
+        else:
+            for variable_name, (version, files) in variables.items():
+                base.add_base_variable(variable_name, files[-1][1])
 
     return model_sets
@@ -0,0 +1,133 @@
+import queue
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+'''
+A three stage read/compute/write pipeline over blocks of data.
+
+The read stage and the write stage each run in a dedicated thread and are connected to the
+compute stage (run in the calling thread) by bounded queues, so reading the next block and
+writing the previous one overlap with computing the current one. Any file handle a stage uses
+should be opened and used by that stage only.
+
+The netCDF and HDF5 libraries are generally not built thread safe, even for distinct files, so
+at most one stage should call into them. Derivations hand their blocks on from the write stage
+to a process of its own (see ``pyclimate.writer``).
+'''
+
+# Marks the end of the items passed through a queue
+_DONE = object()
+# Returned by _get when the pipeline was stopped by a failing stage
+_STOPPED = object()
+
+# Seconds between checks for a stopped pipeline while blocked on a queue
+_POLL_SECONDS = 0.1
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return _STOPPED
+
+
+class StageThread(threading.Thread):
+    """Runs a stage of a pipeline, stopping the whole pipeline if it raises.
+
+    Attributes:
+        target (callable): The stage.
+        stop (threading.Event): Set when any stage fails.
+        errors (list): Exceptions raised by stages.
+    """
+
+    def __init__(self, target, name, stop, errors):
+        super(StageThread, self).__init__(name=name)
+        self.daemon = True
+        self.target = target
+        self.stop = stop
+        self.errors = errors
+
+    def run(self):
+        try:
+            self.target()
+        except BaseException as e:
+            log.debug('Pipeline stage {} failed'.format(self.name), exc_info=True)
+            self.errors.append(e)
+            self.stop.set()
+
+
+def run_pipeline(produce, transform, consume, depth=1):
+    '''
+    Runs consume(transform(item)) for every item yielded by produce()
+
+    With depth 0 all stages run one after the other in the calling thread. Otherwise
+    produce() is called and iterated in a reader thread, consume in a writer thread, and up
+    to `depth` items wait between stages. An exception in any stage stops the others and
+    is raised once they have finished. An unfinished iterator returned by produce() is
+    closed in the reader thread, so a generator can release its handles in a finally block.
+    '''
+    if depth <= 0:
+        for item in produce():
+            consume(transform(item))
+        return
+
+    stop = threading.Event()
+    errors = []
+    read_queue = queue.Queue(depth)
+    write_queue = queue.Queue(depth)
+
+    def reader():
+        items = produce()
+        try:
+            while True:
+                item = next(items, _DONE)
+                if not _put(read_queue, item, stop) or item is _DONE:
+                    return
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    def writer():
+        while True:
+            item = _get(write_queue, stop)
+            if item is _DONE or item is _STOPPED:
+                return
+            consume(item)
+
+    threads = [StageThread(reader, 'reader', stop, errors), StageThread(writer, 'writer', stop, errors)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = _get(read_queue, stop)
+            if item is _STOPPED:
+                break
+            elif item is _DONE:
+                _put(write_queue, _DONE, stop)
+                break
+            elif not _put(write_queue, transform(item), stop):
+                break
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,363 @@
+import os
+import struct
+import logging
+
+import numpy as np
+from netCDF4 import default_fillvals
+
+from pyclimate.handles import acquire_dataset, release_dataset, get_dataset_pool, set_chunk_cache
+
+log = logging.getLogger(__name__)
+
+'''
+Readers for the base variables of a derivation.
+
+Variables of NetCDF3 (classic, 64-bit offset and 64-bit data) files are stored uncompressed at
+byte offsets given in the file header, so they can be read as views of a memory map: slabs are
+served straight from the page cache without going through the netCDF library. Variables of any
+other file (eg: compressed or chunked NetCDF4/HDF5), or with attributes the memory mapped reader
+does not apply (packing, valid ranges), are read through netCDF4.
+
+Both readers return masked arrays, masking values as netCDF4 does with its default settings.
+They can also read raw values along with a boolean mask (``read``), computed into a reusable
+buffer, which avoids the masked array machinery altogether.
+'''
+
+BACKENDS = ('auto', 'memmap', 'netcdf4')
+
+CLASSIC_MAGIC = {b'CDF\x01': 1, b'CDF\x02': 2, b'CDF\x05': 5}
+
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+NC_TYPES = {
+    1: '>i1', 2: 'S1', 3: '>i2', 4: '>i4', 5: '>f4', 6: '>f8',
+    7: '>u1', 8: '>u2', 9: '>u4', 10: '>i8', 11: '>u8'
+}
+
+# Attributes that change values on read in ways the memory mapped reader does not reproduce
+UNSUPPORTED_ATTRIBUTES = ('scale_factor', 'add_offset', 'valid_min', 'valid_max', 'valid_range')
+
+STREAMING = 0xFFFFFFFF
+
+
+class HeaderError(Exception):
+    """Raised for a file that is not a NetCDF3 file or that can not be parsed.
+    """
+    pass
+
+
+class ClassicHeader(object):
+    """Dimensions, attributes and data layout from the header of a NetCDF3 file.
+
+    Attributes:
+        version (int): 1 (classic), 2 (64-bit offset) or 5 (64-bit data).
+        numrecs (int): Number of records along the unlimited dimension.
+        dimensions (list): (name, length) of each dimension. The unlimited dimension has length None.
+        attributes (dict): Global attributes.
+        variables (dict): Variable name to a dict of 'dimensions', 'attributes', 'dtype',
+            'vsize' and 'begin' (byte offset of its data).
+    """
+
+    def __init__(self, f):
+        """Parses the header of an open file
+
+        Args:
+            f (file): File open for binary reading, positioned at its start.
+
+        Raises:
+            HeaderError: If the file is not a NetCDF3 file.
+        """
+        magic = f.read(4)
+        if magic not in CLASSIC_MAGIC:
+            raise HeaderError('Not a NetCDF3 file')
+        self.version = CLASSIC_MAGIC[magic]
+        self._f = f
+
+        self.numrecs = self._read_size()
+        self.dimensions = [(name, length or None) for name, length in self._read_list(NC_DIMENSION, self._read_dimension)]
+        self.attributes = dict(self._read_list(NC_ATTRIBUTE, self._read_attribute))
+        self.variables = dict(self._read_list(NC_VARIABLE, self._read_variable))
+        del self._f
+
+    def _read(self, fmt):
+        fmt = '>' + fmt
+        data = self._f.read(struct.calcsize(fmt))
+        if len(data) != struct.calcsize(fmt):
+            raise HeaderError('Truncated header')
+        return struct.unpack(fmt, data)
+
+    def _read_size(self):
+        return self._read('Q' if self.version == 5 else 'I')[0]
+
+    def _read_name(self):
+        length = self._read_size()
+        name = self._f.read(length)
+        self._f.read(-length % 4)
+        return name.decode('utf-8')
+
+    def _read_list(self, tag, read_item):
+        found, = self._read('I')
+        nelems = self._read_size()
+        if found == 0 and nelems == 0:
+            return []
+        if found != tag:
+            raise HeaderError('Expected tag {} but found {}'.format(tag, found))
+        return [read_item() for i in range(nelems)]
+
+    def _read_dimension(self):
+        return self._read_name(), self._read_size()
+
+    def _read_attribute(self):
+        name = self._read_name()
+        nc_type, = self._read('I')
+        nelems = self._read_size()
+        dtype = np.dtype(NC_TYPES[nc_type])
+        data = self._f.read(nelems * dtype.itemsize)
+        self._f.read(-len(data) % 4)
+        if nc_type == 2:
+            return name, data.decode('utf-8', 'replace').rstrip('\x00')
+        values = np.frombuffer(data, dtype=dtype).astype(dtype.newbyteorder('='))
+        return name, values[0] if len(values) == 1 else values
+
+    def _read_variable(self):
+        name = self._read_name()
+        ndims = self._read_size()
+        dimids = [self._read_size() for i in range(ndims)]
+        attributes = dict(self._read_list(NC_ATTRIBUTE, self._read_attribute))
+        nc_type, = self._read('I')
+        vsize = self._read_size()
+        begin, = self._read('I' if self.version == 1 else 'Q')
+        return name, {
+            'dimensions': [self.dimensions[i] for i in dimids],
+            'attributes': attributes,
+            'dtype': np.dtype(NC_TYPES[nc_type]),
+            'vsize': vsize,
+            'begin': begin
+        }
+
+    def is_record_variable(self, varname):
+        dimensions = self.variables[varname]['dimensions']
+        return bool(dimensions) and dimensions[0][1] is None
+
+    @property
+    def record_size(self):
+        """Bytes per record, the sum of the sizes of each record variable.
+
+        A file with a single record variable stores its records without padding.
+        """
+        record_vars = [v for v in self.variables if self.is_record_variable(v)]
+        if len(record_vars) == 1:
+            info = self.variables[record_vars[0]]
+            return int(np.prod([length for name, length in info['dimensions'][1:]])) * info['dtype'].itemsize
+        return sum(self.variables[v]['vsize'] for v in record_vars)
+
+
+def read_classic_header(fp):
+    '''
+    Returns the ClassicHeader of a file, or None if it is not a NetCDF3 file
+    '''
+    with open(fp, 'rb') as f:
+        try:
+            return ClassicHeader(f)
+        except HeaderError:
+            return None
+
+
+def get_mask_values(attributes, dtype):
+    '''
+    Returns the values netCDF4 masks by default for a variable with `attributes` and `dtype`
+
+    These are _FillValue (or the default fill value of the type, except for bytes) and any
+    missing_value that can be represented exactly in the type.
+    '''
+    values = []
+    if '_FillValue' in attributes:
+        values.append(attributes['_FillValue'])
+    elif dtype.str[1:] not in ('i1', 'u1', 'S1'):
+        values.append(default_fillvals[dtype.str[1:]])
+    if 'missing_value' in attributes:
+        for mv in np.atleast_1d(attributes['missing_value']):
+            if np.array(mv).astype(dtype) == mv:
+                values.append(mv)
+    values = [np.array(x).astype(dtype) for x in values]
+    return [x for i, x in enumerate(values) if not any(x == y for y in values[:i])]
+
+
+def get_fill_mask(data, mask_values, out=None):
+    '''
+    Returns a boolean array of where data equals any of `mask_values`, or None where it never does
+
+    The mask is computed into `out` if given.
+    '''
+    if not mask_values:
+        return None
+    mask = np.equal(data, mask_values[0], out=out)
+    for value in mask_values[1:]:
+        mask |= data == value
+    return mask if mask.any() else None
+
+
+def read_raw(variable, key, pool=None):
+    '''
+    Reads a slab of a variable as (data, mask)
+
+    `data` is not masked and `mask` is a boolean array, or None if nothing is masked. With a
+    BufferPool, the mask is computed into one of its arrays.
+    '''
+    data = variable._read_unmasked(key)
+    if variable.mask_values is None:
+        # Masked by netCDF4 because of attributes get_mask_values does not handle
+        return np.ma.getdata(data), (np.ma.getmaskarray(data) if np.ma.is_masked(data) else None)
+    out = pool.get(variable.varname + '.mask', data.shape, bool) if pool else None
+    return data, get_fill_mask(data, variable.mask_values, out)
+
+
+class MemmapVariable(object):
+    """A NetCDF3 variable read as a view of a memory map of its file.
+
+    Slabs are views of the file data (in the file's big endian byte order), wrapped as
+    masked arrays masking the same values as netCDF4.
+
+    Attributes:
+        fp (str): Location of the file.
+        varname (str): Variable name.
+        shape (tuple): Shape of the variable.
+        dtype (numpy.dtype): Type of the stored values.
+    """
+
+    def __init__(self, fp, varname, header=None):
+        """Initializes a ``MemmapVariable``
+
+        Args:
+            fp (str): Location of the file.
+            varname (str): Variable name.
+            header (ClassicHeader): Parsed header of the file, if already read.
+
+        Raises:
+            HeaderError: If the file is not a NetCDF3 file.
+            KeyError: If the file has no variable `varname`.
+        """
+        header = header or read_classic_header(fp)
+        if header is None:
+            raise HeaderError('{} is not a NetCDF3 file'.format(fp))
+        info = header.variables[varname]
+
+        self.fp = fp
+        self.varname = varname
+        self.dtype = info['dtype']
+        self.attributes = info['attributes']
+        self.mask_values = get_mask_values(self.attributes, self.dtype)
+
+        lengths = [length for name, length in info['dimensions']]
+        itemsize = self.dtype.itemsize
+        inner_strides = tuple(int(np.prod(lengths[i + 1:])) * itemsize for i in range(len(lengths)))
+
+        if header.is_record_variable(varname):
+            record_size = header.record_size
+            numrecs = header.numrecs
+            if numrecs == STREAMING or numrecs == 2 ** 64 - 1:
+                numrecs = (os.path.getsize(fp) - info['begin']) // max(record_size, 1)
+            lengths[0] = numrecs
+            strides = (record_size,) + inner_strides[1:]
+        else:
+            strides = inner_strides
+        self.shape = tuple(lengths)
+
+        size = int(np.prod(self.shape)) * itemsize
+        if size == 0:
+            self._data = np.empty(self.shape, dtype=self.dtype)
+        else:
+            # Map just the bytes spanned by the variable
+            span = sum((n - 1) * s for n, s in zip(self.shape, strides)) + itemsize
+            raw = np.memmap(fp, dtype='u1', mode='r', offset=info['begin'], shape=(span,))
+            self._data = np.ndarray(self.shape, dtype=self.dtype, buffer=raw, strides=strides)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        data = self._data[key]
+        mask = get_fill_mask(data, self.mask_values)
+        return np.ma.masked_array(data, mask=np.ma.nomask if mask is None else mask, copy=False)
+
+    def read(self, key, pool=None):
+        return read_raw(self, key, pool)
+
+    def _read_unmasked(self, key):
+        return self._data[key]
+
+    def close(self):
+        self._data = None
+
+
+class NetCDF4Variable(object):
+    """A variable read through netCDF4, with the same interface as ``MemmapVariable``.
+
+    Raw reads (``read``) turn off netCDF4's automatic masking unless the variable has
+    attributes in ``UNSUPPORTED_ATTRIBUTES``. The Dataset comes from the process' handle pool
+    (see ``pyclimate.handles``) and may be shared with other readers of the same file.
+    """
+
+    def __init__(self, fp, varname):
+        self.fp = fp
+        self.varname = varname
+        self.nc = acquire_dataset(fp)
+        self.ncvar = self.nc.variables[varname]
+        chunk_cache_mb = get_dataset_pool().chunk_cache_mb
+        if chunk_cache_mb and self.nc.data_model == 'NETCDF4':
+            set_chunk_cache(self.ncvar, chunk_cache_mb)
+        self.shape = self.ncvar.shape
+        self.dtype = self.ncvar.dtype
+        attributes = dict((k, self.ncvar.getncattr(k)) for k in self.ncvar.ncattrs())
+        if self.dtype.kind in 'fiu' and not any(x in attributes for x in UNSUPPORTED_ATTRIBUTES):
+            self.mask_values = get_mask_values(attributes, self.dtype)
+        else:
+            self.mask_values = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        self.ncvar.set_auto_mask(True)
+        return self.ncvar[key]
+
+    def read(self, key, pool=None):
+        return read_raw(self, key, pool)
+
+    def _read_unmasked(self, key):
+        self.ncvar.set_auto_mask(self.mask_values is None)
+        return self.ncvar[key]
+
+    def close(self):
+        release_dataset(self.nc)
+
+
+def open_variable(fp, varname, backend='auto'):
+    '''
+    Opens a variable for reading with a backend
+
+    With 'auto', variables of NetCDF3 files are memory mapped unless they have attributes
+    in UNSUPPORTED_ATTRIBUTES or are character data, and anything else is read with netCDF4.
+    A list of files is read as the concatenation of its temporal pieces, each with `backend`.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('Unknown reader backend {}. Expected one of {}'.format(backend, BACKENDS))
+    # Imported here as pyclimate.concat imports this module
+    from pyclimate.concat import ConcatenatedVariable, is_concatenation
+    if is_concatenation(fp):
+        return ConcatenatedVariable(fp, varname, backend)
+    if backend == 'netcdf4':
+        return NetCDF4Variable(fp, varname)
+
+    header = read_classic_header(fp)
+    if backend == 'memmap':
+        return MemmapVariable(fp, varname, header)
+
+    if header is not None and varname in header.variables:
+        info = header.variables[varname]
+        if info['dtype'].kind != 'S' and not any(x in info['attributes'] for x in UNSUPPORTED_ATTRIBUTES):
+            log.debug('Memory mapping {} of {}'.format(varname, fp))
+            return MemmapVariable(fp, varname, header)
+    return NetCDF4Variable(fp, varname)
@@ -0,0 +1,328 @@
+import logging
+
+import numpy as np
+from netCDF4 import Dataset
+
+log = logging.getLogger(__name__)
+
+'''
+Spatial subsetting of derivations to a region of the grid.
+
+A region, given as a bounding box or a mask NetCDF, is resolved once per derivation into a
+``RegionWindow``: the range of latitude indices and the longitude indices that cover it, found
+with vectorized searches over the coordinates. Base variables are then read through a
+``SubsetVariable`` that only reads the window's hyperslabs, and outputs are created on the
+window's grid. Windows crossing the longitude seam of the grid (eg: 350 to 10 on a 0-360 grid)
+are read as two hyperslabs, with the longitudes before the seam shifted by -360 in the output
+so that they stay increasing.
+'''
+
+
+class Region(object):
+    """An area to derive variables over, instead of the whole grid.
+
+    Exactly one of ``bbox`` and ``mask_fp`` is given.
+
+    Attributes:
+        bbox (tuple): (lat_min, lat_max, lon_min, lon_max) in degrees. Longitudes may be given
+            in either of the -180-180 and 0-360 conventions, whatever that of the grid. A box
+            with lon_min > lon_max crosses 180 (or 0) degrees.
+        mask_fp (str): NetCDF holding a (lat, lon) variable on the grid of the base variables,
+            non zero and not masked inside the region. Cells outside of it are masked in outputs.
+        mask_varname (str): Variable of ``mask_fp``. Defaults to its only two dimensional variable.
+    """
+
+    def __init__(self, bbox=None, mask_fp=None, mask_varname=None):
+        """Initializes a ``Region``
+
+        Args:
+            Same as ``Attributes``
+        """
+        if (bbox is None) == (mask_fp is None):
+            raise ValueError('A region is either a bounding box or a mask')
+        if bbox is not None:
+            bbox = tuple(float(x) for x in bbox)
+            if len(bbox) != 4 or bbox[0] > bbox[1]:
+                raise ValueError('Invalid bounding box {}. Expected (lat_min, lat_max, lon_min, lon_max)'.format(bbox))
+        self.bbox = bbox
+        self.mask_fp = mask_fp
+        self.mask_varname = mask_varname
+
+    def __repr__(self):
+        if self.bbox:
+            return 'Region(bbox={})'.format(self.bbox)
+        return 'Region(mask_fp={}, mask_varname={})'.format(self.mask_fp, self.mask_varname)
+
+    def as_dict(self):
+        """Returns the region as a JSON serializable dict.
+        """
+        return {'bbox': list(self.bbox) if self.bbox else None, 'mask_fp': self.mask_fp, 'mask_varname': self.mask_varname}
+
+    def get_window(self, nc, varname):
+        """Resolves the region on the grid of a variable.
+
+        Args:
+            nc (netCDF4.Dataset): Dataset of the variable, with its (lat, lon) coordinates.
+            varname (str): Variable whose last two dimensions are (lat, lon).
+
+        Returns:
+            RegionWindow: The indices of the grid covering the region.
+
+        Raises:
+            ValueError: If the grid has no one dimensional coordinates, or no cell of it is in
+                the region.
+        """
+        ncvar = nc.variables[varname]
+        lat_dim, lon_dim = ncvar.dimensions[-2:]
+        if self.mask_fp:
+            window = get_mask_window(self.mask_fp, self.mask_varname, ncvar.shape[-2:])
+        else:
+            for dim in (lat_dim, lon_dim):
+                if dim not in nc.variables or nc.variables[dim].ndim != 1:
+                    raise ValueError('Bounding boxes need one dimensional {} coordinates'.format(dim))
+            lats = np.ma.getdata(nc.variables[lat_dim][:])
+            lons = np.ma.getdata(nc.variables[lon_dim][:])
+            window = get_bbox_window(lats, lons, self.bbox)
+        log.info('Region {} covers {}x{} cells of the {}x{} grid'.format(self, window.shape[0], window.shape[1], *ncvar.shape[-2:]))
+        return window
+
+
+class RegionWindow(object):
+    """Indices of the cells of a (lat, lon) grid covering a region.
+
+    Attributes:
+        lat_slice (slice): Latitude indices, with a step of 1.
+        lon_index (numpy.ndarray): Longitude indices, increasing except where the window
+            wraps around the end of the grid.
+        wrap (int): Number of longitude indices before the seam of the grid, or 0 if the
+            window does not cross it.
+        mask (numpy.ndarray): True for cells of the window outside of the region, or None.
+    """
+
+    def __init__(self, lat_slice, lon_index, wrap=0, mask=None):
+        """Initializes a ``RegionWindow``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.lat_slice = lat_slice
+        self.lon_index = np.asarray(lon_index, dtype=int)
+        self.wrap = wrap
+        self.mask = mask if mask is not None and mask.any() else None
+
+    @property
+    def shape(self):
+        return (self.lat_slice.stop - self.lat_slice.start, len(self.lon_index))
+
+    def get_shape(self, shape):
+        """Returns the shape of a variable of `shape` subset to the window.
+        """
+        return tuple(shape[:-2]) + self.shape
+
+    def get_keys(self, lat_key, lon_key):
+        """Returns (lat slice, lon slice) of the full grid for each hyperslab of a slab of the window.
+        """
+        lats = range(self.lat_slice.start, self.lat_slice.stop)[lat_key]
+        lons = self.lon_index[lon_key]
+        if len(lons) == 0:
+            return [(slice(lats.start, lats.stop), slice(0, 0))]
+        # Runs of consecutive longitudes are read as one hyperslab
+        breaks = np.flatnonzero(np.diff(lons) != 1) + 1
+        return [(slice(lats.start, lats.stop), slice(run[0], run[-1] + 1)) for run in np.split(lons, breaks)]
+
+    def get_lons(self, lons):
+        """Returns the longitudes (or their bounds) of the window, shifting those before the seam so they increase.
+        """
+        values = np.array(lons[self.lon_index], dtype=np.float64)
+        values[:self.wrap] -= 360
+        return values
+
+
+def get_index_range(coords, low, high):
+    '''
+    Returns (start, stop) of the coordinates within [low, high], for coordinates sorted either way
+    '''
+    ascending = len(coords) < 2 or coords[-1] >= coords[0]
+    values = coords if ascending else coords[::-1]
+    start, stop = np.searchsorted(values, low, side='left'), np.searchsorted(values, high, side='right')
+    return (int(start), int(stop)) if ascending else (len(coords) - int(stop), len(coords) - int(start))
+
+
+def get_bbox_window(lats, lons, bbox):
+    '''
+    Returns the RegionWindow of the cells whose centres are within a bounding box
+
+    Longitudes must be increasing and span less than 360 degrees.
+    '''
+    lat_min, lat_max, lon_min, lon_max = bbox
+    start, stop = get_index_range(lats, lat_min, lat_max)
+
+    if np.any(np.diff(lons) <= 0):
+        raise ValueError('Longitudes of the grid are not increasing')
+    # Move the box to the longitude convention of the grid, starting from its first longitude
+    first = lons[0]
+    width = lon_max - lon_min if lon_max - lon_min >= 360 else (lon_max - lon_min) % 360
+    low = (lon_min - first) % 360 + first
+    high = low + min(width, 360)
+    lon_index = np.arange(*get_index_range(lons, low, high))
+    wrap = 0
+    if high >= first + 360:
+        # The rest of the box is at the start of the grid
+        wrapped = np.arange(*get_index_range(lons, first, high - 360))
+        wrapped = wrapped[~np.isin(wrapped, lon_index)]
+        if len(wrapped) and len(lon_index):
+            wrap = len(lon_index)
+        lon_index = np.concatenate([lon_index, wrapped])
+
+    if stop <= start or len(lon_index) == 0:
+        raise ValueError('Bounding box {} contains no grid cells'.format(bbox))
+    return RegionWindow(slice(start, stop), lon_index, wrap)
+
+
+def get_mask_window(fp, varname, grid_shape):
+    '''
+    Returns the RegionWindow of the smallest window holding every cell of a mask NetCDF
+
+    The window crosses the seam of the grid if that makes it narrower.
+    '''
+    with Dataset(fp) as nc:
+        if varname is None:
+            candidates = [name for name, ncvar in nc.variables.items() if ncvar.ndim == 2]
+            if len(candidates) != 1:
+                raise ValueError('Expected a single two dimensional variable in {}, found {}'.format(fp, candidates))
+            varname = candidates[0]
+        values = nc.variables[varname][:]
+    if values.shape != tuple(grid_shape):
+        raise ValueError('Mask {} of {} is {}, not on the {} grid of the base variables'.format(varname, fp, values.shape, tuple(grid_shape)))
+    inside = np.ma.filled(values != 0, False)
+    rows, cols = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError('Mask {} of {} contains no grid cells'.format(varname, fp))
+
+    # Start after the widest gap between columns of the region, going around the seam
+    nlon = grid_shape[-1]
+    gaps = np.diff(np.concatenate([cols, [cols[0] + nlon]]))
+    last = int(np.argmax(gaps))
+    first_col, last_col = cols[(last + 1) % len(cols)], cols[last]
+    if first_col <= last_col:
+        lon_index, wrap = np.arange(first_col, last_col + 1), 0
+    else:
+        lon_index = np.concatenate([np.arange(first_col, nlon), np.arange(0, last_col + 1)])
+        wrap = nlon - first_col
+
+    lat_slice = slice(int(rows[0]), int(rows[-1]) + 1)
+    return RegionWindow(lat_slice, lon_index, wrap, ~inside[lat_slice][:, lon_index])
+
+
+class SubsetVariable(object):
+    """A variable read over a ``RegionWindow`` only, with the same interface as ``MemmapVariable``.
+
+    Keys index the window: their last two items select (lat, lon) within it. Cells of the
+    window outside of the region are masked.
+
+    Attributes:
+        variable: Variable of the full grid, as returned by ``pyclimate.reader.open_variable``.
+        window (RegionWindow): Cells of the grid to read.
+        shape (tuple): Shape of the variable over the window.
+        dtype (numpy.dtype): Type of the variable.
+    """
+
+    def __init__(self, variable, window):
+        """Initializes a ``SubsetVariable``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.variable = variable
+        self.window = window
+        self.shape = window.get_shape(variable.shape)
+        self.dtype = variable.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _split(self, key):
+        """Returns the keys of the full variable to read for a key of the window, and the window mask of the slab.
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        if any(x is Ellipsis for x in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (len(self.shape) - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        if not all(isinstance(x, slice) for x in key[-2:]):
+            raise IndexError('Subset variables can only be read over (lat, lon) slices')
+        keys = [key[:-2] + x for x in self.window.get_keys(key[-2], key[-1])]
+        mask = self.window.mask[key[-2], key[-1]] if self.window.mask is not None else None
+        return keys, mask
+
+    def __getitem__(self, key):
+        keys, mask = self._split(key)
+        data = np.ma.concatenate([self.variable[x] for x in keys], axis=-1) if len(keys) > 1 else self.variable[keys[0]]
+        if mask is None:
+            return data
+        return np.ma.masked_array(data, mask=np.ma.getmaskarray(data) | mask)
+
+    def read(self, key, pool=None):
+        """Reads a slab as (data, mask) like ``pyclimate.reader.read_raw``.
+
+        A slab within one hyperslab of the full grid and region is read as it would be from
+        the full variable. Anything else is assembled into arrays of the pool, if given.
+        """
+        keys, mask = self._split(key)
+        if len(keys) == 1 and mask is None:
+            return self.variable.read(keys[0], pool)
+
+        name = self.variable.varname
+        if len(keys) == 1:
+            data, data_mask = self.variable.read(keys[0], pool)
+        else:
+            # Hyperslabs of the same shape would share the pool's arrays for their masks
+            reads = [self.variable.read(x) for x in keys]
+            shape = reads[0][0].shape[:-1] + (sum(x.shape[-1] for x, m in reads),)
+            data = pool.get(name + '.subset', shape, self.dtype) if pool else np.empty(shape, self.dtype)
+            np.concatenate([x for x, m in reads], axis=-1, out=data)
+            data_mask = None
+            if any(m is not None for x, m in reads):
+                data_mask = pool.get(name + '.subset_mask', shape, bool) if pool else np.empty(shape, bool)
+                np.concatenate([np.zeros(x.shape, bool) if m is None else m for x, m in reads], axis=-1, out=data_mask)
+        if mask is None:
+            return data, data_mask
+
+        out = pool.get(name + '.region_mask', data.shape, bool) if pool else np.empty(data.shape, bool)
+        if data_mask is None:
+            out[...] = mask
+        else:
+            np.logical_or(data_mask, mask, out=out)
+        return data, out
+
+    def close(self):
+        self.variable.close()
+
+
+def nc_create_subset_dims(dsin, dsout, varname, window):
+    '''
+    Creates the (lat, lon) dimensions of a variable in dsout over a window, with their coordinates and bounds
+    '''
+    ncvar = dsin.variables[varname]
+    lat_dim, lon_dim = ncvar.dimensions[-2:]
+    for dim, size in zip((lat_dim, lon_dim), window.shape):
+        dsout.createDimension(dim, size)
+    for dim in (lat_dim, lon_dim):
+        if dim not in dsin.variables:
+            continue
+        ncvar_coord = dsin.variables[dim]
+        names = [dim]
+        bounds_name = getattr(ncvar_coord, 'bounds', None)
+        if bounds_name in dsin.variables:
+            names.append(bounds_name)
+        for name in names:
+            ncvar_in = dsin.variables[name]
+            for other in ncvar_in.dimensions[1:]:
+                if other not in dsout.dimensions:
+                    dsout.createDimension(other, len(dsin.dimensions[other]))
+            fill_value = getattr(ncvar_in, '_FillValue', None)
+            ncvar_out = dsout.createVariable(name, ncvar_in.datatype, ncvar_in.dimensions, fill_value=fill_value)
+            ncvar_out.setncatts(dict((k, ncvar_in.getncattr(k)) for k in ncvar_in.ncattrs() if k != '_FillValue'))
+            values = ncvar_in[:]
+            ncvar_out[:] = values[window.lat_slice] if dim == lat_dim else window.get_lons(values)
+    log.debug('Created {}x{} subset of the {} and {} dimensions'.format(window.shape[0], window.shape[1], lat_dim, lon_dim))
@@ -0,0 +1,355 @@
+import os
+import sys
+import time
+import logging
+import cProfile
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from pyclimate.concat import get_files
+from pyclimate.handles import get_dataset_pool
+from pyclimate.manifest import is_up_to_date
+from pyclimate.metrics import Metrics, get_peak_rss_mb, get_worker_identity
+from pyclimate.variables import get_derived_variable, DerivedVariableSet
+
+log = logging.getLogger(__name__)
+
+'''
+Runs derivation jobs on a pool of worker processes.
+
+Jobs are small picklable descriptions of the work (variable names, base variable paths, output
+directory and options) rather than DerivedVariable instances. They are started longest first,
+by the total size of their input files, so the biggest model sets do not become stragglers.
+'''
+
+
+class JobFailed(Exception):
+    """Raised by a job that can not succeed, so it is not retried.
+    """
+    pass
+
+
+class Job(object):
+    """Derives one or more variables from a single set of base variables.
+
+    When several variables are given they are derived in a single pass (see ``DerivedVariableSet``).
+
+    Attributes:
+        name (str): Identifies the job in progress output. eg: the model set key
+        variables (list): Short names of the variables to generate.
+        base_variables (dict): Dictionary mapping base variable name to file location.
+        outdir (str): Root directory to place output files.
+        incremental (bool): Skip variables whose output is up to date with its manifest.
+        digest (bool): Use content digests of the inputs in manifests.
+        pipeline_depth (int): Overlap reading, computing and writing, queueing up to this many blocks
+            between stages. 0 runs them one after the other.
+        tiles (tuple): Split the grid into this many (lat, lon) tiles, derived by a pool of
+            ``tile_processes`` worker processes. Tiled jobs can not run on a ``Scheduler``
+            with more than one process, as pool workers can not start pools of their own.
+        tile_processes (int): Size of the pool deriving tiles.
+        reader (str): How base variables are read. See ``pyclimate.reader``.
+        staging (StagingCache): Optional local cache the base variables are read from. A
+            ``Scheduler`` reserves the job's inputs in it until the job is done.
+        handle_pool (int): Number of idle Dataset handles the worker running the job keeps open
+            for later jobs reading the same files. See ``pyclimate.handles``.
+        chunk_cache_mb (float): Chunk cache size (MB) of each NetCDF4 base variable, or None
+            for netCDF4's default.
+        profile (str): Run the job under cProfile and write its stats to this file.
+        options (dict): Options passed on to each ``DerivedVariable``.
+        metrics (dict): Phase times and bytes moved by the last run (see ``pyclimate.metrics``).
+    """
+
+    def __init__(self, name, variables, base_variables, outdir, incremental=False, digest=False, pipeline_depth=0, tiles=None, tile_processes=None,
+                 reader='auto', staging=None, handle_pool=0, chunk_cache_mb=None, profile=None, **options):
+        """Initializes a ``Job``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.name = name
+        self.variables = variables
+        self.base_variables = base_variables
+        self.outdir = outdir
+        self.incremental = incremental
+        self.digest = digest
+        self.pipeline_depth = pipeline_depth
+        self.tiles = tiles
+        self.tile_processes = tile_processes
+        self.reader = reader
+        self.staging = staging
+        self.handle_pool = handle_pool
+        self.chunk_cache_mb = chunk_cache_mb
+        self.profile = profile
+        self.options = options
+        self.metrics = None
+
+    def __str__(self):
+        return '{} for {}'.format(', '.join(self.variables), self.name)
+
+    def get_derived_variables(self):
+        """Returns the ``DerivedVariable`` of each known variable of the job.
+        """
+        derived = [get_derived_variable(v, self.base_variables, self.outdir, **self.options) for v in self.variables]
+        return [v for v in derived if v is not None]
+
+    @property
+    def input_files(self):
+        """Locations of the base variables read by the job.
+        """
+        required = set(x for v in self.get_derived_variables() for x in v.required_vars)
+        return sorted(fp for x in required if x in self.base_variables for fp in get_files(self.base_variables[x]))
+
+    @property
+    def size(self):
+        """Total size in bytes of the job's input files.
+        """
+        return sum(os.path.getsize(fp) for fp in self.input_files if os.path.exists(fp))
+
+    def is_up_to_date(self):
+        """Checks whether every output of the job matches its manifest, without opening any NetCDF.
+        """
+        derived = self.get_derived_variables()
+        return bool(derived) and all(is_up_to_date(v, self.digest) for v in derived)
+
+    def __call__(self):
+        """Runs the job.
+
+        Returns:
+            list: Locations of the generated NetCDFs.
+
+        Raises:
+            JobFailed: If no variable is known or any lacks its base variables.
+        """
+        if self.profile:
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(self._run)
+            finally:
+                profiler.dump_stats(self.profile)
+                log.info('Wrote profile of {} to {}'.format(self, self.profile))
+        return self._run()
+
+    def _run(self):
+        derived = self.get_derived_variables()
+        if not derived:
+            raise JobFailed('No known variables in {}'.format(self.variables))
+        # Handles are pooled per worker process, so they carry over to its next jobs
+        get_dataset_pool().configure(self.handle_pool, self.chunk_cache_mb)
+        derived_set = DerivedVariableSet(derived, self.incremental, self.digest, self.pipeline_depth,
+                                         self.tiles, self.tile_processes, self.reader, self.staging)
+        try:
+            outputs = derived_set()
+        finally:
+            self.metrics = derived_set.metrics.as_dict()
+        missing = [v.variable_name for v, outfp in zip(derived, outputs) if outfp == 1]
+        if missing:
+            raise JobFailed('Insufficient base variables to calculate {}'.format(', '.join(missing)))
+        return outputs
+
+
+class JobResult(object):
+    """Outcome of a job.
+
+    Attributes:
+        job (Job): The job.
+        outputs (list): Locations of the generated NetCDFs, or None if the job failed.
+        error (str): Formatted exception of the last failed attempt, or None if the job succeeded.
+        attempts (int): Number of times the job was run.
+        seconds (float): Run time of the last attempt.
+        worker (str): Name of the process that ran the last attempt.
+        size (int): Total size in bytes of the job's input files.
+        metrics (dict): Metrics record of the last attempt. See ``get_metrics_record``.
+    """
+
+    def __init__(self, job, outputs=None, error=None, attempts=0, seconds=0., worker=None, size=0, metrics=None):
+        self.job = job
+        self.size = size
+        self.outputs = outputs
+        self.error = error
+        self.attempts = attempts
+        self.seconds = seconds
+        self.worker = worker
+        self.metrics = metrics
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return '{}: done in {:.1f}s'.format(self.job, self.seconds)
+        return '{}: failed after {} attempt(s)\n{}'.format(self.job, self.attempts, self.error)
+
+
+def get_metrics_record(job, seconds, ok):
+    '''
+    Returns a JSON serializable record of a job's metrics, peak memory and worker
+    '''
+    record = {
+        'job': str(job),
+        'name': job.name,
+        'variables': job.variables,
+        'ok': ok,
+        'total_seconds': seconds,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'worker': get_worker_identity()
+    }
+    record.update(job.metrics or Metrics().as_dict())
+    return record
+
+
+def run_job(index, job):
+    '''
+    Runs a job in a worker, returning (index, outputs, error, retryable, seconds, worker, metrics) instead of raising
+
+    The peak RSS in the metrics is that of the worker process so far, which may include earlier jobs.
+    '''
+    t0 = time.time()
+    worker = multiprocessing.current_process().name
+    job.metrics = None
+    try:
+        outputs, error, retryable = job(), None, False
+    except JobFailed:
+        outputs, error, retryable = None, traceback.format_exc(), False
+    except Exception:
+        outputs, error, retryable = None, traceback.format_exc(), True
+    seconds = time.time() - t0
+    return index, outputs, error, retryable, seconds, worker, get_metrics_record(job, seconds, error is None)
+
+
+class Progress(object):
+    """Tracks completed jobs and input bytes to report progress and throughput.
+    """
+
+    def __init__(self, total_jobs, total_bytes, stream=None):
+        self.total_jobs = total_jobs
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.done_jobs = 0
+        self.failed_jobs = 0
+        self.done_bytes = 0
+        self.start = time.time()
+
+    def update(self, result):
+        if result.ok:
+            self.done_jobs += 1
+            self.done_bytes += result.size
+        else:
+            self.failed_jobs += 1
+        if self.stream:
+            self.stream.write(self.summary() + '\n')
+            self.stream.flush()
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        finished = self.done_jobs + self.failed_jobs
+        return '[{}/{} jobs, {:.0%} of input] {:.3f} GB/s, {:.1f} jobs/min, {} failed'.format(
+            finished, self.total_jobs, float(self.done_bytes) / self.total_bytes if self.total_bytes else 1.,
+            self.done_bytes / elapsed / 1e9, finished / elapsed * 60, self.failed_jobs)
+
+
+class Scheduler(object):
+    """Runs jobs longest first on a pool of worker processes, retrying failed jobs.
+
+    Attributes:
+        processes (int): Number of worker processes. With 1, jobs run in the calling process.
+        retries (int): Times a job that raised an unexpected exception, or whose worker process
+            died, is run again.
+        progress (bool): Write progress and throughput to stderr after each job.
+    """
+
+    def __init__(self, processes=1, retries=1, progress=False):
+        """Initializes a ``Scheduler``
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.processes = processes
+        self.retries = retries
+        self.progress = progress
+
+    def run(self, jobs):
+        """Runs jobs to completion.
+
+        Args:
+            jobs (list): ``Job`` instances.
+
+        Returns:
+            list: A ``JobResult`` per job, in completion order.
+        """
+        sizes = [job.size for job in jobs]
+        order = sorted(range(len(jobs)), key=lambda i: sizes[i], reverse=True)
+        progress = Progress(len(jobs), sum(sizes), sys.stderr if self.progress else None)
+        log.info('Scheduling {} jobs reading {:.2f} GB on {} process(es)'.format(len(jobs), sum(sizes) / 1e9, self.processes))
+
+        attempts = dict((i, 0) for i in order)
+        results = []
+
+        # Inputs of every pending job stay staged until it is done
+        reserved = set(i for i in order if jobs[i].staging)
+        for i in reserved:
+            jobs[i].staging.reserve(jobs[i].input_files)
+
+        def finish(index, outputs, error, retryable, seconds, worker, metrics):
+            attempts[index] += 1
+            if error and retryable and attempts[index] <= self.retries:
+                log.warning('{} failed on attempt {}, retrying:\n{}'.format(jobs[index], attempts[index], error))
+                return True
+            if index in reserved:
+                reserved.remove(index)
+                jobs[index].staging.release(jobs[index].input_files)
+            result = JobResult(jobs[index], outputs, error, attempts[index], seconds, worker, sizes[index], metrics)
+            if result.ok:
+                log.info(str(result))
+            else:
+                log.error(str(result))
+            results.append(result)
+            progress.update(result)
+            return False
+
+        try:
+            if self.processes <= 1:
+                for i in order:
+                    while finish(*run_job(i, jobs[i])):
+                        pass
+            else:
+                self._run_pool(jobs, order, finish)
+        finally:
+            for i in reserved:
+                jobs[i].staging.release(jobs[i].input_files)
+        return results
+
+    def _run_pool(self, jobs, order, finish):
+        waiting = deque(order)
+        running = {}
+        executor = ProcessPoolExecutor(self.processes)
+        try:
+            while waiting or running:
+                # No more jobs in flight than workers, so only running jobs are lost with a broken pool
+                while waiting and len(running) < self.processes:
+                    i = waiting.popleft()
+                    running[executor.submit(run_job, i, jobs[i])] = i
+                done = wait(running, return_when=FIRST_COMPLETED).done
+                broken = any(isinstance(f.exception(), BrokenProcessPool) for f in done)
+                if broken:
+                    # A worker died (eg: killed for running out of memory), taking every job in flight with it
+                    done = wait(running).done
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        returned = future.result()
+                    except BrokenProcessPool:
+                        returned = (i, None, 'A worker process died while running the job\n', True, 0., None, None)
+                    except Exception as e:
+                        # Failures to transfer a job or its result are reported like any other retryable error
+                        returned = (i, None, repr(e), True, 0., None, None)
+                    if finish(*returned):
+                        waiting.appendleft(i)
+                if broken:
+                    executor.shutdown()
+                    executor = ProcessPoolExecutor(self.processes)
+        finally:
+            executor.shutdown()
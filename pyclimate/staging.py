@@ -0,0 +1,204 @@
+import os
+import time
+import shutil
+import logging
+import sqlite3
+from contextlib import contextmanager
+
+from pyclimate.concat import is_concatenation
+
+log = logging.getLogger(__name__)
+
+'''
+Staging of input files on fast local storage.
+
+Input files are copied once to a local scratch directory and read from there by every job that
+needs them. Copies are kept within a byte budget by evicting the least recently used files that
+no scheduled job still needs: jobs reserve their inputs when they are scheduled and release them
+when they are done, so the inputs of a model set stay staged until its last job has run.
+
+The state of the cache is kept in an SQLite database in the scratch directory, so it is shared
+by the worker processes of a scheduler and carried over from one run to the next.
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    local TEXT,
+    size INTEGER,
+    mtime REAL,
+    staged INTEGER DEFAULT 0,
+    last_used REAL,
+    refs INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_eviction ON files (staged, refs, last_used);
+'''
+
+# Seconds to wait for another process holding the database lock
+LOCK_TIMEOUT = 600
+
+
+class StagingCache(object):
+    """Local copies of input files, within a byte budget and evicted least recently used first.
+
+    Files are staged by ``stage``, which returns the location to read a file from: its local
+    copy, or the file itself if it can not be staged within the budget. A copy is replaced if
+    the size or mtime of its source changes.
+
+    Attributes:
+        directory (str): Local scratch directory holding the copies and the database.
+        max_bytes (int): Budget for the total size of the copies.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """Initializes a ``StagingCache``, creating the directory and database if needed.
+
+        Args:
+            Same as ``Attributes``
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._pid = None
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.conn.executescript(SCHEMA)
+
+    @property
+    def conn(self):
+        # A connection can not be shared with worker processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(os.path.join(self.directory, 'staging.sqlite'), timeout=LOCK_TIMEOUT, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_conn'] = state['_pid'] = None
+        return state
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the body of a ``with`` block as one transaction, holding the write lock throughout.
+        """
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get_local_path(self, fp):
+        return os.path.join(self.directory, 'files', os.path.abspath(fp).lstrip(os.sep))
+
+    @property
+    def used_bytes(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE staged = 1').fetchone()[0]
+
+    def reserve(self, fps):
+        """Marks files as needed by one more scheduled job, so that their copies are not evicted.
+        """
+        with self._transaction() as conn:
+            for fp in fps:
+                fp = os.path.abspath(fp)
+                conn.execute('INSERT OR IGNORE INTO files (path, local) VALUES (?, ?)', (fp, self.get_local_path(fp)))
+                conn.execute('UPDATE files SET refs = refs + 1 WHERE path = ?', (fp,))
+
+    def release(self, fps):
+        """Marks files as needed by one less scheduled job.
+        """
+        with self._transaction() as conn:
+            for fp in fps:
+                conn.execute('UPDATE files SET refs = MAX(refs - 1, 0) WHERE path = ?', (os.path.abspath(fp),))
+
+    def clear_references(self):
+        """Drops all reservations, eg: those left behind by an interrupted run.
+        """
+        with self._transaction() as conn:
+            conn.execute('UPDATE files SET refs = 0')
+
+    def stage(self, fp):
+        """Returns the location to read a file from, copying it to the cache first if needed.
+
+        Returns:
+            str: The local copy, or `fp` if it does not fit within the budget alongside the
+                copies of files that are still reserved.
+        """
+        fp = os.path.abspath(fp)
+        local = self.get_local_path(fp)
+        st = os.stat(fp)
+        with self._transaction() as conn:
+            row = conn.execute('SELECT * FROM files WHERE path = ?', (fp,)).fetchone()
+            if row and row['staged'] and row['size'] == st.st_size and row['mtime'] == st.st_mtime and os.path.exists(local):
+                conn.execute('UPDATE files SET last_used = ? WHERE path = ?', (time.time(), fp))
+                return local
+            if self._get_evictions(conn, fp, st.st_size) is None:
+                log.info('No room to stage {} without evicting reserved files, reading it in place'.format(fp))
+                return fp
+
+        # Copy outside of the lock so other processes can use the cache meanwhile
+        if not os.path.exists(os.path.dirname(local)):
+            try:
+                os.makedirs(os.path.dirname(local))
+            except OSError:
+                # Created by another process meanwhile
+                pass
+        tmp = '{}.{}.tmp'.format(local, os.getpid())
+        t0 = time.time()
+        shutil.copyfile(fp, tmp)
+        log.debug('Copied {} to {} in {:.1f}s'.format(fp, local, time.time() - t0))
+
+        with self._transaction() as conn:
+            evictions = self._get_evictions(conn, fp, st.st_size)
+            if evictions is None:
+                os.remove(tmp)
+                log.info('No room left to stage {}, reading it in place'.format(fp))
+                return fp
+            for row in evictions:
+                self._evict(conn, row)
+            os.rename(tmp, local)
+            conn.execute('INSERT OR IGNORE INTO files (path, local) VALUES (?, ?)', (fp, local))
+            conn.execute('UPDATE files SET local = ?, size = ?, mtime = ?, staged = 1, last_used = ? WHERE path = ?',
+                         (local, st.st_size, st.st_mtime, time.time(), fp))
+        return local
+
+    def _get_evictions(self, conn, fp, size):
+        """Returns the least recently used unreserved copies to evict to make room for a file, or None if it can not fit.
+        """
+        used = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE staged = 1 AND path != ?', (fp,)).fetchone()[0]
+        evictions = []
+        for row in conn.execute('SELECT path, local, size FROM files WHERE staged = 1 AND refs = 0 AND path != ? ORDER BY last_used', (fp,)):
+            if used + size <= self.max_bytes:
+                break
+            evictions.append(row)
+            used -= row['size']
+        return evictions if used + size <= self.max_bytes else None
+
+    def _evict(self, conn, row):
+        log.debug('Evicting {} from the staging cache'.format(row['path']))
+        try:
+            os.remove(row['local'])
+        except OSError:
+            pass
+        conn.execute('UPDATE files SET staged = 0, size = NULL WHERE path = ?', (row['path'],))
+
+
+def stage_files(cache, fp):
+    '''
+    Returns the locations to read a base variable from, a single file or a list of temporal pieces
+
+    Without a cache, the files are read in place.
+    '''
+    if cache is None:
+        return fp
+    if is_concatenation(fp):
+        return [cache.stage(x) for x in fp]
+    return cache.stage(fp)
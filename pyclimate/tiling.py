@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+from collections import deque
+
+import numpy as np
+from pyclimate.buffers import BufferPool
+from pyclimate.concat import get_files
+from pyclimate.nchelpers import iter_time_blocks
+from pyclimate.reader import open_variable
+from pyclimate.region import SubsetVariable
+
+log = logging.getLogger(__name__)
+
+'''
+Spatial tiling of derivations over a pool of worker processes.
+
+The last two (lat, lon) dimensions of the base variables are split into tiles. Each task reads
+and derives one tile of one block of time steps in a worker, which keeps its own handles on the
+base variables. The parent reassembles each block from its tiles so that the single output file
+is only ever written by the parent.
+'''
+
+# Blocks of time steps submitted ahead of the one being assembled
+BLOCKS_IN_FLIGHT = 2
+
+# Blocks held at once: those in flight in the workers and the one the parent assembles and
+# writes. The memory budget of a tiled derivation is divided between them
+BLOCKS_HELD = BLOCKS_IN_FLIGHT + 1
+
+# Base variables opened by this worker process, by (paths, variable name, reader backend)
+_worker_variables = {}
+
+# Derivation plans of this worker process and the buffers of their base variable masks, by
+# derived variable names. A pool only ever derives one set of variables
+_worker_plans = {}
+
+
+def get_tile_slices(size, ntiles):
+    '''
+    Returns up to `ntiles` slices splitting range(size) into nearly equal parts
+    '''
+    ntiles = max(1, min(ntiles, size))
+    bounds = np.linspace(0, size, ntiles + 1).round().astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def get_tiles(shape, tiles):
+    '''
+    Returns rows of (row slice, column slice) tiles splitting the last two dimensions of `shape`
+
+    Args:
+        shape (tuple): Variable shape. eg: (time, lat, lon)
+        tiles (tuple): Number of tiles along the second last and last dimensions.
+    '''
+    rows = get_tile_slices(shape[-2], tiles[0])
+    cols = get_tile_slices(shape[-1], tiles[1])
+    return [[(row, col) for col in cols] for row in rows]
+
+
+def assemble_tiles(rows):
+    '''
+    Joins rows of tile arrays back into a single array, keeping any mask
+    '''
+    return np.ma.concatenate([np.ma.concatenate(row, axis=-1) for row in rows], axis=-2)
+
+
+def _get_worker_variable(fp, varname, reader):
+    key = (tuple(get_files(fp)), varname, reader)
+    if key not in _worker_variables:
+        _worker_variables[key] = open_variable(fp, varname, reader)
+    return _worker_variables[key]
+
+
+def compute_tile(task):
+    '''
+    Derives one tile of one block of time steps in a worker
+
+    Args:
+        task (tuple): (derived variables, reader backend, TimeAlignment of the base variables or None,
+            locations to read the base variables from or None for their own, RegionWindow or None,
+            block slice, (row slice, column slice))
+
+    Returns:
+        list: Result of each derived variable for the tile
+    '''
+    # Imported here as pyclimate.variables imports this module
+    from pyclimate.variables import DerivationPlan
+
+    derived, reader, alignment, sources, window, block_slice, (row, col) = task
+    key = tuple(v.variable_name for v in derived)
+    if key not in _worker_plans:
+        _worker_plans[key] = (DerivationPlan(derived), BufferPool())
+    plan, mask_buffers = _worker_plans[key]
+
+    # Results are pickled back to the parent before the next task reuses the buffers
+    sources = sources or derived[0].base_variables
+    data, masks = {}, {}
+    for x in plan.base_vars:
+        time_slice = alignment.get_slice(x, block_slice) if alignment else block_slice
+        variable = _get_worker_variable(sources[x], x, reader)
+        if window is not None:
+            variable = SubsetVariable(variable, window)
+        data[x], masks[x] = variable.read((time_slice, Ellipsis, row, col), mask_buffers)
+    return plan.evaluate(data, masks)
+
+
+def iter_tiled_blocks(derived, nsteps, block_size, shape, tiles, processes=None, reader='auto', alignment=None, sources=None, window=None):
+    '''
+    Yields (block slice, results) for consecutive blocks of time steps, derived tile by tile on a pool
+
+    Results are ordered as `derived` and cover the full grid of the block, as if the block had
+    been derived in one piece. With a TimeAlignment, block slices index the time steps shared by
+    the base variables. Base variables are read from `sources` (eg: staged copies) if given,
+    and over the cells of a RegionWindow only if given, `shape` then being that of the window.
+    '''
+    tile_rows = get_tiles(shape, tiles)
+    processes = processes or min(sum(len(row) for row in tile_rows), multiprocessing.cpu_count())
+    log.info('Deriving {} in {}x{} tiles on {} processes'.format(
+        ', '.join(v.variable_name for v in derived), len(tile_rows), len(tile_rows[0]), processes))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for block_slice in iter_time_blocks(nsteps, block_size):
+            pending.append((block_slice, [[pool.apply_async(compute_tile, ((derived, reader, alignment, sources, window, block_slice, tile),)) for tile in row]
+                                          for row in tile_rows]))
+            if len(pending) > BLOCKS_IN_FLIGHT:
+                yield _collect(pending.popleft(), len(derived))
+        while pending:
+            yield _collect(pending.popleft(), len(derived))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _collect(pending_block, nresults):
+    block_slice, rows = pending_block
+    rows = [[result.get() for result in row] for row in rows]
+    return block_slice, [assemble_tiles([[tile[i] for tile in row] for row in rows]) for i in range(nresults)]
+
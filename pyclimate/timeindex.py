@@ -0,0 +1,204 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from netCDF4 import num2date
+
+log = logging.getLogger(__name__)
+
+'''
+Calendar aware grouping of a time axis into monthly, seasonal, annual and water year periods.
+
+Dates are resolved for the whole axis at once: calendars with fixed year lengths and the
+gregorian calendars after 1582-10-15 use vectorized arithmetic, anything else falls back to a
+single bulk num2date call.
+'''
+
+FREQUENCIES = ('monthly', 'seasonal', 'annual', 'water_year')
+
+SEASONS = ('DJF', 'MAM', 'JJA', 'SON')
+
+FIXED_CALENDAR_DAYS_PER_MONTH = {
+    '360_day': [30] * 12,
+    '365_day': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+    'noleap': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+    '366_day': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+    'all_leap': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+}
+
+GREGORIAN_CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+UNIT_DAYS = {
+    'days': 1., 'day': 1., 'd': 1.,
+    'hours': 1. / 24, 'hour': 1. / 24, 'hrs': 1. / 24, 'hr': 1. / 24, 'h': 1. / 24,
+    'minutes': 1. / 1440, 'minute': 1. / 1440, 'mins': 1. / 1440, 'min': 1. / 1440,
+    'seconds': 1. / 86400, 'second': 1. / 86400, 'secs': 1. / 86400, 'sec': 1. / 86400, 's': 1. / 86400,
+}
+
+# Guards against time values a hair below a day boundary after unit conversion
+_EPSILON_DAYS = 1e-6 / 86400
+
+_time_index_cache = OrderedDict()
+TIME_INDEX_CACHE_SIZE = 32
+
+
+class TimeIndex(object):
+    """Calendar aware year and month of every step of a time axis.
+
+    Period slices are computed once per frequency and cached on the instance.
+
+    Attributes:
+        units (str): CF time units. eg: 'days since 1850-01-01'
+        calendar (str): CF calendar name. eg: '365_day'
+        years (numpy.ndarray): Year of each time step.
+        months (numpy.ndarray): Month (1-12) of each time step.
+    """
+
+    def __init__(self, values, units, calendar):
+        """Initializes a ``TimeIndex``
+
+        Args:
+            values (array_like): Time coordinate values.
+            units (str): CF time units.
+            calendar (str): CF calendar name.
+        """
+        self.units = units
+        self.calendar = calendar
+        self.years, self.months = get_years_and_months(np.asarray(values), units, calendar)
+        self._slices = {}
+
+    def __len__(self):
+        return len(self.years)
+
+    def keys(self, freq):
+        """Returns an integer key per time step that is constant within each period of `freq`.
+
+        Seasons are labelled by the year they end in (December belongs to the following DJF)
+        and water years (October to September) by the year they end in.
+        """
+        if freq == 'monthly':
+            return self.years * 12 + self.months - 1
+        elif freq == 'seasonal':
+            return (self.years + (self.months == 12)) * 4 + (self.months % 12) // 3
+        elif freq == 'annual':
+            return self.years
+        elif freq == 'water_year':
+            return self.years + (self.months >= 10)
+        raise ValueError('Unknown frequency {}. Expected one of {}'.format(freq, FREQUENCIES))
+
+    def slices(self, freq):
+        """Returns a list of slices covering each consecutive period of `freq`.
+        """
+        if freq not in self._slices:
+            self._slices[freq] = get_run_slices(self.keys(freq))
+        return list(self._slices[freq])
+
+    def monthly_slices(self):
+        return self.slices('monthly')
+
+    def seasonal_slices(self):
+        return self.slices('seasonal')
+
+    def annual_slices(self):
+        return self.slices('annual')
+
+    def water_year_slices(self):
+        return self.slices('water_year')
+
+
+def get_run_slices(keys):
+    '''
+    Returns slices for each run of equal consecutive values in `keys`
+    '''
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return []
+    boundaries = (np.flatnonzero(keys[1:] != keys[:-1]) + 1).tolist()
+    starts = [0] + boundaries
+    stops = boundaries + [len(keys)]
+    return [slice(start, stop) for start, stop in zip(starts, stops)]
+
+
+def parse_units(units):
+    '''
+    Splits CF time units into the length of one unit in days and the reference date string
+    '''
+    try:
+        unit, ref = [x.strip() for x in units.split(' since ', 1)]
+        return UNIT_DAYS[unit.lower()], ref
+    except (ValueError, KeyError):
+        raise ValueError('Unable to interpret time units {}'.format(units))
+
+
+def get_years_and_months(values, units, calendar):
+    '''
+    Returns arrays of the year and month of each time value
+    '''
+    calendar = calendar.lower()
+    if len(values) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    scale, _ = parse_units(units)
+    ref = num2date(0, units, calendar)
+
+    if calendar in FIXED_CALENDAR_DAYS_PER_MONTH:
+        return _fixed_calendar_years_and_months(values, scale, ref, FIXED_CALENDAR_DAYS_PER_MONTH[calendar])
+
+    if calendar in GREGORIAN_CALENDARS and ref.year >= 1 and (calendar == 'proleptic_gregorian' or
+            ((ref.year, ref.month, ref.day) >= (1582, 10, 15) and np.min(values) >= 0)):
+        return _gregorian_years_and_months(values, scale, ref)
+
+    log.debug('No vectorized date path for calendar {}, using num2date'.format(calendar))
+    dates = num2date(values, units, calendar)
+    years = np.fromiter((d.year for d in dates), dtype=int, count=len(dates))
+    months = np.fromiter((d.month for d in dates), dtype=int, count=len(dates))
+    return years, months
+
+
+def _day_fraction(d):
+    return (d.hour * 3600 + d.minute * 60 + d.second + d.microsecond / 1e6) / 86400.
+
+
+def _fixed_calendar_years_and_months(values, scale, ref, days_per_month):
+    year_length = sum(days_per_month)
+    month_start = np.cumsum([0] + days_per_month[:-1])
+    month_of_day = np.repeat(np.arange(1, 13), days_per_month)
+
+    ref_days = ref.year * year_length + month_start[ref.month - 1] + ref.day - 1 + _day_fraction(ref)
+    days = np.floor(ref_days + values * scale + _EPSILON_DAYS).astype('int64')
+
+    years, day_of_year = np.divmod(days, year_length)
+    return years, month_of_day[day_of_year]
+
+
+def _gregorian_years_and_months(values, scale, ref):
+    ref = np.datetime64('{:04d}-{:02d}-{:02d}'.format(ref.year, ref.month, ref.day), 'us') + \
+        np.timedelta64(int(round(_day_fraction(ref) * 86400e6)), 'us')
+    dates = ref + np.round(values * scale * 86400e6).astype('int64').astype('timedelta64[us]')
+
+    months = dates.astype('datetime64[M]').astype('int64')
+    return months // 12 + 1970, months % 12 + 1
+
+
+def get_time_index(ncvar_time):
+    '''
+    Returns a cached TimeIndex for a NetCDF4 time variable
+
+    Indexes are cached by units, calendar and a digest of the time values.
+    '''
+    assert 'calendar' in ncvar_time.ncattrs(), "Time variable does not have a defined calendar"
+    assert 'units' in ncvar_time.ncattrs(), "Time variable must have 'unit' attribute"
+    assert len(ncvar_time.dimensions) == 1, "Time varaible must be single dimension"
+
+    values = np.ma.getdata(ncvar_time[:])
+    key = (ncvar_time.units, ncvar_time.calendar, values.dtype.str, hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest())
+
+    if key in _time_index_cache:
+        _time_index_cache[key] = _time_index_cache.pop(key)
+    else:
+        _time_index_cache[key] = TimeIndex(values, ncvar_time.units, ncvar_time.calendar)
+        while len(_time_index_cache) > TIME_INDEX_CACHE_SIZE:
+            _time_index_cache.popitem(last=False)
+
+    return _time_index_cache[key]
@@ -1,11 +1,75 @@
 import os
+import logging
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 from netCDF4 import Dataset
 
 from cfmeta import Cmip5File
-from pyclimate.nchelpers import nc_copy_atts, nc_copy_var
+from pyclimate.aggregate import TimeAggregator
+from pyclimate.alignment import align_base_variables, group_by_shared_time_steps, open_time_subset
+from pyclimate.buffers import BufferPool
+from pyclimate.concat import is_concatenation, open_base_dataset
+from pyclimate.handles import release_dataset
+from pyclimate.region import SubsetVariable, nc_create_subset_dims
+from pyclimate.manifest import is_up_to_date, remove_manifest, write_manifest
+from pyclimate.metrics import Metrics
+from pyclimate.nchelpers import nc_copy_atts, nc_copy_var, nc_create_aggregated_time, get_time_block_size, iter_time_blocks
+from pyclimate.pipeline import run_pipeline
+from pyclimate.reader import open_variable
+from pyclimate.staging import stage_files
+from pyclimate.tiling import BLOCKS_HELD, iter_tiled_blocks
+from pyclimate.timeindex import get_time_index
+from pyclimate.writer import WRITER_QUEUE_SIZE, WriterProcess
+
+log = logging.getLogger(__name__)
+
+# Default memory budget for the data held in memory for one block of time steps
+DEFAULT_MAX_BLOCK_MB = 128
+
+# Temporal aggregations and the DRS frequency of their outputs
+AGGREGATE_FREQUENCIES = {
+    'monthly': 'mon',
+    'seasonal': 'sea',
+    'annual': 'yr',
+    'water_year': 'wyr'
+}
+
+# Derived variable classes by variable name. See ``register``
+DERIVED_VARIABLES = OrderedDict()
+
+
+def register(cls):
+    """Class decorator adding a ``DerivedVariable`` subclass to the registry.
+
+    Once registered, the variable can be requested by name and used as an input of
+    other derived variables.
+    """
+    DERIVED_VARIABLES[cls.variable_name] = cls
+    return cls
+
+
+def get_required_vars(inputs, _visiting=()):
+    """Resolves inputs through registered derived variables down to base variables.
+
+    Args:
+        inputs (list): Names of base or registered derived variables.
+
+    Returns:
+        list: Names of the base variables needed to compute all of the inputs, in order of first use.
+
+    Raises:
+        ValueError: If derived variables depend on each other in a cycle.
+    """
+    required = []
+    for x in inputs:
+        if x in _visiting:
+            raise ValueError('Cyclic dependency of derived variable {}'.format(x))
+        resolved = get_required_vars(DERIVED_VARIABLES[x].inputs, _visiting + (x,)) if x in DERIVED_VARIABLES else [x]
+        required.extend(y for y in resolved if y not in required)
+    return required
+
 
 class DerivableBase(object):
     """Reprents a group of base variables.
@@ -60,12 +124,13 @@ class DerivableBase(object):
         """
         self.variables[variable] = dataset_fp
 
-    def derive_variable(self, variable, outdir):
+    def derive_variable(self, variable, outdir, **kwargs):
         """Entry point to calculate derived variables from a ``DerivableBase`` class.
 
         Args:
             variable (str): Short name of the variable to generate.
             outdir (str): Root directory to place output file.
+            **kwargs: Options passed on to the ``DerivedVariable``. eg: ``max_block_mb``
 
         Returns:
             A variable specific subclass of DerivableBase.
@@ -73,36 +138,69 @@ class DerivableBase(object):
         Raises:
             None.
         """
-        if variable == 'tas':
-            v = tas(self.variables, outdir)
-        elif variable == 'gdd':
-            v = gdd(self.variables, outdir)
-        elif variable == 'hdd':
-            v = hdd(self.variables, outdir)
-        elif variable == 'ffd':
-            v = ffd(self.variables, outdir)
-        elif variable == 'pas':
-            v = pas(self.variables, outdir)
-        else:
+        return get_derived_variable(variable, self.variables, outdir, **kwargs)
+
+    def derive_variables(self, variables, outdir, **kwargs):
+        """Entry point to calculate several derived variables in a single pass.
+
+        Each base variable is read once per block of time steps and shared by all
+        of the requested derived variables.
+
+        Args:
+            variables (list): Short names of the variables to generate.
+            outdir (str): Root directory to place output files.
+            **kwargs: Options passed on to each ``DerivedVariable``.
+
+        Returns:
+            A ``DerivedVariableSet`` of the known variables, or None if none are known.
+        """
+        derived = [self.derive_variable(variable, outdir, **kwargs) for variable in variables]
+        derived = [v for v in derived if v is not None]
+        if not derived:
             return None
-        return v
+        return DerivedVariableSet(derived)
 
 
-def get_output_file_path_from_base(base_fp, new_varname, outdir=None):
+def get_derived_variable(variable, base_variables, outdir, **kwargs):
+    """Creates the ``DerivedVariable`` for a variable name.
+
+    Args:
+        variable (str): Short name of the variable to generate.
+        base_variables (dict): Dictionary mapping base variable name to file location.
+        outdir (str): Root directory to place output file.
+        **kwargs: Options passed on to the ``DerivedVariable``.
+
+    Returns:
+        A variable specific subclass of DerivedVariable, or None for an unknown variable.
+    """
+    cls = DERIVED_VARIABLES.get(variable)
+    if cls is None:
+        return None
+    return cls(base_variables, outdir, **kwargs)
+
+
+def get_output_file_path_from_base(base_fp, new_varname, outdir=None, **kwargs):
     """Generates a new file path from an existing template using a different variable
 
     Args:
-        base_fp (str): base filename to use as template
+        base_fp (str): base filename to use as template, or a list of temporal pieces. The
+            temporal subset of a list spans all of its pieces.
         new_varname (str): new variable name
+        **kwargs: Any other ``Cmip5File`` attributes to replace. eg: ``frequency``
 
     Returns:
         str: the new filename
     """
+    if is_concatenation(base_fp):
+        cfs = [Cmip5File(datanode_fp = fp) for fp in base_fp]
+        kwargs.setdefault('temporal_subset', '{}-{}'.format(min(x.t_start for x in cfs), max(x.t_end for x in cfs)))
+        base_fp = base_fp[0]
     cf = Cmip5File(datanode_fp = base_fp)
-    cf.update(variable_name = new_varname)
+    cf.update(variable_name = new_varname, **kwargs)
     return os.path.join(outdir, cf.datanode_fp)
 
-def get_output_netcdf_from_base(base_nc, base_varname, new_varname, new_atts, outfp):
+def get_output_netcdf_from_base(base_nc, base_varname, new_varname, new_atts, outfp, time_slices=None, output_policy=None, window=None,
+                                max_time_chunk=None):
     """Prepares a blank NetCDF file for a new variable
 
     Copies structure and attributes of an existing NetCDF into a new NetCDF
@@ -114,6 +212,14 @@ def get_output_netcdf_from_base(base_nc, base_varname, new_varname, new_atts, ou
         new_varname (str): New variable name.
         new_atts (dict): Attributes to assign to the new variable.
         out_fp (str): Location to create the new netCDF4.Dataset
+        time_slices (list): Optional slices of the base time axis. When supplied the new
+            variable gets one time step per slice instead of the base time axis.
+        output_policy (OutputPolicy): Optional compression, chunking and storage type of the
+            new variable. Library defaults and the base variable's type are used if None.
+        window (RegionWindow): Optional cells of the base grid the new variable covers. See
+            ``pyclimate.region``.
+        max_time_chunk (int): Optional number of time steps of the new variable written at once.
+            See ``OutputPolicy.get_chunksizes``.
 
     Returns:
         netCDF4.Dataset: The new netCDF4.Dataset
@@ -124,50 +230,260 @@ def get_output_netcdf_from_base(base_nc, base_varname, new_varname, new_atts, ou
         os.makedirs(os.path.dirname(outfp))
 
     new_nc = Dataset(outfp, 'w')
-    ncvar = nc_copy_var(base_nc, new_nc, base_varname, new_varname)
+    if time_slices is not None:
+        nc_create_aggregated_time(base_nc, new_nc, time_slices)
+    if window is not None:
+        nc_create_subset_dims(base_nc, new_nc, base_varname, window)
+    create_kwargs = {}
+    if output_policy:
+        shape = list(base_nc.variables[base_varname].shape)
+        if time_slices is not None:
+            shape[0] = len(time_slices)
+        if window is not None:
+            shape = list(window.get_shape(shape))
+        create_kwargs = output_policy.get_create_kwargs(new_varname, base_nc.variables[base_varname], shape, max_time_chunk)
+
+    ncvar = nc_copy_var(base_nc, new_nc, base_varname, new_varname, **create_kwargs)
     nc_copy_atts(base_nc, new_nc) #copy global atts
     for k, v in new_atts.items():
         setattr(ncvar, k, v)
+    if output_policy:
+        output_policy.apply_packing(new_varname, ncvar)
 
     return new_nc
 
 
+class DerivationBlock(dict):
+    """Data for a block of time steps.
+
+    Maps base variable names to the data read for the block and derived variable
+    names to their results, as they are computed by a ``DerivationPlan``.
+    """
+    pass
+
+
+class DerivationPlan(object):
+    """Dependency graph of a set of derived variables.
+
+    Every derived variable the set depends on (eg: ``tas`` for ``gdd`` and ``hdd``) is
+    computed once per block, before anything using it, and shared in memory. Data no
+    longer needed by the rest of the block is released as soon as possible.
+
+    Values and masks are handled separately: variables with a ``compute_into`` kernel write
+    into arrays of ``buffers``, which are reused from block to block, and the mask of each
+    result is the union of the masks of its inputs.
+
+    Attributes:
+        derived_variables (list): ``DerivedVariable`` instances to compute.
+        nodes (OrderedDict): Every derived variable to compute per block, requested or
+            intermediate, by name and in dependency order.
+        base_vars (list): Names of the base variables read.
+        buffers (BufferPool): Arrays the results and their masks are computed into.
+    """
+
+    def __init__(self, derived_variables, nbuffers=1):
+        """Initializes a ``DerivationPlan``
+
+        Args:
+            derived_variables (list): ``DerivedVariable`` instances sharing the same base variables.
+            nbuffers (int): Number of blocks whose results can be in use at once. Results of a
+                block are overwritten ``nbuffers`` blocks later.
+
+        Raises:
+            ValueError: If derived variables depend on each other in a cycle.
+        """
+        self.derived_variables = derived_variables
+        self.nodes = OrderedDict()
+        self.buffers = BufferPool(nbuffers)
+
+        requested = dict((v.variable_name, v) for v in derived_variables)
+        template = derived_variables[0]
+
+        def visit(name, visiting):
+            if name in self.nodes:
+                return
+            if name in visiting:
+                raise ValueError('Cyclic dependency of derived variable {}'.format(name))
+            node = requested.get(name) or DERIVED_VARIABLES[name](template.base_variables, template.outdir)
+            for x in node.inputs:
+                if x in requested or x in DERIVED_VARIABLES:
+                    visit(x, visiting + (name,))
+            self.nodes[name] = node
+
+        for v in derived_variables:
+            visit(v.variable_name, ())
+
+        self.base_vars = sorted(set(x for node in self.nodes.values() for x in node.inputs if x not in self.nodes))
+
+        # Position of the last node using each input, after which it can be released
+        self._last_use = {}
+        for i, node in enumerate(self.nodes.values()):
+            for x in node.inputs:
+                self._last_use[x] = i
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def evaluate(self, data, masks=None):
+        """Computes every derived variable for a block of time steps.
+
+        Args:
+            data (dict): Base variable name to data for the block. Masked arrays are split
+                into their data and mask if `masks` is None.
+            masks (dict): Base variable name to a boolean array of its masked values, or
+                None where nothing is masked.
+
+        Returns:
+            list: Result of each of ``derived_variables``, as masked arrays.
+        """
+        if masks is None:
+            masks = dict((x, np.ma.getmaskarray(v) if np.ma.is_masked(v) else None) for x, v in data.items())
+            data = dict((x, np.ma.getdata(v)) for x, v in data.items())
+        block = DerivationBlock(data)
+        masks = dict(masks)
+        keep = set(v.variable_name for v in self.derived_variables)
+        for i, (name, node) in enumerate(self.nodes.items()):
+            if node.has_kernel:
+                out = self.buffers.get(name, node.result_shape(block), node.result_dtype(block))
+                node.compute_into(block, out)
+                masks[name] = self._merge_masks(name, [masks[x] for x in node.inputs], out.shape)
+            else:
+                result = node.compute(DerivationBlock((x, self._masked(block[x], masks[x])) for x in node.inputs))
+                out = np.ma.getdata(result)
+                mask = np.ma.getmaskarray(result) if np.ma.is_masked(result) else None
+                masks[name] = self._merge_masks(name, [masks[x] for x in node.inputs] + [mask], out.shape)
+            block[name] = out
+            for x in node.inputs:
+                if self._last_use[x] == i and x not in keep:
+                    del block[x], masks[x]
+        return [self._masked(block[v.variable_name], masks[v.variable_name]) for v in self.derived_variables]
+
+    def _merge_masks(self, name, masks, shape):
+        masks = [m for m in masks if m is not None]
+        if not masks:
+            return None
+        if len(masks) == 1 and masks[0].shape == shape:
+            return masks[0]
+        merged = self.buffers.get(name + '.mask', shape, bool)
+        merged[...] = masks[0]
+        for m in masks[1:]:
+            np.logical_or(merged, m, out=merged)
+        return merged
+
+    @staticmethod
+    def _masked(data, mask):
+        return np.ma.masked_array(data, mask=np.ma.nomask if mask is None else mask, copy=False)
+
+
 class DerivedVariable(object):
     """Used as a parent for all derived variables.
 
     Stores variable specific information and provides common methods.
     
     Attributes:
-        base_variables (dict): Dictionary mapping base variable name to file location.
+        base_variables (dict): Dictionary mapping base variable name to file location, or to
+            a list of the files of its temporal pieces (see ``pyclimate.concat``).
             eg: {'pr': 'path/to/pr/variable.nc',
-                 'tasmax': 'path/to/tasmax/variable.nc'}
+                 'tasmax': ['path/to/tasmax/variable_2006-2015.nc', 'path/to/tasmax/variable_2016-2025.nc']}
         outdir (str): Location to put the generated NetCDF.
         variable_name (str): Derived variable name.
-        required_vars (list): List of variables required by the specific derived variable
+        inputs (list): Base or registered derived variables the kernel reads from its block.
+        required_vars (list): List of base variables required by the specific derived variable
         variable_atts (dict): Attributes to set on the derived variable
+        max_block_mb (float): Memory budget in MB used to choose how many time steps
+            are read, computed and written per block.
+        aggregate (str): Optional temporal aggregation of the output. One of
+            ``AGGREGATE_FREQUENCIES``. Time steps are combined with ``cell_method``.
+        cell_method (str): How time steps are combined when aggregating. 'sum' or 'mean'.
+        threshold (float): Temperature threshold (K) used by the derivation, if any.
+        output_policy (OutputPolicy): Optional compression, chunking and storage type of the output.
+        region (Region): Optional area to derive the variable over instead of the whole grid.
     """
-
-    def __init__(self, base_variables, outdir, variable_name, required_vars, variable_atts):
+    variable_name = None
+    inputs = []
+    variable_atts = {}
+    cell_method = 'sum'
+    threshold = None
+
+    def __init__(self, base_variables, outdir, variable_name=None, required_vars=None, variable_atts=None, max_block_mb=DEFAULT_MAX_BLOCK_MB,
+                 aggregate=None, output_policy=None, region=None):
         """Initializes a ``DerivedVariable`` class
 
         Args:
-            Same as ``Attributes``
+            Same as ``Attributes``. ``variable_name`` and ``variable_atts`` default to those
+            of the class and ``required_vars`` to the base variables its ``inputs`` resolve to.
 
         """
         self.base_variables = base_variables
         self.outdir = outdir
-        self.variable_name = variable_name
-        self.required_vars = required_vars
-        self.variable_atts = variable_atts
+        self.variable_name = variable_name or self.variable_name
+        self.required_vars = required_vars or get_required_vars(self.inputs)
+        self.variable_atts = variable_atts or self.variable_atts
+        self.max_block_mb = max_block_mb
+        if aggregate and aggregate not in AGGREGATE_FREQUENCIES:
+            raise ValueError('Unknown aggregation {}. Expected one of {}'.format(aggregate, sorted(AGGREGATE_FREQUENCIES)))
+        self.aggregate = aggregate
+        self.output_policy = output_policy
+        self.region = region
+
+        packed_range = output_policy.get_packed_range(self.variable_name) if output_policy else None
+        if packed_range and aggregate and self.cell_method == 'sum':
+            warnings.warn('{} is packed to values within [{:g}, {:g}], which {} totals may exceed. Choose a scale_factor '
+                          'for the totals, or an unpacked storage type'.format(self.variable_name, packed_range[0], packed_range[1], aggregate))
 
     def __call__(self):
-        """__call__ method should be overridden by a child class
+        """Generates the derived variable.
+
+        Returns:
+            str: Location of the generated NetCDF, or 1 if base variables are missing.
         """
-        raise NotImplemented
+        return DerivedVariableSet([self])()[0]
 
     def __str__(self):
         return 'Generating {} with base variables {}'.format(type(self).__name__, self.base_variables.keys())
 
+    def compute(self, block):
+        """Calculates the derived variable for a block of time steps.
+
+        Child classes should override ``compute_into``, or this method if they can not
+        compute in place. Overrides of this method receive masked arrays.
+
+        Args:
+            block (DerivationBlock): Data of the ``inputs`` for the block.
+
+        Returns:
+            numpy.ndarray: The derived variable for the block.
+        """
+        out = np.empty(self.result_shape(block), self.result_dtype(block))
+        self.compute_into(block, out)
+        return out
+
+    def compute_into(self, block, out):
+        """Calculates the derived variable for a block of time steps into an existing array.
+
+        Should be overridden by a child class, with in place ufuncs (``out=``) so that no
+        temporary arrays are allocated. Inputs are plain arrays, with any values that are
+        masked left as they were read. Masks are handled by the ``DerivationPlan``.
+
+        Args:
+            block (DerivationBlock): Data of the ``inputs`` for the block.
+            out (numpy.ndarray): Array of ``result_shape`` and ``result_dtype`` to fill.
+        """
+        raise NotImplementedError
+
+    @property
+    def has_kernel(self):
+        return type(self).compute_into is not DerivedVariable.compute_into
+
+    def result_shape(self, block):
+        return np.broadcast_shapes(*(np.shape(block[x]) for x in self.inputs))
+
+    def result_dtype(self, block):
+        """Type of the result. At least double precision, as thresholds of around 280 K
+        subtracted from temperatures lose most of their digits in single precision.
+        """
+        return np.result_type(np.float64, *(block[x].dtype for x in self.inputs))
+
     @property
     def base_varname(self):
         """Used to set which base variable to use as a template.
@@ -178,7 +494,33 @@ class DerivedVariable(object):
     def outfp(self): 
         """Generates a string
         """
-        return get_output_file_path_from_base(self.base_variables[self.base_varname], self.variable_name, self.outdir)
+        atts = {'frequency': AGGREGATE_FREQUENCIES[self.aggregate]} if self.aggregate else {}
+        return get_output_file_path_from_base(self.base_variables[self.base_varname], self.variable_name, self.outdir, **atts)
+
+    @property
+    def parameters(self):
+        """Everything other than the base variables that determines the output. Recorded in its manifest.
+        """
+        return {
+            'derivation': type(self).__name__,
+            'variable_name': self.variable_name,
+            'required_vars': list(self.required_vars),
+            'variable_atts': self.variable_atts,
+            'threshold': self.threshold,
+            'aggregate': self.aggregate,
+            'cell_method': self.cell_method,
+            'output_policy': self.output_policy.as_dict() if self.output_policy else None,
+            'region': self.region.as_dict() if self.region else None
+        }
+
+    @property
+    def output_atts(self):
+        """Attributes to set on the output variable.
+        """
+        atts = dict(self.variable_atts)
+        if self.aggregate:
+            atts['cell_methods'] = 'time: {}'.format(self.cell_method)
+        return atts
 
     def has_required_vars(self, required_vars):
         if not all([x in self.base_variables.keys() for x in required_vars]):
@@ -187,9 +529,272 @@ class DerivedVariable(object):
         return True
 
 
+class DerivedVariableSet(object):
+    """Generates several derived variables from the same base variables in a single pass.
+
+    Every required base variable is opened and read once per block of time steps, and
+    the data is shared by all of the derived variables in the set. Each output covers the
+    time steps its own base variables share, and outputs over different periods are derived
+    in separate passes. The number of time steps per block is chosen from the smallest
+    ``max_block_mb`` of the set and the grid size. The budget covers every block held at
+    once, so it is split between the blocks queued when pipelined or in flight when tiled.
+
+    In incremental mode, variables whose output still matches its manifest are skipped
+    before any file is opened, and a manifest is written for every generated output.
+
+    Attributes:
+        derived_variables (list): ``DerivedVariable`` instances sharing the same base variables.
+        incremental (bool): Skip up to date outputs and record manifests of generated ones.
+        digest (bool): Record content digests of the inputs, and accept inputs whose mtime
+            changed if their contents did not.
+        pipeline_depth (int): With 0, blocks are read, computed and written one after the other.
+            Otherwise reading runs in a thread and writing in a process of their own (see
+            ``pyclimate.writer``), overlapping with each other and with computing, with up to
+            this many blocks queued between stages.
+        tiles (tuple): Number of tiles to split the (lat, lon) grid into along each dimension.
+            Tiles are read and derived by a pool of worker processes and the blocks are
+            reassembled and written by the calling process. None derives whole blocks.
+        processes (int): Size of the pool deriving tiles. Defaults to one per tile, up to the
+            number of CPUs.
+        reader (str): How base variables are read. One of ``pyclimate.reader.BACKENDS``. With
+            'auto', NetCDF3 inputs are memory mapped and anything else is read with netCDF4.
+        staging (StagingCache): Optional cache base variables are copied to and read from.
+            Outputs and manifests still refer to the original files.
+        metrics (Metrics): Phase times and bytes moved by the last call.
+    """
+
+    def __init__(self, derived_variables, incremental=False, digest=False, pipeline_depth=0, tiles=None, processes=None,
+                 reader='auto', staging=None):
+        """Initializes a ``DerivedVariableSet`` class
+
+        Args:
+            Same as ``Attributes``
+
+        Raises:
+            ValueError: If the derived variables are not all over the same region.
+        """
+        if len(set(repr(v.region) for v in derived_variables)) > 1:
+            raise ValueError('Derived variables of a set must share their region')
+        self.derived_variables = derived_variables
+        self.incremental = incremental
+        self.digest = digest
+        self.pipeline_depth = pipeline_depth
+        self.tiles = tiles
+        self.processes = processes
+        self.reader = reader
+        self.staging = staging
+        self.metrics = Metrics()
+
+    def __str__(self):
+        return 'Generating {} with base variables {}'.format(
+            ', '.join(type(v).__name__ for v in self.derived_variables),
+            self.base_variables.keys()
+        )
+
+    @property
+    def base_variables(self):
+        return self.derived_variables[0].base_variables
+
+    @property
+    def max_block_mb(self):
+        return min(v.max_block_mb for v in self.derived_variables)
+
+    @property
+    def region(self):
+        return self.derived_variables[0].region
+
+    def __call__(self):
+        """Generates all derived variables in the set.
+
+        Time spent in each phase and bytes moved are recorded in ``metrics``. When tiled,
+        reading happens in the workers and is counted as 'compute'.
+
+        Returns:
+            list: Location of each generated NetCDF, or 1 for any derived variable
+                with missing base variables. Ordered as ``derived_variables``.
+        """
+        self.metrics = metrics = Metrics()
+        derivable = [v for v in self.derived_variables if v.has_required_vars(v.required_vars)]
+        if self.incremental:
+            up_to_date = [v for v in derivable if is_up_to_date(v, self.digest)]
+            for v in up_to_date:
+                log.info('Skipping up to date {}'.format(v.outfp))
+            derivable = [v for v in derivable if v not in up_to_date]
+        else:
+            up_to_date = []
+        if not derivable:
+            return [v.outfp if v in up_to_date else 1 for v in self.derived_variables]
+
+        with metrics.phase('open'):
+            # Results may be in use until written, by which time the next pipeline_depth + 1 blocks may be computed
+            plan = DerivationPlan(derivable, self.pipeline_depth + 2 if self.pipeline_depth else 1)
+            required_vars = plan.base_vars
+            # Where each base variable is read from. Staging counts as opening
+            sources = dict((x, stage_files(self.staging, self.base_variables[x])) for x in required_vars)
+            nc_bases = {x: open_base_dataset(sources[x], x) for x in required_vars}
+
+            # Each output covers the time steps its own base variables share. Outputs over
+            # different periods are derived in separate passes
+            try:
+                groups = group_by_shared_time_steps(nc_bases, [v.required_vars for v in derivable])
+                alignment = align_base_variables(nc_bases) if len(groups) == 1 else None
+            except Exception:
+                for nc in nc_bases.values():
+                    release_dataset(nc)
+                raise
+            if alignment is None:
+                for nc in nc_bases.values():
+                    release_dataset(nc)
+
+        if alignment is None:
+            for group in groups:
+                subset = DerivedVariableSet([derivable[i] for i in group], self.incremental, self.digest, self.pipeline_depth, self.tiles,
+                                            self.processes, self.reader, self.staging)
+                log.info('Deriving {} apart, over the time steps shared by their base variables'.format(
+                    ', '.join(v.variable_name for v in subset.derived_variables)))
+                subset()
+                metrics.merge(subset.metrics)
+            return [v.outfp if v in derivable or v in up_to_date else 1 for v in self.derived_variables]
+
+        with metrics.phase('open'):
+            if not alignment.is_identity:
+                for x in required_vars:
+                    nc = nc_bases[x]
+                    nc_bases[x] = open_time_subset(nc, x, alignment.get_slice(x))
+                    release_dataset(nc)
+
+            # The region is resolved once on the grid the base variables share
+            try:
+                window = self.region.get_window(nc_bases[required_vars[0]], required_vars[0]) if self.region else None
+            except Exception:
+                for nc in nc_bases.values():
+                    release_dataset(nc)
+                raise
+
+            # Base variables, the result of every node of the plan, and a temporary per output
+            ncvar_template = nc_bases[required_vars[0]].variables[required_vars[0]]
+            if window is not None:
+                ncvar_template = SubsetVariable(ncvar_template, window)
+            arrays_per_step = len(required_vars) + len(plan) + len(derivable)
+            if self.tiles:
+                max_block_mb = self.max_block_mb / BLOCKS_HELD
+            elif self.pipeline_depth:
+                # Up to pipeline_depth blocks wait in each queue, and one more is held by each stage. The
+                # writer process holds the results of up to WRITER_QUEUE_SIZE + 1 more
+                max_block_mb = self.max_block_mb / (self.pipeline_depth + 2 + WRITER_QUEUE_SIZE)
+            else:
+                max_block_mb = self.max_block_mb
+            block_size = get_time_block_size(ncvar_template, max_block_mb, arrays_per_step)
+            nsteps = ncvar_template.shape[0]
+            shape = ncvar_template.shape
+
+            nc_outs = []
+            writers = []
+            outputs = []
+            for v in derivable:
+                remove_manifest(v.outfp)
+                nc_base = nc_bases[v.base_varname]
+                time_slices = get_time_index(nc_base.variables['time']).slices(v.aggregate) if v.aggregate else None
+                # Output time steps written per block
+                max_time_chunk = max(1, block_size * len(time_slices) // max(nsteps, 1)) if v.aggregate else block_size
+                nc_out = get_output_netcdf_from_base(nc_base, v.base_varname, v.variable_name, v.output_atts, v.outfp, time_slices,
+                                                     v.output_policy, window, max_time_chunk)
+                ncvar_out = nc_out.variables[v.variable_name]
+                nc_outs.append(nc_out)
+                writers.append(TimeAggregator(time_slices, ncvar_out, v.cell_method) if v.aggregate else ncvar_out)
+                outputs.append((v.outfp, v.variable_name, time_slices, v.cell_method))
+
+        step_bytes = int(np.prod(shape[1:])) * sum(nc_bases[x].variables[x].dtype.itemsize for x in required_vars)
+
+        # The reader reopens the base variables so each handle is only used by one thread. Pooled
+        # handles are given back here and reused by the reader
+        with metrics.phase('close'):
+            for nc in nc_bases.values():
+                release_dataset(nc)
+
+        # Masks of base variables can be passed through to results, so one may be in use from
+        # reading until writing
+        mask_buffers = BufferPool(2 * self.pipeline_depth + 3 if self.pipeline_depth else 1)
+
+        def read_blocks():
+            with metrics.phase('open'):
+                variables = dict((x, open_variable(sources[x], x, self.reader)) for x in required_vars)
+                if window is not None:
+                    variables = dict((x, SubsetVariable(variable, window)) for x, variable in variables.items())
+            try:
+                for block_slice in iter_time_blocks(nsteps, block_size):
+                    with metrics.phase('read'):
+                        data, masks = {}, {}
+                        for x, variable in variables.items():
+                            data[x], masks[x] = variable.read(alignment.get_slice(x, block_slice), mask_buffers)
+                    metrics.add(bytes_read=sum(x.nbytes for x in data.values()))
+                    yield block_slice, data, masks
+            finally:
+                with metrics.phase('close'):
+                    for variable in variables.values():
+                        variable.close()
+
+        def compute_block(item):
+            block_slice, data, masks = item
+            with metrics.phase('compute'):
+                return block_slice, plan.evaluate(data, masks)
+
+        def write_block(item):
+            block_slice, results = item
+            with metrics.phase('write'):
+                for v, writer, result in zip(derivable, writers, results):
+                    if v.aggregate:
+                        writer.add(block_slice, result)
+                    else:
+                        writer[block_slice] = result
+            metrics.add(bytes_written=sum(np.asarray(x).nbytes for x in results), blocks=1)
+
+        try:
+            if self.tiles:
+                # Workers compute the next blocks while the parent writes
+                tiled_blocks = iter_tiled_blocks(derivable, nsteps, block_size, shape, self.tiles, self.processes, self.reader, alignment, sources, window)
+                while True:
+                    with metrics.phase('compute'):
+                        item = next(tiled_blocks, None)
+                    if item is None:
+                        break
+                    metrics.add(bytes_read=step_bytes * (item[0].stop - item[0].start))
+                    write_block(item)
+            elif self.pipeline_depth:
+                # Outputs are written by a process of its own, as the netCDF library can not
+                # write in one thread while reading in another
+                with metrics.phase('close'):
+                    for nc in nc_outs:
+                        nc.close()
+                nc_outs = []
+                writer = WriterProcess(outputs)
+                writer.start()
+                try:
+                    run_pipeline(read_blocks, compute_block, lambda item: writer.write(*item), self.pipeline_depth)
+                    metrics.merge(writer.finish())
+                except BaseException:
+                    writer.abort()
+                    raise
+            else:
+                run_pipeline(read_blocks, compute_block, write_block, 0)
+        finally:
+            with metrics.phase('close'):
+                for nc in nc_outs:
+                    nc.close()
+
+        if self.incremental:
+            with metrics.phase('close'):
+                for v in derivable:
+                    write_manifest(v, self.digest)
+
+        return [v.outfp if v in derivable or v in up_to_date else 1 for v in self.derived_variables]
+
+
+@register
 class tas(DerivedVariable):
     variable_name = 'tas'
-    required_vars = ['tasmax', 'tasmin']
+    cell_method = 'mean'
+    inputs = ['tasmax', 'tasmin']
     variable_atts = {
         'long_name': 'Near-Surface Air Temperature',
         'standard_name': 'air_temperature',
@@ -198,157 +803,65 @@ class tas(DerivedVariable):
         'cell_measures': 'area: areacella'
     }
 
-    def __init__(self, base_variables, outdir):
-        super(tas, self).__init__(base_variables, outdir, self.variable_name, self.required_vars, self.variable_atts)
-
-    def __call__(self):
-        if not self.has_required_vars(self.required_vars):
-            return 1
-
-        nc_tasmax = Dataset(self.base_variables['tasmax'])
-        var_tasmax = nc_tasmax.variables['tasmax']
-
-        nc_tasmin = Dataset(self.base_variables['tasmin'])
-        var_tasmin = nc_tasmin.variables['tasmin']
-
-        nc_out = get_output_netcdf_from_base(nc_tasmax, self.base_varname, self.variable_name, self.variable_atts, self.outfp)
-        ncvar_tas = nc_out.variables[self.variable_name]
-
-        for i in range(var_tasmax.shape[0]):
-            ncvar_tas[i,:,:] = (var_tasmax[i,:,:] + var_tasmin[i,:,:]) / 2
-
-        for nc in [nc_out, nc_tasmax, nc_tasmin]:
-            nc.close()
-
-        return self.outfp
+    def compute_into(self, block, out):
+        np.add(block['tasmax'], block['tasmin'], out=out)
+        np.multiply(out, 0.5, out=out)
 
 
+@register
 class gdd(DerivedVariable):
     variable_name = 'gdd'
-    required_vars = ['tasmax', 'tasmin']
+    threshold = 278.15
+    inputs = ['tas']
     variable_atts = {
         'units': 'degree days',
         'long_name': 'Growing Degree Days'
     }
 
-    def __init__(self, base_variables, outdir):
-        super(gdd, self).__init__(base_variables, outdir, self.variable_name, self.required_vars, self.variable_atts)
-
-    def __call__(self):
-        if not self.has_required_vars(self.required_vars):
-            return 1
-
-        nc_tasmax = Dataset(self.base_variables['tasmax'])
-        var_tasmax = nc_tasmax.variables['tasmax']
-
-        nc_tasmin = Dataset(self.base_variables['tasmin'])
-        var_tasmin = nc_tasmin.variables['tasmin']
-
-        nc_out = get_output_netcdf_from_base(nc_tasmax, self.base_varname, self.variable_name, self.variable_atts, self.outfp)
-        ncvar_gdd = nc_out.variables[self.variable_name]
-
-        for i in range(var_tasmax.shape[0]):
-            tas = (var_tasmax[i,:,:] + var_tasmin[i,:,:]) / 2
-            ncvar_gdd[i,:,:] = np.where(tas > 278.15, (tas - 278.15), 0)
-
-        for nc in [nc_out, nc_tasmax, nc_tasmin]:
-            nc.close()
-
-        return self.outfp
+    def compute_into(self, block, out):
+        np.subtract(block['tas'], self.threshold, out=out)
+        np.fmax(out, 0, out=out)
 
 
+@register
 class hdd(DerivedVariable):
     variable_name = 'hdd'
-    required_vars = ['tasmax', 'tasmin']
+    threshold = 291.15
+    inputs = ['tas']
     variable_atts = {
         'units': 'degree days',
         'long_name': 'Heating Degree Days'
     }
 
-    def __init__(self, base_variables, outdir):
-        super(hdd, self).__init__(base_variables, outdir, self.variable_name, self.required_vars, self.variable_atts)
-
-    def __call__(self):
-        if not self.has_required_vars(self.required_vars):
-            return 1
-
-        nc_tasmax = Dataset(self.base_variables['tasmax'])
-        var_tasmax = nc_tasmax.variables['tasmax']
-
-        nc_tasmin = Dataset(self.base_variables['tasmin'])
-        var_tasmin = nc_tasmin.variables['tasmin']
-
-        nc_out = get_output_netcdf_from_base(nc_tasmax, self.base_varname, self.variable_name, self.variable_atts, self.outfp)
-        ncvar_hdd = nc_out.variables[self.variable_name]
-
-        for i in range(var_tasmax.shape[0]):
-            tas = (var_tasmax[i,:,:] + var_tasmin[i,:,:]) / 2
-            ncvar_hdd[i,:,:] = np.where(tas < 291.15, np.absolute(tas - 291.15), 0)
-
-        for nc in [nc_out, nc_tasmax, nc_tasmin]:
-            nc.close()
-
-        return self.outfp
+    def compute_into(self, block, out):
+        np.subtract(self.threshold, block['tas'], out=out)
+        np.fmax(out, 0, out=out)
 
 
+@register
 class ffd(DerivedVariable):
     variable_name = 'ffd'
-    required_vars = ['tasmin']
+    threshold = 273.15
+    inputs = ['tasmin']
     variable_atts = {
         'units': 'days',
         'long_name': 'Frost Free Days'
     }
 
-    def __init__(self, base_variables, outdir):
-        super(ffd, self).__init__(base_variables, outdir, self.variable_name, self.required_vars, self.variable_atts)
-
-    def __call__(self):
-        if not self.has_required_vars(self.required_vars):
-            return 1
-
-        nc_tasmin = Dataset(self.base_variables['tasmin'])
-        var_tasmin = nc_tasmin.variables['tasmin']
-
-        nc_out = get_output_netcdf_from_base(nc_tasmin, self.base_varname, self.variable_name, self.variable_atts, self.outfp)
-        ncvar_ffd = nc_out.variables[self.variable_name]
-
-        for i in range(var_tasmin.shape[0]):
-            ncvar_ffd[i,:,:] = np.where(var_tasmin[i,:,:] > 273.15, 1, 0)
-
-        for nc in [nc_out, nc_tasmin]:
-            nc.close()
-
-        return self.outfp
+    def compute_into(self, block, out):
+        np.greater(block['tasmin'], self.threshold, out=out)
 
 
+@register
 class pas(DerivedVariable):
     variable_name = 'pas'
-    required_vars = ['tasmax', 'pr']
+    threshold = 273.15
+    inputs = ['tasmax', 'pr']
     variable_atts = {
         'units': 'mm',
         'long_name': 'Precip as snow'
     }
 
-    def __init__(self, base_variables, outdir):
-        super(pas, self).__init__(base_variables, outdir, self.variable_name, self.required_vars, self.variable_atts)
-
-    def __call__(self):
-        if not self.has_required_vars(self.required_vars):
-            return 1
-
-        nc_tasmax = Dataset(self.base_variables['tasmax'])
-        var_tasmax = nc_tasmax.variables['tasmax']
-
-        nc_pr = Dataset(self.base_variables['pr'])
-        var_pr = nc_pr.variables['pr']
-
-        nc_out = get_output_netcdf_from_base(nc_tasmax, self.base_varname, self.variable_name, self.variable_atts, self.outfp)
-        ncvar_pas = nc_out.variables[self.variable_name]
-
-        for i in range(var_tasmax.shape[0]):
-            ncvar_pas[i,:,:] = np.where(var_tasmax[i,:,:] < 273.15, var_pr[i,:,:] , 0)
-
-        for nc in [nc_out, nc_tasmax]:
-            nc.close()
-
-        return self.outfp
+    def compute_into(self, block, out):
+        np.less(block['tasmax'], self.threshold, out=out)
+        np.multiply(out, block['pr'], out=out)
@@ -0,0 +1,164 @@
+import queue
+import pickle
+import logging
+import multiprocessing
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pyclimate.aggregate import TimeAggregator
+from pyclimate.handles import set_chunk_cache
+from pyclimate.metrics import Metrics
+
+log = logging.getLogger(__name__)
+
+'''
+Writing blocks of derived results from a dedicated process.
+
+The netCDF and HDF5 libraries are generally not built thread safe, even for distinct files, so a
+thread writing (and compressing) outputs can not run alongside another reading (and
+decompressing) inputs. A ``WriterProcess`` has libraries of its own: it reopens the outputs
+prepared by the parent and writes the blocks it receives over a bounded queue, while the parent
+reads and computes the next ones.
+'''
+
+# Blocks queued for the writer process, on top of the one it is writing
+WRITER_QUEUE_SIZE = 1
+
+# Seconds between checks that the writer process is alive while waiting on it
+_POLL_SECONDS = 0.1
+
+
+def set_write_chunk_cache(ncvar):
+    '''
+    Sizes the chunk cache of an output variable to one time slab of its chunks
+
+    Outputs are written in order along time, so chunks are complete once the next slab is
+    started. A cache no bigger than a slab has them compressed and written out as the blocks
+    arrive, rather than all at once when the output is closed.
+    '''
+    chunking = ncvar.chunking()
+    if not isinstance(chunking, (list, tuple)):
+        return
+    slab_bytes = chunking[0] * ncvar.dtype.itemsize
+    for n in ncvar.shape[1:]:
+        slab_bytes *= n
+    set_chunk_cache(ncvar, slab_bytes / 1024. / 1024)
+
+
+class WriterFailed(Exception):
+    """Raised when the writer process exited without reporting how it went.
+    """
+    pass
+
+
+class WriterProcess(multiprocessing.Process):
+    """Writes blocks of results to prepared outputs, in order, from a process of its own.
+
+    Attributes:
+        outputs (list): (output path, variable name, time slices or None, aggregation method)
+            per output. With time slices, blocks are aggregated into them (see ``TimeAggregator``).
+    """
+
+    def __init__(self, outputs):
+        """Initializes a ``WriterProcess``
+
+        Args:
+            Same as ``Attributes``
+        """
+        super(WriterProcess, self).__init__(name='writer')
+        self.daemon = True
+        self.outputs = outputs
+        self._blocks = multiprocessing.Queue(WRITER_QUEUE_SIZE)
+        self._outcome = multiprocessing.Queue()
+
+    def run(self):
+        metrics = Metrics()
+        error = None
+        ncs = []
+        try:
+            with metrics.phase('open'):
+                writers = []
+                for outfp, varname, time_slices, method in self.outputs:
+                    nc = Dataset(outfp, 'a')
+                    ncs.append(nc)
+                    ncvar = nc.variables[varname]
+                    set_write_chunk_cache(ncvar)
+                    writers.append(TimeAggregator(time_slices, ncvar, method) if time_slices else ncvar)
+            while True:
+                item = self._blocks.get()
+                if item is None:
+                    break
+                block_slice, results = pickle.loads(item)
+                with metrics.phase('write'):
+                    for writer, result in zip(writers, results):
+                        if isinstance(writer, TimeAggregator):
+                            writer.add(block_slice, result)
+                        else:
+                            writer[block_slice] = result
+                metrics.add(bytes_written=sum(np.asarray(x).nbytes for x in results), blocks=1)
+        except Exception as e:
+            log.debug('Writer process failed', exc_info=True)
+            error = e
+        finally:
+            with metrics.phase('close'):
+                for nc in ncs:
+                    nc.close()
+        self._outcome.put((error, metrics))
+
+    def write(self, block_slice, results):
+        """Queues a block of results, ordered as ``outputs``, waiting while the queue is full.
+
+        The results are copied before returning, so their buffers can be reused.
+
+        Raises:
+            Exception: The error of the writer process, if it failed.
+        """
+        item = pickle.dumps((block_slice, results), pickle.HIGHEST_PROTOCOL)
+        while True:
+            try:
+                self._blocks.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                if not self.is_alive():
+                    self._raise()
+
+    def finish(self):
+        """Waits for every queued block to be written and the outputs closed.
+
+        Returns:
+            Metrics: Time spent and bytes written by the writer process.
+
+        Raises:
+            Exception: The error of the writer process, if it failed.
+        """
+        while self.is_alive():
+            try:
+                self._blocks.put(None, timeout=_POLL_SECONDS)
+                break
+            except queue.Full:
+                pass
+        error, metrics = self._get_outcome()
+        self.join()
+        if error is not None:
+            raise error
+        return metrics
+
+    def abort(self):
+        """Stops the writer process, leaving the outputs incomplete.
+        """
+        if self.is_alive():
+            self.terminate()
+        self.join()
+
+    def _get_outcome(self):
+        while True:
+            try:
+                return self._outcome.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                if not self.is_alive() and self._outcome.empty():
+                    raise WriterFailed('Writer process exited with code {}'.format(self.exitcode))
+
+    def _raise(self):
+        error, metrics = self._get_outcome()
+        raise error or WriterFailed('Writer process stopped before all blocks were written')
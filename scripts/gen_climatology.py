@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+import argparse
+
+from pyclimate.climatology import generate_climatologies, CLIMATOLOGY_FREQUENCIES, CLIMATOLOGY_METHODS, DEFAULT_PERIODS
+from pyclimate.reader import BACKENDS
+from pyclimate.variables import DEFAULT_MAX_BLOCK_MB
+
+log = logging.getLogger(__name__)
+
+def parse_period(s):
+    '''
+    Parses a START-END period argument. eg: 1971-2000
+    '''
+    start, end = s.split('-')
+    return int(start), int(end)
+
+def main(args):
+    failed = 0
+    for fp in args.files:
+        try:
+            outfps = generate_climatologies(fp, args.variable, args.outdir, args.periods, args.freq, args.method, args.std,
+                                            args.max_block_mb, args.reader, args.complevel)
+            for outfp in outfps:
+                log.info('Wrote {}'.format(outfp))
+        except ValueError as e:
+            log.error('Skipping {}: {}'.format(fp, e))
+            failed += 1
+    log.info('{} of {} files succeeded'.format(len(args.files) - failed, len(args.files)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate CF climatologies of daily base or derived variables')
+    parser.add_argument('files', nargs='+', help='Input files, each with a daily record of the variable')
+    parser.add_argument('-o', '--outdir', required=True, help='Output directory')
+    parser.add_argument('-v', '--variable', required=True, help='Variable to summarize. Ex: gdd')
+    parser.add_argument('--periods', nargs='+', default=list(DEFAULT_PERIODS), type=parse_period, metavar='START-END',
+                        help='Periods to summarize. Ex: --periods 1971-2000 2041-2070')
+    parser.add_argument('--freq', default='monthly', choices=sorted(CLIMATOLOGY_FREQUENCIES),
+                        help='Summarize each month or each season')
+    parser.add_argument('--method', default='mean', choices=CLIMATOLOGY_METHODS,
+                        help='Mean of the daily values, or mean over years of the monthly or seasonal totals')
+    parser.add_argument('--std', default=False, action='store_true', help='Also write the standard deviation of the daily values')
+    parser.add_argument('--max-block-mb', default=DEFAULT_MAX_BLOCK_MB, type=float,
+                        help='Memory budget (MB) for each block of time steps read')
+    parser.add_argument('--reader', default='auto', choices=BACKENDS, help='How input files are read')
+    parser.add_argument('--complevel', default=4, type=int, choices=range(10),
+                        help='zlib compression level of the outputs. 0 disables compression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    sys.exit(main(args))
@@ -1,58 +1,124 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
+import json
 import logging
 import argparse
-import multiprocessing
 
 import numpy as np
 from netCDF4 import Dataset
 from cfmeta import Cmip5File
 
-from pyclimate import Consumer
+from pyclimate.catalog import Catalog, DEFAULT_CATALOG_PATH
+from pyclimate.scheduler import Job, Scheduler
 from pyclimate.path import iter_netcdf_files, group_files_by_model_set, iter_matching_cmip5_file
+from pyclimate.metrics import format_summary
+from pyclimate.output import OutputPolicy, CHUNK_LAYOUTS
+from pyclimate.reader import BACKENDS
+from pyclimate.region import Region
+from pyclimate.staging import StagingCache
+from pyclimate.variables import DEFAULT_MAX_BLOCK_MB, AGGREGATE_FREQUENCIES, DERIVED_VARIABLES
 from pyclimate.nchelpers import *
 
 log = logging.getLogger(__name__)
 
+def parse_dtype(s):
+    '''
+    Parses a VAR=DTYPE argument. eg: ffd=i1
+    '''
+    variable, dtype = s.split('=')
+    return variable, np.dtype(dtype).str[1:]
+
+def parse_packing(s):
+    '''
+    Parses a VAR=SCALE[,OFFSET] argument. eg: gdd=0.01,0
+    '''
+    variable, params = s.split('=')
+    params = [float(x) for x in params.split(',')]
+    return variable, (params[0], params[1] if len(params) > 1 else 0.)
+
 def main(args):
     base_dir = args.indir
-    log.info('Getting file list')
-    netcdf_iter = iter_netcdf_files(base_dir)
-    file_iter = iter_matching_cmip5_file(netcdf_iter, args.filter)
-
-    log.info('Determining valid model sets')
-    model_sets = group_files_by_model_set(file_iter)
+    if args.catalog:
+        log.info('Refreshing file catalog {}'.format(args.catalog))
+        catalog = Catalog(args.catalog)
+        catalog.refresh(base_dir)
+
+        log.info('Determining valid model sets')
+        model_sets = catalog.group_files_by_model_set(args.filter, args.concatenate, base_dir)
+        catalog.close()
+    else:
+        log.info('Getting file list')
+        netcdf_iter = iter_netcdf_files(base_dir, _filter=args.filter, threads=args.scan_threads)
+        file_iter = iter_matching_cmip5_file(netcdf_iter, args.filter)
+
+        log.info('Determining valid model sets')
+        model_sets = group_files_by_model_set(file_iter, args.concatenate)
 
     log.info(model_sets)
 
-
-    # Set up job queues
-    tasks = multiprocessing.Queue()
-    results = multiprocessing.Queue()
-
-    # Start workers
-    num_workers = args.processes
-    log.info('Creating {} workers'.format(num_workers))
-    workers = [Consumer(tasks, results) for i in xrange(num_workers)]
-    for worker in workers:
-        worker.start()
-
-    # Populate task list
-    for k, base in model_sets.items():
-        for variable in args.variable:
-            tasks.put(base.derive_variable(variable, args.outdir))
-
-    # Add a poison pill for each worker
-    for x in xrange(num_workers):
-        tasks.put(None)
-
-    num_jobs = len(model_sets) * len(args.variable)
-    while num_jobs:
-        result = results.get()
-        num_jobs -= 1
-        print(str(num_jobs) + ' Jobs left')
+    output_policy = OutputPolicy(
+        complevel=args.complevel,
+        shuffle=not args.no_shuffle,
+        chunking=args.chunking,
+        dtypes=dict(args.dtype),
+        packing=dict(args.pack)
+    )
+    options = {'max_block_mb': args.max_block_mb, 'aggregate': args.aggregate, 'output_policy': output_policy,
+               'incremental': args.incremental, 'digest': args.digest, 'pipeline_depth': args.pipeline,
+               'reader': args.reader, 'handle_pool': args.handle_pool, 'chunk_cache_mb': args.chunk_cache_mb}
+    if args.stage_dir:
+        staging = StagingCache(args.stage_dir, int(args.stage_mb * 1024 * 1024))
+        # Reservations left by an interrupted run would keep their files staged for good
+        staging.clear_references()
+        options['staging'] = staging
+    if args.bbox or args.region_mask:
+        options['region'] = Region(args.bbox, args.region_mask, args.region_mask_var)
+    if args.tiles:
+        # Each job spreads its tiles over all processes, so jobs run one at a time
+        options.update({'tiles': args.tiles, 'tile_processes': args.processes})
+
+    # Build job list
+    jobs = []
+    for k, base in sorted(model_sets.items()):
+        if args.fused:
+            jobs.append(Job(k, args.variable, base.variables, args.outdir, **options))
+        else:
+            for variable in args.variable:
+                jobs.append(Job(k, [variable], base.variables, args.outdir, **options))
+
+    if args.incremental:
+        pending = [job for job in jobs if not job.is_up_to_date()]
+        log.info('Skipping {} up to date jobs'.format(len(jobs) - len(pending)))
+        jobs = pending
+
+    if args.profile and jobs:
+        # Profile the first (largest) job, or the first whose name matches --profile-job
+        matching = [job for job in sorted(jobs, key=lambda job: job.size, reverse=True)
+                    if not args.profile_job or re.search(args.profile_job, str(job))]
+        if matching:
+            matching[0].profile = args.profile
+        else:
+            log.warning('No job matches {}, not profiling'.format(args.profile_job))
+
+    scheduler = Scheduler(processes=1 if args.tiles else args.processes, retries=args.retries, progress=args.progress)
+    results = scheduler.run(jobs)
+
+    records = [r.metrics for r in results if r.metrics]
+    if args.metrics:
+        f = sys.stdout if args.metrics == '-' else open(args.metrics, 'w')
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        if f is not sys.stdout:
+            f.close()
+    if args.summary:
+        sys.stderr.write(format_summary(records) + '\n')
+
+    failed = [r for r in results if not r.ok]
+    log.info('{} of {} jobs succeeded'.format(len(results) - len(failed), len(results)))
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
@@ -60,14 +126,69 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--indir', help='Input directory')
     parser.add_argument('-o', '--outdir', help='Output directory')
     parser.add_argument('-v', '--variable', nargs= '+',
-                        choices=['tas', 'gdd', 'hdd', 'ffd', 'pas'],
+                        choices=list(DERIVED_VARIABLES),
                         help='Variable(s) to calculate. Ex: -v var1 var2 var3')
     parser.add_argument('-f', '--filter', help='Predefined model set to restrict file input to')
+    parser.add_argument('-c', '--catalog', nargs='?', const=DEFAULT_CATALOG_PATH,
+                        help='Discover input files through an incrementally refreshed file catalog (default location {})'.format(DEFAULT_CATALOG_PATH))
+    parser.add_argument('--scan-threads', default=1, type=int,
+                        help='Number of directories to list concurrently when scanning the input directory')
     parser.add_argument('-p', '--processes', default=1,
                         type=int, help='Max number of processes to consume')
-    parser.add_argument('--progress', default=False, action='store_true', help='Display percentage progress')
+    parser.add_argument('--concatenate', default=False, action='store_true',
+                        help='Group all temporal pieces of a model run together and derive across file boundaries, instead of deriving each temporal subset on its own')
+    parser.add_argument('--fused', default=False, action='store_true',
+                        help='Calculate all requested variables for a model set in a single pass over its base variables')
+    parser.add_argument('--max-block-mb', default=DEFAULT_MAX_BLOCK_MB, type=float,
+                        help='Memory budget (MB) per job for the blocks of time steps held at once. With --pipeline DEPTH it is split '
+                             'between DEPTH + 3 blocks, and with --tiles between the 3 blocks being derived and written')
+    parser.add_argument('--pipeline', nargs='?', default=0, const=2, type=int, metavar='DEPTH',
+                        help='Read blocks in a thread and write them from a process of their own, so reading, computing and writing overlap on separate cores, '
+                             'queueing up to DEPTH blocks (default 2) between them')
+    parser.add_argument('--reader', default='auto', choices=BACKENDS,
+                        help='Read base variables from memory maps (NetCDF3 only), with netCDF4, or memory map whenever possible (auto)')
+    parser.add_argument('--stage-dir', metavar='DIR',
+                        help='Copy input files to this local scratch directory and read them from there, keeping them for later jobs and runs')
+    parser.add_argument('--stage-mb', default=50 * 1024, type=float,
+                        help='Budget (MB) for the files kept in --stage-dir, least recently used files not needed by a pending job being evicted first')
+    parser.add_argument('--handle-pool', default=0, type=int, metavar='N',
+                        help='Keep up to N input files open in each worker between jobs, so jobs of the same model set reuse them')
+    parser.add_argument('--chunk-cache-mb', type=float,
+                        help='Chunk cache size (MB) of each NetCDF4 input variable. Defaults to the netCDF library default')
+    parser.add_argument('--tiles', nargs=2, type=int, metavar=('NLAT', 'NLON'),
+                        help='Split each grid into NLAT x NLON tiles derived in parallel on --processes workers. For few, large model sets')
+    parser.add_argument('--bbox', nargs=4, type=float, metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'),
+                        help='Only read and write the grid cells within this bounding box. Ex: --bbox 48 60 -140 -114')
+    parser.add_argument('--region-mask', metavar='PATH',
+                        help='Only read and write the grid cells around the region of a (lat, lon) mask NetCDF on the grid of the inputs, masking cells outside of it')
+    parser.add_argument('--region-mask-var', help='Variable of --region-mask. Defaults to its only two dimensional variable')
+    parser.add_argument('--aggregate', choices=sorted(AGGREGATE_FREQUENCIES),
+                        help='Write temporal totals (means for tas) of each variable instead of daily values')
+    parser.add_argument('--complevel', default=4, type=int, choices=range(10),
+                        help='zlib compression level of the outputs. 0 disables compression')
+    parser.add_argument('--no-shuffle', default=False, action='store_true',
+                        help='Do not apply the shuffle filter when compressing outputs')
+    parser.add_argument('--chunking', choices=CHUNK_LAYOUTS,
+                        help='Output chunk shape tuned for map (one time step) or time series access')
+    parser.add_argument('--dtype', nargs='+', default=[], type=parse_dtype, metavar='VAR=DTYPE',
+                        help='Output storage type per variable. Ex: --dtype ffd=i1')
+    parser.add_argument('--pack', nargs='+', default=[], type=parse_packing, metavar='VAR=SCALE[,OFFSET]',
+                        help='Store a variable as int16 packed with scale_factor and add_offset, holding 65535 steps of scale_factor. '
+                             'Ex: --pack gdd=0.01 for daily values, --pack gdd=1 for --aggregate totals')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='Only generate outputs whose inputs or parameters changed since they were last generated, as recorded in a manifest next to each output')
+    parser.add_argument('--digest', default=False, action='store_true',
+                        help='Record sha256 digests of inputs in manifests, so inputs that were only touched or copied are not treated as changed')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="Write per-job phase times, bytes, peak RSS and worker as JSON lines to PATH ('-' for stdout)")
+    parser.add_argument('--summary', default=False, action='store_true', help='Display a table of per-job metrics when done')
+    parser.add_argument('--profile', metavar='PATH', help='Profile a single job with cProfile and write its stats to PATH')
+    parser.add_argument('--profile-job', metavar='PATTERN',
+                        help='Profile the first job whose description matches this regular expression instead of the largest job')
+    parser.add_argument('--retries', default=1, type=int, help='Times to retry a job that raised an unexpected error')
+    parser.add_argument('--progress', default=False, action='store_true', help='Display progress and throughput after each job')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
 
-    main(args)
+    sys.exit(main(args))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+import argparse
+
+from pyclimate.alignment import AlignmentError
+from pyclimate.ensemble import generate_ensemble_statistics, get_ensemble_members, DEFAULT_STATISTICS
+from pyclimate.path import iter_netcdf_files, group_files_by_model_set, iter_matching_cmip5_file
+from pyclimate.reader import BACKENDS
+from pyclimate.variables import DEFAULT_MAX_BLOCK_MB
+
+log = logging.getLogger(__name__)
+
+def main(args):
+    log.info('Getting file list')
+    netcdf_iter = iter_netcdf_files(args.indir, _filter=args.filter, threads=args.scan_threads)
+    model_sets = group_files_by_model_set(iter_matching_cmip5_file(netcdf_iter, args.filter), concatenate=True)
+    experiments = args.experiment or sorted(set(base.experiment for base in model_sets.values()))
+
+    failed = 0
+    for experiment in experiments:
+        for variable in args.variable:
+            members = get_ensemble_members(model_sets, experiment, variable, args.frequency)
+            if len(members) < 2:
+                log.warning('Skipping {} of {}: {} member(s)'.format(variable, experiment, len(members)))
+                continue
+            log.info('Summarizing {} of {} across {}'.format(variable, experiment, ', '.join(members)))
+            try:
+                generate_ensemble_statistics(members, variable, args.outdir, args.statistics, args.max_block_mb, args.reader)
+            except (AlignmentError, ValueError) as e:
+                log.error('Skipping {} of {}: {}'.format(variable, experiment, e))
+                failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate ensemble statistics of variables across the model runs of each experiment')
+    parser.add_argument('-i', '--indir', required=True, help='Input directory, eg: the output directory of gen_degree_days.py')
+    parser.add_argument('-o', '--outdir', required=True, help='Output directory')
+    parser.add_argument('-v', '--variable', nargs='+', required=True, help='Variable(s) to summarize. Ex: -v gdd hdd')
+    parser.add_argument('-e', '--experiment', nargs='+', help='Experiment(s) to summarize. Defaults to every experiment found')
+    parser.add_argument('-f', '--filter', help='Predefined model set to restrict file input to. Ex: pcic12')
+    parser.add_argument('--frequency', default='day',
+                        help='DRS frequency of the files to summarize, eg: mon for the outputs of gen_degree_days.py --aggregate monthly')
+    parser.add_argument('--statistics', nargs='+', default=list(DEFAULT_STATISTICS),
+                        help="Statistics across members: mean, median and percentiles such as p10")
+    parser.add_argument('--scan-threads', default=1, type=int,
+                        help='Number of directories to list concurrently when scanning the input directory')
+    parser.add_argument('--max-block-mb', default=DEFAULT_MAX_BLOCK_MB, type=float,
+                        help='Memory budget (MB) for the blocks read from all members and their statistics')
+    parser.add_argument('--reader', default='auto', choices=BACKENDS, help='How input files are read')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    sys.exit(main(args))
@@ -1,4 +1,5 @@
 import os
+import shutil
 import pytest
 
 from tempfile import NamedTemporaryFile
@@ -6,6 +7,8 @@ from tempfile import NamedTemporaryFile
 import netCDF4
 import numpy as np
 
+from pyclimate.handles import get_dataset_pool
+
 def get_base_3d_nc(dims, calendar='standard', start_time = 0):
     f = NamedTemporaryFile(suffix='.nc')
     nc = netCDF4.Dataset(f.name, 'w')
@@ -188,3 +191,197 @@ def dpm_leap(request):
 @pytest.fixture(scope="session")
 def days_leap(request):
     return [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366]
+
+def get_drs_model_set(base_dir, dims, variables=('tasmax', 'tasmin', 'pr'), calendar='365_day', format='NETCDF4', model='CanESM2', seed=0):
+    '''
+    Writes a datanode DRS structured set of base variables and returns a dict of variable to file path
+
+    Values are random, drawn from a state seeded by the variable name and `seed`.
+    '''
+    base_variables = {}
+    for varname in variables:
+        fp = os.path.join(base_dir, 'CMIP5', 'output', 'CCCMA', model, 'rcp85', 'day', 'atmos', 'day', 'r1i1p1',
+                          'v20120407', varname, '{}_day_{}_rcp85_r1i1p1_20060101-20061231.nc'.format(varname, model))
+        os.makedirs(os.path.dirname(fp))
+        nc = netCDF4.Dataset(fp, 'w', format=format)
+        nc.model_id = model
+
+        nc.createDimension('time', None)
+        nc.createDimension('lat', dims['lat'])
+        nc.createDimension('lon', dims['lon'])
+
+        var_time = nc.createVariable('time', 'f8', 'time')
+        var_time.units = 'days since 2006-01-01'
+        var_time.calendar = calendar
+        var_time.bounds = 'time_bnds'
+        var_time[:] = np.arange(dims['time']) + 0.5
+
+        nc.createDimension('bnds', 2)
+        var_time_bnds = nc.createVariable('time_bnds', 'f8', ('time', 'bnds'))
+        var_time_bnds[:] = np.column_stack([np.arange(dims['time']), np.arange(dims['time']) + 1])
+
+        var_lat = nc.createVariable('lat', 'f8', 'lat')
+        var_lat[:] = np.linspace(-90, 90, dims['lat'])
+        var_lon = nc.createVariable('lon', 'f8', 'lon')
+        var_lon[:] = np.linspace(0, 360, dims['lon'], endpoint=False)
+
+        var = nc.createVariable(varname, 'f4', ('time', 'lat', 'lon'), fill_value=1e20)
+        var.missing_value = 1e20
+        rs = np.random.RandomState(sum(map(ord, varname)) + seed)
+        shape = (dims['time'], dims['lat'], dims['lon'])
+        if varname == 'pr':
+            var[:] = rs.gamma(1, 2, size=shape)
+        else:
+            offset = 5 if varname == 'tasmax' else -5
+            var[:] = 278.15 + offset + 15 * rs.randn(*shape)
+        nc.close()
+        base_variables[varname] = fp
+
+    return base_variables
+
+@pytest.fixture(scope='session')
+def model_set(tmpdir_factory):
+    base_dir = str(tmpdir_factory.mktemp('archive'))
+    return get_drs_model_set(base_dir, {'time': 40, 'lat': 6, 'lon': 8})
+
+def split_time_pieces(fp, bounds, base_dir):
+    '''
+    Writes the time steps [start, stop) of a base variable file for each (start, stop) in bounds
+    as temporal pieces in a DRS layout below base_dir. Returns their paths
+    '''
+    fps = []
+    drs_dir = os.path.dirname(fp)
+    drs_dir = drs_dir[drs_dir.index(os.sep + 'CMIP5' + os.sep) + 1:]
+    with netCDF4.Dataset(fp) as nc:
+        varname = os.path.basename(drs_dir)
+        ncvar_time = nc.variables['time']
+        for start, stop in bounds:
+            first, last = netCDF4.num2date(ncvar_time[[start, stop - 1]], ncvar_time.units, ncvar_time.calendar)
+            piece_fp = os.path.join(base_dir, drs_dir, '{}_day_CanESM2_rcp85_r1i1p1_{:04d}{:02d}{:02d}-{:04d}{:02d}{:02d}.nc'.format(
+                varname, first.year, first.month, first.day, last.year, last.month, last.day))
+            if not os.path.exists(os.path.dirname(piece_fp)):
+                os.makedirs(os.path.dirname(piece_fp))
+            with netCDF4.Dataset(piece_fp, 'w') as piece:
+                piece.setncatts(dict((k, nc.getncattr(k)) for k in nc.ncattrs()))
+                for name, dim in nc.dimensions.items():
+                    piece.createDimension(name, None if dim.isunlimited() else len(dim))
+                for name, ncvar in nc.variables.items():
+                    fill_value = getattr(ncvar, '_FillValue', None)
+                    var = piece.createVariable(name, ncvar.datatype, ncvar.dimensions, fill_value=fill_value)
+                    var.setncatts(dict((k, ncvar.getncattr(k)) for k in ncvar.ncattrs() if k != '_FillValue'))
+                    var[:] = ncvar[start:stop] if ncvar.dimensions[0] == 'time' else ncvar[:]
+            fps.append(piece_fp)
+    return fps
+
+@pytest.fixture(scope='function')
+def split_model_set(model_set, tmpdir):
+    '''
+    model_set with tasmax and tasmin split into temporal pieces at different time steps, listed
+    out of order, and pr in a single file
+    '''
+    base_dir = str(tmpdir.mkdir('split'))
+    return {
+        'tasmax': split_time_pieces(model_set['tasmax'], [(15, 40), (0, 15)], base_dir),
+        'tasmin': split_time_pieces(model_set['tasmin'], [(0, 10), (10, 25), (25, 40)], base_dir),
+        'pr': split_time_pieces(model_set['pr'], [(0, 40)], base_dir)[0]
+    }
+
+def shift_units(fp, units, offset):
+    '''
+    Rewrites the time axis of a file in other units, `offset` being the old reference date in the new units
+    '''
+    with netCDF4.Dataset(fp, 'a') as nc:
+        for varname in ('time', 'time_bnds'):
+            nc.variables[varname][:] = nc.variables[varname][:] * 24 + offset
+        nc.variables['time'].units = units
+
+@pytest.fixture(scope='function')
+def offset_model_set(model_set, tmpdir):
+    '''
+    model_set with tasmin from the 11th day, in hours since the 6th, and pr up to the 30th day
+    '''
+    base_dir = str(tmpdir.mkdir('offset'))
+    base_variables = {
+        'tasmax': model_set['tasmax'],
+        'tasmin': split_time_pieces(model_set['tasmin'], [(10, 40)], base_dir)[0],
+        'pr': split_time_pieces(model_set['pr'], [(0, 30)], base_dir)[0]
+    }
+    shift_units(base_variables['tasmin'], 'hours since 2006-01-06', -5 * 24)
+    return base_variables
+
+@pytest.fixture(scope='session', params=['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET'])
+def classic_model_set(request, tmpdir_factory):
+    base_dir = str(tmpdir_factory.mktemp('classic'))
+    return get_drs_model_set(base_dir, {'time': 40, 'lat': 6, 'lon': 8}, format=request.param)
+
+@pytest.fixture(scope='function')
+def small_model_set(tmpdir):
+    '''
+    A model set private to one test, for tests that modify their inputs
+    '''
+    return get_drs_model_set(str(tmpdir.mkdir('archive')), {'time': 10, 'lat': 2, 'lon': 3})
+
+@pytest.fixture(scope='function')
+def cmip5_tree(tmpdir, cmip5_file_list):
+    '''
+    Empty files laid out as cmip5_file_list below a temporary directory. Returns the directory matching /root/directory
+    '''
+    for fp in cmip5_file_list:
+        tmpdir.join(fp).ensure()
+    return str(tmpdir.join('root', 'directory'))
+
+@pytest.fixture(scope='function')
+def dataset_pool():
+    '''
+    The process' Dataset handle pool, emptied and disabled again after the test
+    '''
+    pool = get_dataset_pool()
+    yield pool
+    pool.configure(0)
+
+@pytest.fixture(scope='session')
+def multi_year_set(tmpdir_factory):
+    '''
+    tasmax and pr over three years from 2006 on a 365 day calendar
+    '''
+    base_dir = str(tmpdir_factory.mktemp('multi_year'))
+    return get_drs_model_set(base_dir, {'time': 3 * 365, 'lat': 2, 'lon': 3}, variables=('tasmax', 'pr'))
+
+@pytest.fixture(scope='function')
+def masked_multi_year_set(multi_year_set, tmpdir):
+    '''
+    multi_year_set with tasmax masked in the first cell throughout January and in the second on January 4th 2006
+    '''
+    tasmax, = split_time_pieces(multi_year_set['tasmax'], [(0, 3 * 365)], str(tmpdir.mkdir('masked')))
+    with netCDF4.Dataset(tasmax, 'a') as nc:
+        january = np.concatenate([np.arange(31) + 365 * year for year in range(3)])
+        nc.variables['tasmax'][january, 0, 0] = np.ma.masked
+        nc.variables['tasmax'][3, 0, 1] = np.ma.masked
+    return {'tasmax': tasmax, 'pr': multi_year_set['pr']}
+
+@pytest.fixture(scope='session')
+def ensemble_dir(tmpdir_factory):
+    '''
+    Directory of three model runs of tasmax and tasmin on the same grid
+    '''
+    base_dir = str(tmpdir_factory.mktemp('ensemble'))
+    for seed, model in enumerate(('CanESM2', 'MIROC5', 'inmcm4')):
+        get_drs_model_set(base_dir, {'time': 40, 'lat': 6, 'lon': 8}, ('tasmax', 'tasmin'), model=model, seed=seed)
+    return base_dir
+
+@pytest.fixture(scope='session')
+def mixed_frequency_ensemble_dir(tmpdir_factory, ensemble_dir):
+    '''
+    ensemble_dir with a monthly tasmax next to the daily one of each run, as gen_degree_days.py --aggregate leaves them
+    '''
+    base_dir = str(tmpdir_factory.mktemp('mixed_frequency_ensemble'))
+    shutil.rmtree(base_dir)
+    shutil.copytree(ensemble_dir, base_dir)
+    for root, dirs, files in list(os.walk(base_dir)):
+        for f in files:
+            if f.startswith('tasmax_day_'):
+                fp = os.path.join(root, f).replace('/day/', '/mon/').replace('tasmax_day_', 'tasmax_mon_') \
+                    .replace('20060101-20061231', '200601-200612')
+                os.makedirs(os.path.dirname(fp))
+                shutil.copy(os.path.join(root, f), fp)
+    return base_dir
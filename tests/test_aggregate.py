@@ -0,0 +1,36 @@
+import pytest
+import numpy as np
+
+from pyclimate.aggregate import TimeAggregator
+from pyclimate.nchelpers import iter_time_blocks
+
+@pytest.mark.parametrize('block_size', [1, 3, 7, 100])
+@pytest.mark.parametrize('method', ['sum', 'mean'])
+def test_time_aggregator(block_size, method):
+    data = np.random.RandomState(0).rand(20, 2, 3)
+    slices = [slice(0, 5), slice(5, 6), slice(6, 14), slice(14, 20)]
+    out = np.zeros((len(slices), 2, 3))
+
+    aggregator = TimeAggregator(slices, out, method)
+    for block_slice in iter_time_blocks(20, block_size):
+        aggregator.add(block_slice, data[block_slice])
+
+    reduce = np.sum if method == 'sum' else np.mean
+    expected = np.array([reduce(data[s], axis=0) for s in slices])
+    np.testing.assert_allclose(out, expected)
+
+def test_time_aggregator_masked():
+    data = np.ma.masked_array(np.ones((6, 2)), mask=False)
+    data[4, 1] = np.ma.masked
+    out = np.ma.zeros((2, 2))
+
+    aggregator = TimeAggregator([slice(0, 3), slice(3, 6)], out)
+    for block_slice in iter_time_blocks(6, 2):
+        aggregator.add(block_slice, data[block_slice])
+
+    np.testing.assert_array_equal(np.ma.getmaskarray(out), [[False, False], [False, True]])
+    assert out[1, 0] == 3
+
+def test_time_aggregator_unknown_method():
+    with pytest.raises(ValueError):
+        TimeAggregator([slice(0, 1)], np.zeros(1), 'max')
@@ -0,0 +1,74 @@
+import pytest
+import numpy as np
+from netCDF4 import Dataset
+
+from pyclimate.alignment import AlignmentError, align_base_variables, get_time_seconds, group_by_shared_time_steps
+from pyclimate.variables import DerivedVariableSet, get_derived_variable
+
+def open_bases(base_variables):
+    return dict((x, Dataset(fp)) for x, fp in base_variables.items())
+
+def test_time_seconds(offset_model_set):
+    with Dataset(offset_model_set['tasmin']) as nc:
+        np.testing.assert_array_equal(get_time_seconds(nc.variables['time'], 'days since 2006-01-01'), (np.arange(10, 40) + 0.5) * 86400)
+
+def test_identity(model_set):
+    nc_bases = open_bases(model_set)
+    alignment = align_base_variables(nc_bases)
+    assert alignment.is_identity
+    assert alignment.nsteps == 40
+
+def test_align_offsets(offset_model_set):
+    alignment = align_base_variables(open_bases(offset_model_set))
+    assert not alignment.is_identity
+    assert alignment.nsteps == 20
+    assert alignment.offsets == {'tasmax': 10, 'tasmin': 0, 'pr': 10}
+    assert alignment.get_slice('tasmax', slice(5, 8)) == slice(15, 18)
+
+@pytest.mark.parametrize(('variables', 'periods'), [
+    (['tas', 'gdd'], [(10, 40), (10, 40)]),
+    # pr is shorter than tasmin, which starts later than tasmax
+    (['gdd', 'pas'], [(10, 40), (0, 30)]),
+    (['gdd', 'pas', 'hdd'], [(10, 40), (0, 30), (10, 40)]),
+])
+def test_derive_shared_period(model_set, offset_model_set, tmpdir, variables, periods):
+    outfps = DerivedVariableSet([get_derived_variable(v, offset_model_set, str(tmpdir.join('offset')), max_block_mb=0.01) for v in variables])()
+    single = DerivedVariableSet([get_derived_variable(v, model_set, str(tmpdir.join('single'))) for v in variables])()
+    for variable, (start, stop), outfp, single_fp in zip(variables, periods, outfps, single):
+        with Dataset(outfp) as nc, Dataset(single_fp) as nc_single:
+            np.testing.assert_array_equal(nc.variables['time'][:], np.arange(start, stop) + 0.5)
+            np.testing.assert_array_equal(nc.variables[variable][:], nc_single.variables[variable][start:stop])
+
+def test_group_by_shared_time_steps(offset_model_set):
+    nc_bases = open_bases(offset_model_set)
+    assert group_by_shared_time_steps(nc_bases, [['tasmax', 'tasmin'], ['tasmax', 'pr'], ['tasmin'], ['pr', 'tasmax'], ['pr', 'tasmin']]) == [[0, 2], [1, 3], [4]]
+
+def test_derive_shared_period_tiled(model_set, offset_model_set, tmpdir):
+    outfp, = DerivedVariableSet([get_derived_variable('gdd', offset_model_set, str(tmpdir.join('offset')))], tiles=(2, 2), processes=2)()
+    single_fp, = DerivedVariableSet([get_derived_variable('gdd', model_set, str(tmpdir.join('single')))])()
+    with Dataset(outfp) as nc, Dataset(single_fp) as nc_single:
+        np.testing.assert_array_equal(nc.variables['gdd'][:], nc_single.variables['gdd'][10:40])
+
+def test_mismatched_grid(small_model_set, tmpdir):
+    with Dataset(small_model_set['tasmin'], 'a') as nc:
+        nc.variables['lat'][:] = nc.variables['lat'][:] + 1
+    with pytest.raises(AlignmentError):
+        get_derived_variable('tas', small_model_set, str(tmpdir))()
+
+def test_mismatched_calendar(small_model_set, tmpdir):
+    with Dataset(small_model_set['tasmin'], 'a') as nc:
+        nc.variables['time'].calendar = '360_day'
+    with pytest.raises(AlignmentError):
+        get_derived_variable('tas', small_model_set, str(tmpdir))()
+
+def test_missing_time_steps(small_model_set):
+    with Dataset(small_model_set['tasmin'], 'a') as nc:
+        nc.variables['time'][5:] = nc.variables['time'][5:] + 1
+    with pytest.raises(AlignmentError):
+        align_base_variables(open_bases(small_model_set))
+
+def test_no_shared_time_steps(small_model_set):
+    with Dataset(small_model_set['tasmin'], 'a') as nc:
+        nc.variables['time'][:] = nc.variables['time'][:] + 100
+    with pytest.raises(AlignmentError):
+        align_base_variables(open_bases(small_model_set))
@@ -0,0 +1,75 @@
+import os
+import shutil
+
+import pytest
+
+from pyclimate.catalog import Catalog
+from pyclimate.path import iter_netcdf_files, iter_matching_cmip5_file, group_files_by_model_set
+
+@pytest.fixture(scope='function')
+def catalog(tmpdir):
+    c = Catalog(str(tmpdir.join('cache', 'catalog.sqlite')), read_headers=False)
+    yield c
+    c.close()
+
+@pytest.mark.parametrize('_filter', [
+    None,
+    "[{'variable_name': 'tasmax'}]",
+    "[{'model': 'CanESM2', 'experiment': ['rcp26', 'rcp85']}, {'model': 'CanCM4', 'experiment': 'historical'}]",
+    'pcic12',
+    "[{'t_start': '20060101'}]",
+])
+def test_catalog_query_matches_scan(cmip5_tree, catalog, _filter):
+    catalog.refresh(cmip5_tree)
+    expected = sorted(iter_matching_cmip5_file(iter_netcdf_files(cmip5_tree), _filter))
+    assert list(catalog.iter_matching_cmip5_file(_filter)) == expected
+
+def test_catalog_group_files_by_model_set(cmip5_tree, catalog):
+    catalog.refresh(cmip5_tree)
+    groups = catalog.group_files_by_model_set()
+    expected = group_files_by_model_set(iter_netcdf_files(cmip5_tree))
+    assert sorted(groups.keys()) == sorted(expected.keys())
+    for k in groups:
+        assert groups[k].variables == expected[k].variables
+
+def test_catalog_incremental_refresh(cmip5_tree, catalog):
+    stats = catalog.refresh(cmip5_tree)
+    assert stats['added'] == 16
+    assert stats['listed'] == len(list(os.walk(cmip5_tree)))
+
+    assert catalog.refresh(cmip5_tree) == {'listed': 0, 'added': 0, 'updated': 0, 'removed': 0}
+
+    variable_dir = os.path.join(cmip5_tree, 'CCCMA/CanCM4/rcp45/day/atmos/day/r1i1p1/v20120612/pr')
+    open(os.path.join(variable_dir, 'pr_day_CanCM4_rcp45_r1i1p1_20360101-20451231.nc'), 'w').close()
+    os.utime(variable_dir, (0, 1))
+    assert catalog.refresh(cmip5_tree) == {'listed': 1, 'added': 1, 'updated': 0, 'removed': 0}
+
+    shutil.rmtree(os.path.join(cmip5_tree, 'CCCMA/CanCM4/rcp45'))
+    os.utime(os.path.join(cmip5_tree, 'CCCMA/CanCM4'), (0, 2))
+    assert catalog.refresh(cmip5_tree)['removed'] == 4
+    assert len(list(catalog.iter_matching_cmip5_file())) == 13
+
+def test_catalog_headers(model_set, tmpdir):
+    archive = model_set['tasmax'].split('/CMIP5/')[0]
+    catalog = Catalog(str(tmpdir.join('catalog.sqlite')))
+    catalog.refresh(archive)
+    dimensions, calendar = catalog.get_header(model_set['tasmax'])
+    assert dimensions == {'time': 40, 'lat': 6, 'lon': 8, 'bnds': 2}
+    assert calendar == '365_day'
+    catalog.close()
+
+def test_catalog_query_restricted_to_base_dir(cmip5_tree, catalog):
+    # A sibling whose path starts with the other's
+    other_tree = cmip5_tree + '2'
+    shutil.copytree(cmip5_tree, other_tree)
+    catalog.refresh(cmip5_tree)
+    catalog.refresh(other_tree)
+
+    assert len(list(catalog.iter_matching_cmip5_file())) == 32
+    for base_dir in (cmip5_tree, other_tree):
+        fps = list(catalog.iter_matching_cmip5_file(base_dir=base_dir))
+        assert fps == sorted(iter_matching_cmip5_file(iter_netcdf_files(base_dir)))
+        groups = catalog.group_files_by_model_set(concatenate=True, base_dir=base_dir)
+        for base in groups.values():
+            for fp in base.variables.values():
+                assert all(x.startswith(base_dir + os.sep) for x in (fp if isinstance(fp, list) else [fp]))
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from pyclimate.climatology import ClimatologyAccumulator, generate_climatologies, get_climatologies
+
+MONTH_LENGTHS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+def get_month_steps(year, month):
+    '''
+    Time steps of a month of the multi_year_set (365 day calendar from 2006)
+    '''
+    start = (year - 2006) * 365 + sum(MONTH_LENGTHS[:month - 1])
+    return np.arange(start, start + MONTH_LENGTHS[month - 1])
+
+def test_get_climatologies(multi_year_set):
+    with Dataset(multi_year_set['tasmax']) as nc:
+        climatologies = get_climatologies(nc.variables['time'], [(2006, 2007), (2008, 2009)])
+        assert len(climatologies) == 12
+        assert [c.group for c in climatologies] == list(range(12))
+        assert list(climatologies[0].months) == [0, 12]
+        assert list(climatologies[0].first) == [0]
+
+        seasonal = get_climatologies(nc.variables['time'], [(2007, 2008)], 'seasonal')
+        # DJF 2007 starts with December 2006
+        assert list(seasonal[0].months) == [11, 12, 13, 23, 24, 25]
+        assert list(seasonal[0].first) == [11, 12, 13]
+
+def test_accumulator():
+    rs = np.random.RandomState(0)
+    data = rs.randn(50, 3) * 10 + 280
+    mask = rs.rand(50, 3) < 0.2
+    accumulator = ClimatologyAccumulator(1, (3,), variance=True)
+    for start in range(0, 50, 7):
+        accumulator.add(0, data[start:start + 7], mask[start:start + 7])
+    expected = np.ma.masked_array(data, mask)
+    np.testing.assert_allclose(accumulator.mean(0), expected.mean(axis=0))
+    np.testing.assert_allclose(accumulator.std(0), expected.std(axis=0, ddof=1))
+
+def test_monthly_climatology(multi_year_set, tmpdir):
+    outfps = generate_climatologies(multi_year_set['tasmax'], 'tasmax', str(tmpdir), [(2006, 2007), (2008, 2008)], variance=True, max_block_mb=0.001)
+    assert len(outfps) == 2
+    assert 'monClim' in outfps[0] and outfps[0].endswith('20060101-20071231.nc')
+    with Dataset(multi_year_set['tasmax']) as nc_in, Dataset(outfps[0]) as nc:
+        data = nc_in.variables['tasmax'][:]
+        assert nc.variables['time'].climatology == 'climatology_bounds'
+        assert nc.frequency == 'monClim'
+        bounds = nc.variables['climatology_bounds'][:]
+        assert bounds.shape == (12, 2)
+        np.testing.assert_array_equal(bounds[0], [0, 365 + 31])
+        np.testing.assert_array_equal(nc.variables['time'][:2], [15.5, 31 + 14])
+        for month in range(1, 13):
+            steps = np.concatenate([get_month_steps(2006, month), get_month_steps(2007, month)])
+            np.testing.assert_allclose(nc.variables['tasmax'][month - 1], data[steps].mean(axis=0), rtol=1e-6)
+            np.testing.assert_allclose(nc.variables['tasmax_std'][month - 1], data[steps].std(axis=0, ddof=1), rtol=1e-5)
+
+def test_seasonal_sum_climatology(multi_year_set, tmpdir):
+    outfp, = generate_climatologies(multi_year_set['pr'], 'pr', str(tmpdir), [(2007, 2008)], 'seasonal', 'sum')
+    with Dataset(multi_year_set['pr']) as nc_in, Dataset(outfp) as nc:
+        data = nc_in.variables['pr'][:]
+        assert nc.variables['pr'].shape == (4, 2, 3)
+        assert nc.variables['pr'].cell_methods == 'time: sum within years time: mean over years'
+        djf = np.concatenate([get_month_steps(year, month) for year, month in [(2006, 12), (2007, 1), (2007, 2), (2007, 12), (2008, 1), (2008, 2)]])
+        np.testing.assert_allclose(nc.variables['pr'][0], data[djf].sum(axis=0) / 2, rtol=1e-6)
+
+def test_masked_values(masked_multi_year_set, tmpdir):
+    fp = masked_multi_year_set['tasmax']
+    with Dataset(fp) as nc:
+        data = nc.variables['tasmax'][:]
+    outfp, = generate_climatologies(fp, 'tasmax', str(tmpdir.join('out')), [(2006, 2007)])
+    with Dataset(outfp) as nc:
+        january = nc.variables['tasmax'][0]
+        assert january.mask[0, 0] and not january.mask[0, 1]
+        steps = np.concatenate([get_month_steps(2006, 1), get_month_steps(2007, 1)])
+        np.testing.assert_allclose(january[0, 1], data[steps, 0, 1].mean(), rtol=1e-6)
+
+def test_uncovered_periods(multi_year_set, tmpdir):
+    with pytest.raises(ValueError):
+        generate_climatologies(multi_year_set['tasmax'], 'tasmax', str(tmpdir), [(1971, 2000)])
+    outfps = generate_climatologies(multi_year_set['tasmax'], 'tasmax', str(tmpdir), [(2006, 2006), (2007, 2010)])
+    assert len(outfps) == 1 and os.path.exists(outfps[0])
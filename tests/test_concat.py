@@ -0,0 +1,99 @@
+import os
+
+import pytest
+import numpy as np
+from netCDF4 import Dataset
+
+from pyclimate.concat import ConcatenatedVariable, get_time_pieces, open_base_dataset
+from pyclimate.manifest import is_up_to_date
+from pyclimate.path import group_files_by_model_set, get_subset_date_key
+from pyclimate.variables import DerivedVariableSet, get_derived_variable
+
+def read_base(fp, varname):
+    with Dataset(fp) as nc:
+        return nc.variables[varname][:]
+
+def test_time_pieces(split_model_set):
+    pieces = get_time_pieces(split_model_set['tasmax'])
+    assert [(os.path.basename(p.fp), p.start, p.stop) for p in pieces] == [
+        ('tasmax_day_CanESM2_rcp85_r1i1p1_20060101-20060115.nc', 0, 15),
+        ('tasmax_day_CanESM2_rcp85_r1i1p1_20060116-20060209.nc', 15, 40)
+    ]
+    np.testing.assert_array_equal(np.concatenate([p.values for p in pieces]), np.arange(40) + 0.5)
+
+def test_overlapping_pieces(split_model_set):
+    with pytest.raises(ValueError):
+        get_time_pieces(split_model_set['tasmax'] + [split_model_set['pr']])
+
+def test_concatenated_dataset(model_set, split_model_set):
+    with open_base_dataset(split_model_set['tasmin'], 'tasmin') as nc, Dataset(model_set['tasmin']) as nc_single:
+        assert nc.variables['tasmin'].shape == nc_single.variables['tasmin'].shape
+        for varname in ('time', 'time_bnds', 'lat', 'lon'):
+            np.testing.assert_array_equal(nc.variables[varname][:], nc_single.variables[varname][:])
+        assert nc.model_id == nc_single.model_id
+
+@pytest.mark.parametrize('backend', ['auto', 'netcdf4'])
+def test_concatenated_variable(model_set, split_model_set, backend):
+    expected = read_base(model_set['tasmin'], 'tasmin')
+    variable = ConcatenatedVariable(split_model_set['tasmin'], 'tasmin', backend)
+    assert variable.shape == expected.shape
+    for block_slice in (slice(0, 7), slice(5, 30), slice(12, 18), slice(30, 40)):
+        np.testing.assert_array_equal(variable[block_slice, 1:3], expected[block_slice, 1:3])
+        data, mask = variable.read(block_slice)
+        np.testing.assert_array_equal(data, expected[block_slice])
+        assert mask is None
+    # Only the last piece is left open
+    assert list(variable._open) == [split_model_set['tasmin'][2]]
+    variable.close()
+
+@pytest.mark.parametrize('pipeline_depth', [0, 2])
+def test_derive_concatenated(model_set, split_model_set, tmpdir, pipeline_depth):
+    variables = ['gdd', 'ffd', 'pas']
+    derived = [get_derived_variable(v, split_model_set, str(tmpdir.join('split')), max_block_mb=0.1) for v in variables]
+    outfps = DerivedVariableSet(derived, incremental=True, pipeline_depth=pipeline_depth)()
+    assert os.path.basename(outfps[0]) == 'gdd_day_CanESM2_rcp85_r1i1p1_20060101-20060209.nc'
+    assert all(is_up_to_date(v) for v in derived)
+
+    single = DerivedVariableSet([get_derived_variable(v, model_set, str(tmpdir.join('single'))) for v in variables])()
+    for variable, outfp, single_fp in zip(variables, outfps, single):
+        with Dataset(outfp) as nc, Dataset(single_fp) as nc_single:
+            np.testing.assert_array_equal(nc.variables[variable][:], nc_single.variables[variable][:])
+            np.testing.assert_array_equal(nc.variables['time'][:], nc_single.variables['time'][:])
+
+def test_concatenated_manifest_detects_new_piece(split_model_set, tmpdir):
+    derived = get_derived_variable('ffd', split_model_set, str(tmpdir))
+    DerivedVariableSet([derived], incremental=True)()
+    assert is_up_to_date(derived)
+    derived.base_variables = dict(split_model_set, tasmin=split_model_set['tasmin'][:2])
+    assert not is_up_to_date(derived)
+
+def test_group_concatenated(cmip5_file_list):
+    split = [fp.replace('20060101-21001231', '20060101-20551231') for fp in cmip5_file_list if 'rcp85' in fp and 'tasmax' in fp]
+    split += [fp.replace('20060101-21001231', '20560101-21001231') for fp in split]
+    fps = [fp for fp in cmip5_file_list if not ('rcp85' in fp and 'tasmax' in fp)] + split
+
+    assert 'CanESM2_rcp85_r1i1p1_20060101-21001231' in group_files_by_model_set(fps)
+
+    groups = group_files_by_model_set(fps, concatenate=True)
+    assert len(groups) == 6
+    base = groups['CanESM2_rcp85_r1i1p1_day_day']
+    assert base.variables['tasmax'] == sorted(split)
+    assert base.variables['pr'] == [fp for fp in cmip5_file_list if 'rcp85' in fp and '/pr/' in fp]
+    assert base.temporal_subset == '20060101-21001231'
+
+def test_group_concatenated_frequencies_and_versions(cmip5_file_list):
+    day = [fp for fp in cmip5_file_list if 'rcp85' in fp]
+    amon = ['/root/directory/CCCMA/CanESM2/rcp85/mon/atmos/Amon/r1i1p1/v20120407/tas/tas_Amon_CanESM2_rcp85_r1i1p1_{}.nc'.format(x)
+            for x in ('200601-205512', '205601-210012')]
+    old = [fp.replace('v20120407', 'v20110101').replace('20060101-21001231', '19500101-21001231') for fp in day if '/pr/' in fp]
+
+    groups = group_files_by_model_set(day + amon + old, concatenate=True)
+    assert sorted(groups) == ['CanESM2_rcp85_r1i1p1_day_day', 'CanESM2_rcp85_r1i1p1_mon_Amon']
+    assert groups['CanESM2_rcp85_r1i1p1_day_day'].variables['pr'] == [fp for fp in day if '/pr/' in fp]
+    assert groups['CanESM2_rcp85_r1i1p1_day_day'].temporal_subset == '20060101-21001231'
+    assert groups['CanESM2_rcp85_r1i1p1_mon_Amon'].variables == {'tas': amon}
+    assert groups['CanESM2_rcp85_r1i1p1_mon_Amon'].temporal_subset == '200601-210012'
+
+def test_subset_date_key():
+    assert get_subset_date_key('200601') < get_subset_date_key('20060101')
+    assert get_subset_date_key('21001231', end=True) < get_subset_date_key('210012', end=True)
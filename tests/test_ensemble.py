@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from pyclimate.alignment import AlignmentError
+from pyclimate.ensemble import compute_statistics, generate_ensemble_statistics, get_ensemble_block_shape, \
+    get_ensemble_members, get_percentile
+from pyclimate.path import group_files_by_model_set, iter_netcdf_files
+
+@pytest.fixture(scope='module')
+def members(ensemble_dir):
+    model_sets = group_files_by_model_set(iter_netcdf_files(ensemble_dir))
+    return get_ensemble_members(model_sets, 'rcp85', 'tasmax')
+
+def read_members(members):
+    arrays = []
+    for fp in members.values():
+        with Dataset(fp) as nc:
+            arrays.append(nc.variables['tasmax'][:])
+    return np.ma.stack(arrays)
+
+@pytest.mark.parametrize(('statistic', 'expected'), [
+    ('mean', None),
+    ('median', 50.),
+    ('p10', 10.),
+    ('p97.5', 97.5),
+])
+def test_get_percentile(statistic, expected):
+    assert get_percentile(statistic) == expected
+
+@pytest.mark.parametrize('statistic', ['max', 'p101', 'p'])
+def test_unknown_statistic(statistic):
+    with pytest.raises(ValueError):
+        get_percentile(statistic)
+
+def test_get_ensemble_block_shape():
+    shape = (100, 50, 40)
+    assert get_ensemble_block_shape(shape, 12, 4, 1024) == [100, 50, 40]
+    # 2000 values of 8 bytes for each of 12 * 2 + 4 arrays
+    assert get_ensemble_block_shape(shape, 12, 4, 2000 * 8 * 28 / 1024. / 1024) == [1, 50, 40]
+    assert get_ensemble_block_shape(shape, 12, 4, 100 * 8 * 28 / 1024. / 1024) == [1, 2, 40]
+
+def test_compute_statistics():
+    rs = np.random.RandomState(0)
+    stack = rs.randn(5, 4, 3)
+    stack[0, 0, 0] = stack[:, 1, 1] = np.nan
+    mean, median, p10 = compute_statistics(stack, ['mean', 'median', 'p10'])
+    np.testing.assert_allclose(mean[0, 0], stack[1:, 0, 0].mean())
+    np.testing.assert_allclose(median[0, 0], np.median(stack[1:, 0, 0]))
+    np.testing.assert_allclose(p10[2], np.percentile(stack[:, 2], 10, axis=0))
+    assert mean.mask[1, 1] and p10.mask[1, 1] and mean.mask.sum() == 1
+
+def test_get_ensemble_members(members):
+    assert list(members) == ['CanESM2_r1i1p1', 'MIROC5_r1i1p1', 'inmcm4_r1i1p1']
+
+@pytest.mark.parametrize('max_block_mb', [128, 0.001])
+def test_ensemble_statistics(members, tmpdir, max_block_mb):
+    outfps = generate_ensemble_statistics(members, 'tasmax', str(tmpdir), max_block_mb=max_block_mb)
+    assert list(outfps) == ['mean', 'median', 'p10', 'p90']
+    stack = read_members(members)
+    expected = {
+        'mean': stack.mean(axis=0),
+        'median': np.median(stack, axis=0),
+        'p10': np.percentile(stack, 10, axis=0),
+        'p90': np.percentile(stack, 90, axis=0)
+    }
+    for statistic, outfp in outfps.items():
+        assert '_ensemble_rcp85_{}_'.format(statistic) in outfp
+        with Dataset(outfp) as nc:
+            ncvar = nc.variables['tasmax']
+            assert ncvar.dtype == np.float32
+            assert ncvar.cell_methods.startswith('realization: ')
+            assert nc.ensemble_members == 'CanESM2_r1i1p1, MIROC5_r1i1p1, inmcm4_r1i1p1'
+            np.testing.assert_allclose(ncvar[:], expected[statistic], rtol=1e-6)
+
+def test_different_grids(members, small_model_set, tmpdir):
+    with pytest.raises(AlignmentError):
+        generate_ensemble_statistics(dict(members, other=small_model_set['tasmax']), 'tasmax', str(tmpdir))
+
+@pytest.mark.parametrize('frequency', ['day', 'mon'])
+def test_get_ensemble_members_mixed_frequencies(mixed_frequency_ensemble_dir, members, tmpdir, frequency):
+    model_sets = group_files_by_model_set(iter_netcdf_files(mixed_frequency_ensemble_dir), concatenate=True)
+    mixed = get_ensemble_members(model_sets, 'rcp85', 'tasmax', frequency)
+    assert list(mixed) == list(members)
+    for fp in mixed.values():
+        assert '/{}/'.format(frequency) in fp and '_{}_'.format(frequency) in os.path.basename(fp)
+    assert len(generate_ensemble_statistics(mixed, 'tasmax', str(tmpdir), ['mean'])) == 1
@@ -0,0 +1,100 @@
+import os
+import shutil
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pyclimate.handles import DatasetPool, get_chunk_cache_slots
+from pyclimate.reader import NetCDF4Variable
+from pyclimate.scheduler import Job, Scheduler
+
+def test_reuse(small_model_set):
+    pool = DatasetPool(2)
+    nc = pool.acquire(small_model_set['tasmax'])
+    pool.release(nc)
+    assert nc.isopen()
+    assert pool.acquire(small_model_set['tasmax']) is nc
+    assert (pool.hits, pool.misses) == (1, 1)
+
+def test_disabled(small_model_set):
+    pool = DatasetPool()
+    nc = pool.acquire(small_model_set['tasmax'])
+    pool.release(nc)
+    assert not nc.isopen()
+    assert len(pool) == 0
+
+def test_evict_least_recently_used(small_model_set):
+    pool = DatasetPool(2)
+    ncs = dict((x, pool.acquire(small_model_set[x])) for x in ('tasmax', 'tasmin', 'pr'))
+    for x in ('tasmin', 'tasmax', 'pr'):
+        pool.release(ncs[x])
+    assert not ncs['tasmin'].isopen()
+    assert ncs['tasmax'].isopen() and ncs['pr'].isopen()
+    pool.clear()
+    assert not ncs['tasmax'].isopen() and len(pool) == 0
+
+def test_in_use_not_closed(small_model_set):
+    pool = DatasetPool(0)
+    nc = pool.acquire(small_model_set['tasmax'])
+    assert pool.acquire(small_model_set['tasmax']) is nc
+    pool.release(nc)
+    assert nc.isopen()
+    pool.release(nc)
+    assert not nc.isopen()
+
+def test_changed_file_reopened(small_model_set):
+    pool = DatasetPool(2)
+    fp = small_model_set['tasmax']
+    nc = pool.acquire(fp)
+    pool.release(nc)
+    # Replaced by a new version, as the open handle locks the file itself
+    shutil.copyfile(fp, fp + '.new')
+    with Dataset(fp + '.new', 'a') as nc_edit:
+        nc_edit.variables['tasmax'][0] = 300.
+    os.rename(fp + '.new', fp)
+    nc_new = pool.acquire(fp)
+    assert nc_new is not nc and not nc.isopen()
+    assert np.all(nc_new.variables['tasmax'][0] == 300.)
+
+def test_changed_file_in_use_reopened(small_model_set, tmpdir):
+    pool = DatasetPool(2)
+    fp = str(tmpdir.join('tasmax.nc'))
+    shutil.copyfile(small_model_set['tasmax'], fp)
+    nc = pool.acquire(fp)
+    shutil.copyfile(fp, fp + '.new')
+    with Dataset(fp + '.new', 'a') as nc_edit:
+        nc_edit.variables['tasmax'][0] = 250.
+    os.rename(fp + '.new', fp)
+    nc_new = pool.acquire(fp)
+    assert nc_new is not nc and nc.isopen()
+    assert np.all(nc_new.variables['tasmax'][0] == 250.)
+    # The stale handle is closed by its last user, the new one is kept
+    pool.release(nc)
+    assert not nc.isopen()
+    pool.release(nc_new)
+    assert nc_new.isopen() and len(pool) == 1
+    assert pool.acquire(fp) is nc_new
+
+def test_reader_chunk_cache(small_model_set, dataset_pool):
+    dataset_pool.configure(1, chunk_cache_mb=4)
+    variable = NetCDF4Variable(small_model_set['tasmax'], 'tasmax')
+    try:
+        size, nelems, preemption = variable.ncvar.get_var_chunk_cache()
+        assert size == 4 * 1024 * 1024
+        assert nelems == get_chunk_cache_slots(size, variable.dtype.itemsize * np.prod(variable.ncvar.chunking()))
+    finally:
+        variable.close()
+    assert variable.nc.isopen()
+
+def test_chunk_cache_slots():
+    assert get_chunk_cache_slots(100, 10) == 101
+    assert get_chunk_cache_slots(1, 1000) == 11
+
+def test_jobs_share_handles(small_model_set, dataset_pool, tmpdir):
+    misses, hits = dataset_pool.misses, dataset_pool.hits
+    jobs = [Job('set', [v], small_model_set, str(tmpdir), handle_pool=3) for v in ('gdd', 'hdd')]
+    results = Scheduler().run(jobs)
+    assert all(r.ok for r in results)
+    # tasmax and tasmin are opened by the first job only
+    assert dataset_pool.misses - misses == 2 and dataset_pool.hits > hits
+    assert len(dataset_pool) == 2
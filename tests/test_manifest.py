@@ -0,0 +1,80 @@
+import os
+
+from pyclimate.manifest import get_manifest_path, read_manifest, is_up_to_date, file_matches
+from pyclimate.output import OutputPolicy
+from pyclimate.scheduler import Job
+from pyclimate.variables import DerivedVariableSet, gdd, ffd
+
+def touch(fp, offset=10):
+    st = os.stat(fp)
+    os.utime(fp, (st.st_atime, st.st_mtime + offset))
+
+def test_manifest_written(small_model_set, tmpdir):
+    v = gdd(small_model_set, str(tmpdir))
+    outfp, = DerivedVariableSet([v], incremental=True)()
+    manifest = read_manifest(outfp)
+    assert os.path.exists(get_manifest_path(outfp))
+    assert sorted(manifest['inputs']) == ['tasmax', 'tasmin']
+    assert manifest['inputs']['tasmin']['size'] == os.path.getsize(small_model_set['tasmin'])
+    assert manifest['parameters']['threshold'] == 278.15
+    assert 'sha256' not in manifest['inputs']['tasmin']
+    assert is_up_to_date(v)
+
+def test_no_manifest_by_default(small_model_set, tmpdir):
+    outfp, = DerivedVariableSet([ffd(small_model_set, str(tmpdir))])()
+    assert not os.path.exists(get_manifest_path(outfp))
+
+def test_skips_up_to_date(small_model_set, tmpdir):
+    outfp, = DerivedVariableSet([ffd(small_model_set, str(tmpdir))], incremental=True)()
+    touch(outfp, -10)
+    # Outputs modified since the manifest was written are regenerated
+    assert not is_up_to_date(ffd(small_model_set, str(tmpdir)))
+
+    DerivedVariableSet([ffd(small_model_set, str(tmpdir))], incremental=True)()
+    mtime = os.stat(outfp).st_mtime
+    assert DerivedVariableSet([ffd(small_model_set, str(tmpdir))], incremental=True)() == [outfp]
+    assert os.stat(outfp).st_mtime == mtime
+
+def test_changed_input(small_model_set, tmpdir):
+    v = ffd(small_model_set, str(tmpdir))
+    DerivedVariableSet([v], incremental=True)()
+    touch(small_model_set['tasmin'])
+    assert not is_up_to_date(v)
+    # Unrelated base variables do not matter
+    DerivedVariableSet([v], incremental=True)()
+    touch(small_model_set['pr'])
+    assert is_up_to_date(v)
+
+def test_changed_parameters(small_model_set, tmpdir):
+    DerivedVariableSet([gdd(small_model_set, str(tmpdir))], incremental=True)()
+    assert not is_up_to_date(gdd(small_model_set, str(tmpdir), output_policy=OutputPolicy(complevel=4)))
+    assert is_up_to_date(gdd(small_model_set, str(tmpdir)))
+
+def test_digest(small_model_set, tmpdir):
+    v = ffd(small_model_set, str(tmpdir))
+    DerivedVariableSet([v], incremental=True, digest=True)()
+    recorded = read_manifest(v.outfp)['inputs']['tasmin']
+    assert len(recorded['sha256']) == 64
+
+    touch(small_model_set['tasmin'])
+    assert not file_matches(recorded, small_model_set['tasmin'])
+    assert file_matches(recorded, small_model_set['tasmin'], digest=True)
+    assert is_up_to_date(v, digest=True)
+
+    recorded = dict(recorded, sha256='0' * 64)
+    assert not file_matches(recorded, small_model_set['tasmin'], digest=True)
+
+def test_corrupt_manifest(small_model_set, tmpdir):
+    v = ffd(small_model_set, str(tmpdir))
+    DerivedVariableSet([v], incremental=True)()
+    with open(get_manifest_path(v.outfp), 'w') as f:
+        f.write('{')
+    assert read_manifest(v.outfp) is None
+    assert not is_up_to_date(v)
+
+def test_job_up_to_date(small_model_set, tmpdir):
+    job = Job('test', ['gdd', 'ffd'], small_model_set, str(tmpdir), incremental=True)
+    assert not job.is_up_to_date()
+    job()
+    assert job.is_up_to_date()
+    assert not Job('test', ['gdd', 'hdd'], small_model_set, str(tmpdir), incremental=True).is_up_to_date()
@@ -0,0 +1,53 @@
+import os
+import pickle
+import pstats
+
+from pyclimate.metrics import Metrics, PHASES, format_summary, get_peak_rss_mb
+from pyclimate.scheduler import Job, Scheduler
+from pyclimate.variables import DerivedVariableSet, gdd, ffd
+
+def test_metrics_phase():
+    metrics = Metrics()
+    with metrics.phase('read'):
+        pass
+    metrics.add(bytes_read=10, blocks=1)
+    metrics.add(bytes_read=5)
+    metrics = pickle.loads(pickle.dumps(metrics))
+    d = metrics.as_dict()
+    assert sorted(d['seconds']) == sorted(PHASES)
+    assert d['seconds']['read'] >= 0
+    assert d['bytes_read'] == 15
+    assert d['blocks'] == 1
+
+def test_get_peak_rss_mb():
+    assert get_peak_rss_mb() > 1
+
+def test_derived_variable_set_metrics(model_set, tmpdir):
+    derived_set = DerivedVariableSet([gdd(model_set, str(tmpdir), max_block_mb=0.01), ffd(model_set, str(tmpdir), max_block_mb=0.01)])
+    derived_set()
+    metrics = derived_set.metrics.as_dict()
+    # tasmax and tasmin as float32, two float64 outputs of 40 x 6 x 8
+    assert metrics['bytes_read'] == 2 * 40 * 6 * 8 * 4
+    assert metrics['bytes_written'] == 2 * 40 * 6 * 8 * 8
+    assert metrics['blocks'] > 1
+    assert all(metrics['seconds'][phase] > 0 for phase in ('open', 'read', 'write', 'close'))
+
+def test_scheduler_metrics(model_set, tmpdir):
+    results = Scheduler(processes=2).run([Job('gdd', ['gdd'], model_set, str(tmpdir)), Job('unknown', ['unknown'], model_set, str(tmpdir))])
+    records = dict((r.job.name, r.metrics) for r in results)
+    assert records['gdd']['ok']
+    assert records['gdd']['bytes_read'] == 2 * 40 * 6 * 8 * 4
+    assert records['gdd']['worker']['pid'] != os.getpid()
+    assert not records['unknown']['ok']
+    assert records['unknown']['bytes_read'] == 0
+
+    table = format_summary([records['gdd'], records['unknown']]).splitlines()
+    assert len(table) == 4
+    assert table[2].startswith('gdd for gdd')
+
+def test_job_profile(model_set, tmpdir):
+    profile = str(tmpdir.join('job.prof'))
+    job = Job('gdd', ['gdd'], model_set, str(tmpdir), profile=profile)
+    job()
+    stats = pstats.Stats(profile)
+    assert any(name == '__call__' and 'variables.py' in fp for fp, line, name in stats.stats)
@@ -1,6 +1,10 @@
+import pytest
 import numpy as np
 
-from pyclimate.nchelpers import nc_copy_atts, nc_copy_var, get_monthly_time_slices
+from netCDF4 import Dataset
+
+from pyclimate.nchelpers import nc_copy_atts, nc_copy_var, nc_create_aggregated_time, get_monthly_time_slices, get_time_block_size, iter_time_blocks, \
+    get_copy_block_shape, iter_hyperslabs
 
 def test_nc_copy_global_atts(nc_3d, nc_3d_bare):
     nc_copy_atts(nc_3d, nc_3d_bare)
@@ -44,3 +48,76 @@ def test_nc_get_monthly_time_slices_nonzero_time_start(nc_3d_360day_tstart_15):
     expected = [slice(0, 15)] + [slice(i, i+30) for i in range(15, 345, 30)] + [slice(345, 360)]
     slices = get_monthly_time_slices(nc_3d_360day_tstart_15.variables['time'])
     assert slices  == expected
+
+@pytest.mark.parametrize(('max_block_mb', 'expected'), [
+    (1, 16), # 64 * 128 * 8 bytes per step
+    (0.001, 1),
+    (100, 32),
+])
+def test_get_time_block_size(nc_3d, max_block_mb, expected):
+    assert get_time_block_size(nc_3d.variables['tasmax'], max_block_mb) == expected
+
+def test_iter_time_blocks():
+    assert list(iter_time_blocks(10, 4)) == [slice(0, 4), slice(4, 8), slice(8, 10)]
+
+@pytest.fixture(scope='function')
+def nc_4d(tmpdir):
+    nc = Dataset(str(tmpdir.join('plev.nc')), 'w')
+    for name, size in [('time', None), ('plev', 4), ('lat', 6), ('lon', 8)]:
+        nc.createDimension(name, size)
+    nc.createDimension('bnds', 2)
+    var_lat = nc.createVariable('lat', 'f8', ('lat',))
+    var_lat.bounds = 'lat_bnds'
+    var_lat[:] = np.arange(6)
+    nc.createVariable('lat_bnds', 'f8', ('lat', 'bnds'))[:] = np.column_stack([np.arange(6) - .5, np.arange(6) + .5])
+    nc.createVariable('scalar', 'f4', ())[...] = 3.5
+    var = nc.createVariable('ta', 'f4', ('time', 'plev', 'lat', 'lon'), chunksizes=(2, 1, 6, 8), fill_value=1e20)
+    var[:] = np.random.rand(10, 4, 6, 8)
+    var[3, 2, 1, 1] = np.ma.masked
+    yield nc
+    nc.close()
+
+@pytest.fixture(scope='function')
+def nc_empty(tmpdir):
+    nc = Dataset(str(tmpdir.join('empty.nc')), 'w')
+    yield nc
+    nc.close()
+
+def test_nc_copy_var_data_4d(nc_4d, nc_empty):
+    nc_copy_var(nc_4d, nc_empty, 'ta', 'ta', copy_data=True, max_block_mb=0.001)
+    np.testing.assert_array_equal(nc_empty.variables['ta'][:], nc_4d.variables['ta'][:])
+    assert nc_empty.variables['ta'][3, 2, 1, 1] is np.ma.masked
+
+@pytest.mark.parametrize('bulk', [True, False])
+def test_nc_copy_var_data_low_rank(nc_4d, nc_empty, bulk):
+    nc_copy_var(nc_4d, nc_empty, 'lat', 'lat', copy_data=True, copy_attrs=True, bulk=bulk, max_block_mb=0.00001)
+    nc_copy_var(nc_4d, nc_empty, 'scalar', 'scalar', copy_data=True, bulk=bulk)
+    np.testing.assert_array_equal(nc_empty.variables['lat'][:], np.arange(6))
+    np.testing.assert_array_equal(nc_empty.variables['lat_bnds'][:], nc_4d.variables['lat_bnds'][:])
+    assert nc_empty.variables['scalar'][...] == 3.5
+
+@pytest.mark.parametrize(('max_block_mb', 'expected'), [
+    (1, [10, 4, 6, 8]),
+    (3 * 6 * 8 * 4 / 1048576., [1, 3, 6, 8]),
+    (5 * 4 * 6 * 8 * 4 / 1048576., [4, 4, 6, 8]), # Aligned with the time chunk size of 2
+    (0.00001, [1, 1, 1, 2]),
+])
+def test_get_copy_block_shape(nc_4d, max_block_mb, expected):
+    assert get_copy_block_shape(nc_4d.variables['ta'], max_block_mb) == expected
+
+def test_iter_hyperslabs():
+    slabs = list(iter_hyperslabs((3, 4), (2, 3)))
+    assert slabs == [(slice(0, 2), slice(0, 3)), (slice(0, 2), slice(3, 4)), (slice(2, 3), slice(0, 3)), (slice(2, 3), slice(3, 4))]
+
+@pytest.mark.parametrize('hour', [0, 12])
+def test_nc_create_aggregated_time_without_bounds(tmpdir, hour):
+    with Dataset(str(tmpdir.join('in.nc')), 'w') as nc_in, Dataset(str(tmpdir.join('out.nc')), 'w') as nc_out:
+        nc_in.createDimension('time', 59)
+        var_time = nc_in.createVariable('time', 'f8', 'time')
+        var_time.units = 'days since 2006-01-01'
+        var_time.calendar = '365_day'
+        var_time[:] = np.arange(59) + hour / 24.
+        slices = get_monthly_time_slices(var_time)
+        nc_create_aggregated_time(nc_in, nc_out, slices)
+        np.testing.assert_allclose(nc_out.variables['time_bnds'][:], [[0, 31], [31, 59]])
+        np.testing.assert_allclose(nc_out.variables['time'][:], [15.5, 45])
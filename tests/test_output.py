@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+
+from pyclimate.output import OutputPolicy
+
+def test_output_policy_defaults(nc_3d):
+    kwargs = OutputPolicy().get_create_kwargs('tasmax', nc_3d.variables['tasmax'], (32, 64, 128))
+    assert kwargs == {'datatype': nc_3d.variables['tasmax'].datatype}
+
+def test_output_policy_create_kwargs(nc_3d):
+    policy = OutputPolicy(complevel=5, shuffle=False, chunking='map', dtypes={'ffd': 'i1'})
+    kwargs = policy.get_create_kwargs('ffd', nc_3d.variables['tasmax'], (32, 64, 128))
+    assert kwargs == {'datatype': np.dtype('i1'), 'fill_value': -127, 'zlib': True, 'complevel': 5, 'shuffle': False, 'chunksizes': [1, 64, 128]}
+
+@pytest.mark.parametrize(('shape', 'itemsize', 'expected'), [
+    ((1024, 100, 200), 4, [1024, 16, 16]),
+    ((100, 3, 2000), 4, [100, 3, 873]),
+    ((10, 2, 2), 4, [10, 2, 2]),
+])
+def test_output_policy_timeseries_chunks(shape, itemsize, expected):
+    assert OutputPolicy(chunking='timeseries').get_chunksizes(shape, itemsize) == expected
+
+def test_output_policy_timeseries_chunks_within_block():
+    assert OutputPolicy(chunking='timeseries').get_chunksizes((1024, 100, 200), 4, max_time_chunk=100) == [100, 51, 51]
+
+@pytest.mark.parametrize(('policy', 'expected'), [
+    (OutputPolicy(packing={'gdd': (0.01, 0.)}), (-327.68, 327.67)),
+    (OutputPolicy(packing={'gdd': (0.01, 100.)}, dtypes={'gdd': 'i1'}), (98.72, 101.27)),
+    (OutputPolicy(dtypes={'gdd': 'i2'}), None),
+])
+def test_output_policy_packed_range(policy, expected):
+    packed_range = policy.get_packed_range('gdd')
+    if expected is None:
+        assert packed_range is None
+    else:
+        np.testing.assert_allclose(packed_range, expected)
+
+def test_output_policy_unknown_chunking():
+    with pytest.raises(ValueError):
+        OutputPolicy(chunking='diagonal')
@@ -1,6 +1,8 @@
+import os
 import pytest
 
-from pyclimate.path import group_files_by_model_set, iter_matching_cmip5_file
+from pyclimate.filters import Filter
+from pyclimate.path import group_files_by_model_set, iter_matching_cmip5_file, iter_netcdf_files, get_drs_dir_facets
 
 @pytest.mark.parametrize(('_filter', 'expected'), [
     ("[{'variable_name': 'tasmin'}]", 5),
@@ -29,3 +31,67 @@ def test_model_grouping(cmip5_file_list):
     assert len(groups) == 6
     assert 'CanESM2_rcp45_r1i1p1_20060101-23001231' in groups.keys()
     assert len(groups['CanESM2_rcp45_r1i1p1_20060101-23001231'].variables) == 2
+
+@pytest.mark.parametrize(('_filter', 'expected'), [
+    (None, 16),
+    ("[{'model': 'CanCM4'}]", 6),
+    ("[{'model': 'CanESM2', 'experiment': ['rcp26', 'rcp85']}]", 6),
+    ('pcic12', 10),
+    # Filename-only facets can't prune directories
+    ("[{'temporal_subset': '20060101-21001231'}]", 16),
+])
+def test_iter_netcdf_files_pruned(cmip5_tree, _filter, expected):
+    fl = list(iter_netcdf_files(cmip5_tree, _filter=_filter))
+    assert len(fl) == expected
+    assert len(list(iter_matching_cmip5_file(fl, _filter))) == len(list(iter_matching_cmip5_file(iter_netcdf_files(cmip5_tree), _filter)))
+
+def test_iter_netcdf_files_never_lists_pruned_dirs(cmip5_tree, monkeypatch):
+    listed = []
+    scandir = os.scandir
+    def spy(path):
+        listed.append(path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', spy)
+
+    list(iter_netcdf_files(cmip5_tree, _filter="[{'model': 'CanESM2', 'experiment': 'historical'}]"))
+    # Only the single branch probed to confirm its DRS layout is listed below each excluded directory
+    for excluded in ('CanCM4', 'rcp26', 'rcp45', 'rcp60', 'rcp85'):
+        branch = sorted(x for x in listed if excluded in x)
+        assert all(b.startswith(a) for a, b in zip(branch, branch[1:]))
+
+@pytest.mark.parametrize(('extra', '_filter', 'included'), [
+    # A branch with the activity and product levels, sorting after the first one
+    ('CMIP5/output/CCCMA/CanESM2/historical/day/atmos/day/r1i1p1/v20120101/tasmax/tasmax_day_CanESM2_historical_r1i1p1_19500101-20051231.nc',
+     "[{'model': 'CanESM2', 'experiment': 'historical'}]", True),
+    # A stray file on the first branch
+    ('CCCMA/CanCM4/notes.nc', "[{'variable_name': 'tasmax'}]", False),
+])
+def test_iter_netcdf_files_mixed_depths(tmpdir, cmip5_tree, extra, _filter, included):
+    expected = list(iter_matching_cmip5_file(iter_netcdf_files(cmip5_tree), _filter))
+    extra = str(tmpdir.join(os.path.relpath(cmip5_tree, str(tmpdir)), extra).ensure())
+    if included:
+        expected.append(extra)
+    assert set(expected) <= set(iter_netcdf_files(cmip5_tree, _filter=_filter))
+    assert set(expected) <= set(iter_netcdf_files(cmip5_tree, _filter=_filter, threads=4))
+
+def test_get_drs_dir_facets(cmip5_tree):
+    assert get_drs_dir_facets(cmip5_tree)[:2] == ['institute', 'model']
+    assert get_drs_dir_facets(os.path.join(cmip5_tree, 'CCCMA', 'CanESM2'))[0] == 'experiment'
+
+def test_filter_compiled():
+    _filter = Filter([{'model': 'CanESM2', 'experiment': ['rcp26', 'rcp45']}])
+    assert _filter.compiled == [{'model': frozenset(['CanESM2']), 'experiment': frozenset(['rcp26', 'rcp45'])}]
+    assert _filter.allows_facets({'model': 'CanESM2'})
+    assert not _filter.allows_facets({'model': 'CanESM2', 'experiment': 'rcp85'})
+    assert not _filter.allows_facets({'model': 'CanESM'})
+    assert Filter(_filter).compiled == _filter.compiled
+
+@pytest.mark.parametrize('_filter', [None, "[{'model': 'CanESM2', 'experiment': ['rcp26', 'rcp85']}]"])
+def test_iter_netcdf_files_threaded(cmip5_tree, _filter):
+    expected = sorted(iter_netcdf_files(cmip5_tree, _filter=_filter))
+    assert sorted(iter_netcdf_files(cmip5_tree, _filter=_filter, threads=4)) == expected
+
+def test_iter_netcdf_files_threaded_early_exit(cmip5_tree):
+    i = iter_netcdf_files(cmip5_tree, threads=4)
+    assert next(i).endswith('.nc')
+    i.close()
@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from pyclimate.pipeline import run_pipeline
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_run_pipeline(depth):
+    out = []
+    run_pipeline(lambda: iter(range(20)), lambda x: x * 2, out.append, depth)
+    assert out == [x * 2 for x in range(20)]
+
+def test_run_pipeline_stage_threads():
+    names = {}
+    def produce():
+        names['produce'] = threading.current_thread().name
+        for x in range(3):
+            yield x
+    def transform(x):
+        names['transform'] = threading.current_thread().name
+        return x
+    def consume(x):
+        names['consume'] = threading.current_thread().name
+    run_pipeline(produce, transform, consume, 1)
+    assert names == {'produce': 'reader', 'transform': threading.current_thread().name, 'consume': 'writer'}
+
+def failing(x):
+    if x == 5:
+        raise ValueError('Failed on {}'.format(x))
+    return x
+
+@pytest.mark.parametrize('stage', ['produce', 'transform', 'consume'])
+def test_run_pipeline_error(stage):
+    closed = []
+    nthreads = threading.active_count()
+    def produce():
+        try:
+            for x in range(1000):
+                yield failing(x) if stage == 'produce' else x
+        finally:
+            closed.append(threading.current_thread().name)
+    transform = failing if stage == 'transform' else (lambda x: x)
+    consume = failing if stage == 'consume' else (lambda x: None)
+
+    with pytest.raises(ValueError):
+        run_pipeline(produce, transform, consume, 2)
+    # The reader released its resources in its own thread
+    assert closed == ['reader']
+    assert threading.active_count() == nthreads
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset, default_fillvals
+
+from pyclimate.buffers import BufferPool
+from pyclimate.reader import read_classic_header, open_variable, MemmapVariable, NetCDF4Variable, HeaderError
+from pyclimate.variables import DerivedVariableSet, tas, gdd, pas
+
+@pytest.fixture(scope='function', params=['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT_DATA'])
+def classic_nc(request, tmpdir):
+    fp = str(tmpdir.join('classic.nc'))
+    nc = Dataset(fp, 'w', format=request.param)
+    nc.title = 'Test'
+    nc.createDimension('time', None)
+    nc.createDimension('lat', 3)
+    nc.createDimension('lon', 5)
+    nc.createDimension('bnds', 2)
+    nc.createVariable('lat', 'f8', ('lat',))[:] = [-45, 0, 45]
+    nc.createVariable('time_bnds', 'f8', ('time', 'bnds'))[:] = np.arange(14).reshape(7, 2)
+
+    var = nc.createVariable('tasmax', 'f4', ('time', 'lat', 'lon'))
+    var.missing_value = np.float32(-1)
+    data = np.arange(7 * 3 * 5, dtype='f4').reshape(7, 3, 5)
+    data[0, 0, 0] = -1
+    data[1, 1, 1] = default_fillvals['f4']
+    var[:] = data
+
+    # Only partly written, so later records hold the fill value
+    count = nc.createVariable('count', 'i2', ('time', 'lat', 'lon'), fill_value=-9)
+    count[:4] = 3
+
+    packed = nc.createVariable('packed', 'i2', ('time', 'lat', 'lon'))
+    packed.scale_factor = 0.5
+    nc.close()
+    return fp
+
+def assert_same_as_netcdf4(fp, varname, key):
+    with Dataset(fp) as nc:
+        expected = nc.variables[varname][key]
+    actual = MemmapVariable(fp, varname)[key]
+    assert actual.shape == expected.shape
+    np.testing.assert_array_equal(np.ma.getmaskarray(actual), np.ma.getmaskarray(expected))
+    np.testing.assert_array_equal(actual.filled(0), expected.filled(0))
+
+def test_read_classic_header(classic_nc):
+    header = read_classic_header(classic_nc)
+    assert header.numrecs == 7
+    assert header.dimensions == [('time', None), ('lat', 3), ('lon', 5), ('bnds', 2)]
+    assert header.attributes == {'title': 'Test'}
+    assert header.variables['tasmax']['attributes']['missing_value'] == -1
+    assert header.is_record_variable('tasmax')
+    assert not header.is_record_variable('lat')
+
+def test_read_classic_header_hdf5(model_set):
+    assert read_classic_header(model_set['tasmax']) is None
+    with pytest.raises(HeaderError):
+        MemmapVariable(model_set['tasmax'], 'tasmax')
+
+@pytest.mark.parametrize('varname', ['tasmax', 'count', 'time_bnds'])
+def test_memmap_variable(classic_nc, varname):
+    for key in [slice(None), slice(2, 5), (slice(1, 6, 2), 1)]:
+        assert_same_as_netcdf4(classic_nc, varname, key)
+    assert_same_as_netcdf4(classic_nc, 'lat', slice(None))
+
+def test_memmap_single_record_variable(tmpdir):
+    # Records of a file with a single record variable are not padded
+    fp = str(tmpdir.join('single.nc'))
+    with Dataset(fp, 'w', format='NETCDF3_CLASSIC') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('x', 3)
+        nc.createVariable('flag', 'i1', ('time', 'x'))[:] = np.arange(15).reshape(5, 3)
+    assert_same_as_netcdf4(fp, 'flag', slice(None))
+
+def test_memmap_is_a_view(classic_nc):
+    data = MemmapVariable(classic_nc, 'tasmax')[2:4]
+    assert isinstance(data, np.ma.MaskedArray)
+    assert not data.data.flags.owndata
+    assert isinstance(data.data.base, np.memmap) or isinstance(data.data.base.base, np.memmap)
+
+@pytest.mark.parametrize('backend', ['memmap', 'netcdf4'])
+@pytest.mark.parametrize('varname', ['tasmax', 'count'])
+def test_read_raw(classic_nc, backend, varname):
+    variable = open_variable(classic_nc, varname, backend)
+    expected = variable[2:6]
+    pool = BufferPool()
+    data, mask = variable.read(slice(2, 6), pool)
+    assert not isinstance(data, np.ma.MaskedArray)
+    if np.ma.is_masked(expected):
+        np.testing.assert_array_equal(mask, np.ma.getmaskarray(expected))
+        assert mask is variable.read(slice(2, 6), pool)[1]
+    else:
+        assert mask is None
+    np.testing.assert_array_equal(data[~np.ma.getmaskarray(expected)], expected.compressed())
+    variable.close()
+
+def test_open_variable_fallback(classic_nc, model_set):
+    assert isinstance(open_variable(classic_nc, 'tasmax'), MemmapVariable)
+    assert isinstance(open_variable(classic_nc, 'packed'), NetCDF4Variable)
+    assert isinstance(open_variable(model_set['tasmax'], 'tasmax'), NetCDF4Variable)
+    assert isinstance(open_variable(classic_nc, 'tasmax', 'netcdf4'), NetCDF4Variable)
+    with pytest.raises(ValueError):
+        open_variable(classic_nc, 'tasmax', 'unknown')
+
+@pytest.mark.parametrize('reader', ['memmap', 'netcdf4'])
+def test_derive_classic(classic_model_set, tmpdir, reader):
+    derived = [tas(classic_model_set, str(tmpdir), max_block_mb=0.001), gdd(classic_model_set, str(tmpdir), max_block_mb=0.001),
+               pas(classic_model_set, str(tmpdir), aggregate='monthly')]
+    outfps = DerivedVariableSet(derived, reader=reader)()
+    expected = DerivedVariableSet([type(v)(classic_model_set, str(tmpdir.join('expected')), aggregate=v.aggregate) for v in derived],
+                                  reader='netcdf4')()
+    for v, outfp, expected_fp in zip(derived, outfps, expected):
+        with Dataset(outfp) as nc, Dataset(expected_fp) as nc_expected:
+            np.testing.assert_allclose(nc.variables[v.variable_name][:], nc_expected.variables[v.variable_name][:])
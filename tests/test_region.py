@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from pyclimate.region import Region, get_bbox_window, get_index_range
+from pyclimate.variables import DerivedVariableSet, get_derived_variable
+
+LATS = np.linspace(-90, 90, 6)
+LONS = np.linspace(0, 360, 8, endpoint=False)
+
+def test_get_index_range():
+    assert get_index_range(LATS, -20, 60) == (2, 5)
+    assert get_index_range(LATS[::-1], -20, 60) == (1, 4)
+    assert get_index_range(LATS, 91, 100) == (6, 6)
+
+def test_bbox_window():
+    window = get_bbox_window(LATS, LONS, (-20, 60, -140, -40))
+    assert window.lat_slice == slice(2, 5)
+    assert list(window.lon_index) == [5, 6, 7] and window.wrap == 0
+    assert window.shape == (3, 3)
+
+def test_bbox_window_wraparound():
+    window = get_bbox_window(LATS, LONS, (0, 90, 300, 50))
+    assert list(window.lon_index) == [7, 0, 1]
+    np.testing.assert_array_equal(window.get_lons(LONS), [-45, 0, 45])
+    assert window.get_keys(slice(None), slice(None)) == [(slice(3, 6), slice(7, 8)), (slice(3, 6), slice(0, 2))]
+    assert window.get_keys(slice(None), slice(1, 3)) == [(slice(3, 6), slice(0, 2))]
+    # The same box on a -180-180 grid crosses no seam
+    window = get_bbox_window(LATS, LONS - 180, (0, 90, 300, 50))
+    assert list(window.lon_index) == [3, 4, 5] and window.wrap == 0
+
+def test_bbox_window_empty():
+    with pytest.raises(ValueError):
+        get_bbox_window(LATS, LONS, (10, 15, 0, 360))
+
+def test_invalid_region():
+    with pytest.raises(ValueError):
+        Region()
+    with pytest.raises(ValueError):
+        Region(bbox=(60, 10, 0, 10))
+
+def derive(base_variables, outdir, region=None, **kwargs):
+    outfp, = DerivedVariableSet([get_derived_variable('gdd', base_variables, outdir, region=region)], **kwargs)()
+    with Dataset(outfp) as nc:
+        return nc.variables['gdd'][:], nc.variables['lat'][:], nc.variables['lon'][:]
+
+@pytest.mark.parametrize('kwargs', [{}, {'pipeline_depth': 2}, {'tiles': (2, 2), 'processes': 2}])
+def test_derive_bbox(model_set, tmpdir, kwargs):
+    expected, lats, lons = derive(model_set, str(tmpdir.join('full')))
+    region = Region(bbox=(0, 90, 300, 50))
+    gdd, subset_lats, subset_lons = derive(model_set, str(tmpdir.join('region')), region, **kwargs)
+    assert gdd.shape == (40, 3, 3)
+    np.testing.assert_array_equal(gdd, expected[:, 3:6][:, :, [7, 0, 1]])
+    np.testing.assert_array_equal(subset_lats, lats[3:6])
+    np.testing.assert_array_equal(subset_lons, [-45, 0, 45])
+
+def test_derive_mask(model_set, tmpdir):
+    expected, lats, lons = derive(model_set, str(tmpdir.join('full')))
+    mask_fp = str(tmpdir.join('mask.nc'))
+    with Dataset(mask_fp, 'w') as nc:
+        nc.createDimension('lat', 6)
+        nc.createDimension('lon', 8)
+        mask = np.zeros((6, 8), dtype='i1')
+        mask[1, 7] = mask[2, 0] = mask[2, 1] = 1
+        nc.createVariable('region', 'i1', ('lat', 'lon'))[:] = mask
+    gdd, subset_lats, subset_lons = derive(model_set, str(tmpdir.join('region')), Region(mask_fp=mask_fp), tiles=(1, 2), processes=2)
+    assert gdd.shape == (40, 2, 3)
+    np.testing.assert_array_equal(subset_lons, [-45, 0, 45])
+    assert np.all(gdd.mask[:, 0, 1:]) and np.all(gdd.mask[:, 1, 0])
+    np.testing.assert_array_equal(gdd[:, 0, 0], expected[:, 1, 7])
+    np.testing.assert_array_equal(gdd[:, 1, 1:], expected[:, 2, :2])
+
+def test_region_in_parameters(model_set, tmpdir):
+    v = get_derived_variable('gdd', model_set, str(tmpdir), region=Region(bbox=(0, 90, 300, 50)))
+    assert v.parameters['region'] == {'bbox': [0., 90., 300., 50.], 'mask_fp': None, 'mask_varname': None}
@@ -0,0 +1,82 @@
+import io
+import os
+import signal
+
+import pytest
+from netCDF4 import Dataset
+
+from pyclimate.scheduler import Job, JobFailed, Scheduler
+
+class FlakyJob(Job):
+    calls = 0
+
+    def __call__(self):
+        FlakyJob.calls += 1
+        if FlakyJob.calls == 1:
+            raise IOError('Transient failure')
+        return super(FlakyJob, self).__call__()
+
+class KilledJob(Job):
+    """Kills its worker process the first time it runs, as the OOM killer would.
+    """
+
+    def __call__(self):
+        marker = os.path.join(self.outdir, 'killed')
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+            os.kill(os.getpid(), signal.SIGKILL)
+        return super(KilledJob, self).__call__()
+
+def test_job_size(model_set, tmpdir):
+    job = Job('test', ['ffd'], model_set, str(tmpdir))
+    assert job.input_files == [model_set['tasmin']]
+    assert job.size == os.path.getsize(model_set['tasmin'])
+
+def test_scheduler_longest_job_first(model_set, tmpdir):
+    jobs = [Job('ffd', ['ffd'], model_set, str(tmpdir)), Job('pas', ['gdd', 'pas'], model_set, str(tmpdir))]
+    results = Scheduler().run(jobs)
+    assert [r.job.name for r in results] == ['pas', 'ffd']
+    assert all(r.ok for r in results)
+    assert len(results[0].outputs) == 2
+
+def test_scheduler_missing_base_variables_not_retried(model_set, tmpdir):
+    job = Job('gdd', ['gdd'], {'tasmax': model_set['tasmax']}, str(tmpdir))
+    with pytest.warns(UserWarning):
+        result, = Scheduler(retries=3).run([job])
+    assert not result.ok
+    assert result.attempts == 1
+    assert JobFailed.__name__ in result.error.splitlines()[-1]
+
+def test_scheduler_retry(model_set, tmpdir):
+    result, = Scheduler(retries=1).run([FlakyJob('tas', ['tas'], model_set, str(tmpdir))])
+    assert result.ok
+    assert result.attempts == 2
+
+def test_scheduler_pool(model_set, tmpdir):
+    jobs = [Job(v, [v], model_set, str(tmpdir)) for v in ['tas', 'gdd', 'hdd', 'ffd', 'unknown']]
+    results = Scheduler(processes=2).run(jobs)
+    assert len(results) == 5
+    assert sorted(r.job.name for r in results if not r.ok) == ['unknown']
+    for r in results:
+        if r.ok:
+            with Dataset(r.outputs[0]) as nc:
+                assert len(nc.variables['time']) == 40
+
+@pytest.mark.parametrize(('retries', 'ok'), [(0, False), (1, True)])
+def test_scheduler_pool_worker_killed(model_set, tmpdir, retries, ok):
+    jobs = [KilledJob('tas', ['tas'], model_set, str(tmpdir)), Job('gdd', ['gdd'], model_set, str(tmpdir))]
+    results = Scheduler(processes=2, retries=retries).run(jobs)
+    assert len(results) == 2
+    killed = [r for r in results if r.job.name == 'tas'][0]
+    assert killed.ok == ok
+    if not ok:
+        assert 'worker process died' in killed.error
+    # The other job in flight when the pool broke is retried, or fails with it
+    assert all(r.ok for r in results) == ok
+
+def test_progress(model_set, tmpdir, monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr('sys.stderr', stream)
+    Scheduler(progress=True).run([Job('tas', ['tas'], model_set, str(tmpdir))])
+    assert stream.getvalue().startswith('[1/1 jobs, 100% of input]')
+    assert 'GB/s' in stream.getvalue()
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pyclimate.scheduler import Job, Scheduler
+from pyclimate.staging import StagingCache
+from pyclimate.variables import DerivedVariableSet, get_derived_variable
+
+def test_stage(small_model_set, tmpdir):
+    cache = StagingCache(str(tmpdir.join('scratch')), 10 * 1024 * 1024)
+    fp = small_model_set['tasmax']
+    local = cache.stage(fp)
+    assert local != fp and local.startswith(cache.directory)
+    assert open(local, 'rb').read() == open(fp, 'rb').read()
+    assert cache.stage(fp) == local
+    assert cache.used_bytes == os.path.getsize(fp)
+
+def test_stage_changed_source(small_model_set, tmpdir):
+    cache = StagingCache(str(tmpdir.join('scratch')), 10 * 1024 * 1024)
+    fp = small_model_set['tasmax']
+    local = cache.stage(fp)
+    with Dataset(fp, 'a') as nc:
+        nc.variables['tasmax'][0] = 300.
+    os.utime(fp, (0, 0))
+    assert cache.stage(fp) == local
+    with Dataset(local) as nc:
+        assert np.all(nc.variables['tasmax'][0] == 300.)
+
+def test_evict_least_recently_used(small_model_set, tmpdir):
+    sizes = dict((x, os.path.getsize(fp)) for x, fp in small_model_set.items())
+    cache = StagingCache(str(tmpdir.join('scratch')), sizes['tasmax'] + sizes['tasmin'])
+    tasmax, tasmin = cache.stage(small_model_set['tasmax']), cache.stage(small_model_set['tasmin'])
+    cache.stage(small_model_set['tasmax'])
+    cache.stage(small_model_set['pr'])
+    assert os.path.exists(tasmax)
+    assert not os.path.exists(tasmin)
+    assert cache.used_bytes <= cache.max_bytes
+
+def test_reserved_files_are_kept(small_model_set, tmpdir):
+    size = os.path.getsize(small_model_set['tasmax'])
+    cache = StagingCache(str(tmpdir.join('scratch')), size + 1)
+    cache.reserve([small_model_set['tasmax']])
+    tasmax = cache.stage(small_model_set['tasmax'])
+    # No room for tasmin without evicting the reserved tasmax
+    assert cache.stage(small_model_set['tasmin']) == small_model_set['tasmin']
+    assert os.path.exists(tasmax)
+    cache.release([small_model_set['tasmax']])
+    assert cache.stage(small_model_set['tasmin']) != small_model_set['tasmin']
+    assert not os.path.exists(tasmax)
+
+def test_too_large(small_model_set, tmpdir):
+    cache = StagingCache(str(tmpdir.join('scratch')), 100)
+    assert cache.stage(small_model_set['pr']) == small_model_set['pr']
+    assert cache.used_bytes == 0
+
+def test_derive_staged(small_model_set, tmpdir):
+    cache = StagingCache(str(tmpdir.join('scratch')), 10 * 1024 * 1024)
+    outfp, = DerivedVariableSet([get_derived_variable('gdd', small_model_set, str(tmpdir.join('staged')))], incremental=True, staging=cache)()
+    expected_fp, = DerivedVariableSet([get_derived_variable('gdd', small_model_set, str(tmpdir.join('direct')))])()
+    assert outfp.startswith(str(tmpdir.join('staged')))
+    with Dataset(outfp) as nc, Dataset(expected_fp) as nc_expected:
+        np.testing.assert_array_equal(nc.variables['gdd'][:], nc_expected.variables['gdd'][:])
+    assert cache.used_bytes == os.path.getsize(small_model_set['tasmax']) + os.path.getsize(small_model_set['tasmin'])
+
+def test_scheduler_releases_reservations(small_model_set, tmpdir):
+    cache = StagingCache(str(tmpdir.join('scratch')), 10 * 1024 * 1024)
+    jobs = [Job('set', [v], small_model_set, str(tmpdir.join('out')), staging=cache) for v in ('gdd', 'pas')]
+    results = Scheduler().run(jobs)
+    assert all(r.ok for r in results)
+    assert cache.conn.execute('SELECT SUM(refs) FROM files').fetchone()[0] == 0
+    assert cache.conn.execute('SELECT COUNT(*) FROM files WHERE staged = 1').fetchone()[0] == 3
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from pyclimate.tiling import get_tile_slices, get_tiles, assemble_tiles
+from pyclimate.variables import DerivedVariableSet, gdd, ffd, tas
+
+@pytest.mark.parametrize(('size', 'ntiles', 'expected'), [
+    (10, 1, [slice(0, 10)]),
+    (10, 3, [slice(0, 3), slice(3, 7), slice(7, 10)]),
+    (2, 4, [slice(0, 1), slice(1, 2)]),
+])
+def test_get_tile_slices(size, ntiles, expected):
+    assert get_tile_slices(size, ntiles) == expected
+
+def test_assemble_tiles():
+    a = np.ma.masked_greater(np.arange(5 * 6 * 7).reshape(5, 6, 7), 200)
+    rows = get_tiles(a.shape, (2, 3))
+    assert len(rows) == 2 and len(rows[0]) == 3
+    assembled = assemble_tiles([[a[..., row, col] for row, col in tiles] for tiles in rows])
+    np.testing.assert_array_equal(assembled, a)
+    np.testing.assert_array_equal(assembled.mask, a.mask)
+
+@pytest.mark.parametrize(('tiles', 'max_block_mb'), [((2, 3), 100), ((3, 4), 0.001), ((1, 2), 0.01)])
+def test_derive_tiled(model_set, tmpdir, tiles, max_block_mb):
+    derived = [gdd(model_set, str(tmpdir), max_block_mb=max_block_mb),
+               ffd(model_set, str(tmpdir), max_block_mb=max_block_mb),
+               tas(model_set, str(tmpdir), max_block_mb=max_block_mb, aggregate='monthly')]
+    outfps = DerivedVariableSet(derived, tiles=tiles, processes=2)()
+    expected = DerivedVariableSet([type(v)(model_set, str(tmpdir.join('whole')), aggregate=v.aggregate) for v in derived])()
+    for v, outfp, expected_fp in zip(derived, outfps, expected):
+        with Dataset(outfp) as nc, Dataset(expected_fp) as nc_expected:
+            np.testing.assert_allclose(nc.variables[v.variable_name][:], nc_expected.variables[v.variable_name][:])
+
+def test_tiled_block_size_within_budget(model_set, tmpdir):
+    # tasmax, tasmin, tas and its output: 4 arrays of 6 x 8 doubles per time step, 30 steps in the budget
+    max_block_mb = 30 * 4 * 6 * 8 * 8 / 1024. / 1024
+    whole = DerivedVariableSet([tas(model_set, str(tmpdir.join('whole')), max_block_mb=max_block_mb)])
+    whole()
+    tiled = DerivedVariableSet([tas(model_set, str(tmpdir), max_block_mb=max_block_mb)], tiles=(2, 2), processes=2)
+    tiled()
+    # 40 steps in blocks of 30, and of 10 as three blocks are held at once when tiled
+    assert whole.metrics.blocks == 2
+    assert tiled.metrics.blocks == 4
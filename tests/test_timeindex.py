@@ -0,0 +1,44 @@
+import pytest
+import numpy as np
+from netCDF4 import num2date
+
+from pyclimate.timeindex import TimeIndex, get_time_index, get_run_slices
+
+@pytest.mark.parametrize(('units', 'calendar'), [
+    ('days since 1850-01-01', '365_day'),
+    ('days since 1850-01-01', 'noleap'),
+    ('days since 1850-01-01', '360_day'),
+    ('days since 1850-01-01', 'all_leap'),
+    ('hours since 1949-12-01 12:00:00', '360_day'),
+    ('days since 1850-01-01', 'standard'),
+    ('days since 1850-01-01', 'proleptic_gregorian'),
+    ('hours since 1979-06-01 06:00:00', 'gregorian'),
+    ('days since 0001-01-01', 'julian'),
+])
+def test_years_and_months_match_num2date(units, calendar):
+    values = np.sort(np.random.RandomState(0).uniform(0, 200000, 500))
+    index = TimeIndex(values, units, calendar)
+    dates = num2date(values, units, calendar)
+    np.testing.assert_array_equal(index.years, [d.year for d in dates])
+    np.testing.assert_array_equal(index.months, [d.month for d in dates])
+
+def test_seasonal_annual_water_year_slices():
+    # Two 360 day years starting in January
+    index = TimeIndex(np.arange(720) + 0.5, 'days since 2000-01-01', '360_day')
+    assert index.seasonal_slices() == [slice(0, 60)] + [slice(i, i + 90) for i in range(60, 690, 90)] + [slice(690, 720)]
+    assert index.annual_slices() == [slice(0, 360), slice(360, 720)]
+    assert index.water_year_slices() == [slice(0, 270), slice(270, 630), slice(630, 720)]
+    assert len(index.monthly_slices()) == 24
+
+def test_unknown_frequency():
+    index = TimeIndex(np.arange(10), 'days since 2000-01-01', '360_day')
+    with pytest.raises(ValueError):
+        index.slices('weekly')
+
+def test_get_run_slices():
+    assert get_run_slices([]) == []
+    assert get_run_slices([1, 1, 2, 3, 3, 3]) == [slice(0, 2), slice(2, 3), slice(3, 6)]
+
+def test_get_time_index_cached(nc_3d_360day):
+    index = get_time_index(nc_3d_360day.variables['time'])
+    assert get_time_index(nc_3d_360day.variables['time']) is index
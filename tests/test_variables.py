@@ -0,0 +1,236 @@
+import warnings
+from collections import OrderedDict
+
+import pytest
+import numpy as np
+from netCDF4 import Dataset
+
+from pyclimate.output import OutputPolicy
+from pyclimate.timeindex import TimeIndex
+from pyclimate.variables import DerivableBase, DerivedVariableSet, DerivedVariable, DerivationPlan, AGGREGATE_FREQUENCIES, \
+    DERIVED_VARIABLES, get_required_vars, register, tas
+
+def get_derivable_base(base_variables):
+    base = DerivableBase(model='CanESM2', experiment='rcp85', ensemble_member='r1i1p1', temporal_subset='20060101-20061231')
+    for k, v in base_variables.items():
+        base.add_base_variable(k, v)
+    return base
+
+def read_base(base_variables, varname):
+    with Dataset(base_variables[varname]) as nc:
+        return nc.variables[varname][:]
+
+def expected_values(base_variables, variable):
+    tasmax = read_base(base_variables, 'tasmax')
+    tasmin = read_base(base_variables, 'tasmin')
+    tas = (tasmax + tasmin) / 2
+    if variable == 'tas':
+        return tas
+    elif variable == 'gdd':
+        return np.where(tas > 278.15, tas - 278.15, 0)
+    elif variable == 'hdd':
+        return np.where(tas < 291.15, np.absolute(tas - 291.15), 0)
+    elif variable == 'ffd':
+        return np.where(tasmin > 273.15, 1, 0)
+    elif variable == 'pas':
+        return np.where(tasmax < 273.15, read_base(base_variables, 'pr'), 0)
+
+@pytest.mark.parametrize('variable', ['tas', 'gdd', 'hdd', 'ffd', 'pas'])
+def test_derive_variable(model_set, tmpdir, variable):
+    base = get_derivable_base(model_set)
+    outfp = base.derive_variable(variable, str(tmpdir))()
+    with Dataset(outfp) as nc:
+        np.testing.assert_allclose(nc.variables[variable][:], expected_values(model_set, variable), rtol=1e-6)
+
+def test_derive_variable_missing_base(model_set, tmpdir):
+    base = get_derivable_base({'tasmax': model_set['tasmax']})
+    with pytest.warns(UserWarning):
+        assert base.derive_variable('gdd', str(tmpdir))() == 1
+
+def test_derive_variables_fused(model_set, tmpdir):
+    variables = ['tas', 'gdd', 'hdd', 'ffd', 'pas']
+    base = get_derivable_base(model_set)
+    fused = base.derive_variables(variables, str(tmpdir.join('fused')))
+    assert isinstance(fused, DerivedVariableSet)
+
+    outfps = fused()
+    assert len(outfps) == len(variables)
+    for variable, outfp in zip(variables, outfps):
+        single_fp = base.derive_variable(variable, str(tmpdir.join('single')))()
+        with Dataset(outfp) as nc, Dataset(single_fp) as nc_single:
+            np.testing.assert_array_equal(nc.variables[variable][:], nc_single.variables[variable][:])
+
+@pytest.mark.parametrize(('pipeline_depth', 'max_block_mb'), [(1, 100), (2, 0.001), (4, 0.01)])
+def test_derive_variables_pipelined(model_set, tmpdir, pipeline_depth, max_block_mb):
+    variables = ['tas', 'gdd', 'ffd', 'pas']
+    base = get_derivable_base(model_set)
+    derived = [base.derive_variable(v, str(tmpdir), max_block_mb=max_block_mb) for v in variables]
+    derived.append(base.derive_variable('hdd', str(tmpdir), max_block_mb=max_block_mb, aggregate='monthly'))
+    outfps = DerivedVariableSet(derived, pipeline_depth=pipeline_depth)()
+    for v, outfp in zip(derived, outfps):
+        single_fp = base.derive_variable(v.variable_name, str(tmpdir.join('single')), aggregate=v.aggregate)()
+        with Dataset(outfp) as nc, Dataset(single_fp) as nc_single:
+            np.testing.assert_allclose(nc.variables[v.variable_name][:], nc_single.variables[v.variable_name][:])
+
+def test_derive_variables_partial(model_set, tmpdir):
+    base = get_derivable_base({k: model_set[k] for k in ('tasmax', 'tasmin')})
+    with pytest.warns(UserWarning):
+        outfps = base.derive_variables(['gdd', 'pas', 'unknown'], str(tmpdir))()
+    assert len(outfps) == 2
+    assert outfps[0].endswith('.nc')
+    assert outfps[1] == 1
+
+@pytest.mark.parametrize('max_block_mb', [0.0001, 0.01, 100])
+def test_derive_variable_block_size(model_set, tmpdir, max_block_mb):
+    base = get_derivable_base(model_set)
+    outfp = base.derive_variable('gdd', str(tmpdir), max_block_mb=max_block_mb)()
+    with Dataset(outfp) as nc:
+        np.testing.assert_allclose(nc.variables['gdd'][:], expected_values(model_set, 'gdd'), rtol=1e-6)
+
+@pytest.mark.parametrize('aggregate', ['monthly', 'seasonal', 'annual'])
+@pytest.mark.parametrize('variable', ['tas', 'gdd'])
+def test_derive_variable_aggregate(model_set, tmpdir, aggregate, variable):
+    base = get_derivable_base(model_set)
+    derived = base.derive_variable(variable, str(tmpdir), aggregate=aggregate, max_block_mb=0.01)
+    outfp = derived()
+    assert '/{}/'.format(AGGREGATE_FREQUENCIES[aggregate]) in outfp
+
+    with Dataset(model_set['tasmax']) as nc:
+        slices = TimeIndex(nc.variables['time'][:], nc.variables['time'].units, nc.variables['time'].calendar).slices(aggregate)
+    daily = expected_values(model_set, variable)
+    reduce = np.mean if variable == 'tas' else np.sum
+    expected = np.array([reduce(daily[s], axis=0) for s in slices])
+
+    with Dataset(outfp) as nc:
+        np.testing.assert_allclose(nc.variables[variable][:], expected, rtol=1e-5)
+        assert nc.variables[variable].cell_methods == 'time: {}'.format(derived.cell_method)
+        assert len(nc.variables['time']) == len(slices)
+        assert nc.variables['time_bnds'][0, 0] == 0
+        assert nc.variables['time_bnds'][-1, 1] == 40
+
+def test_derive_variable_unknown_aggregate(model_set, tmpdir):
+    with pytest.raises(ValueError):
+        get_derivable_base(model_set).derive_variable('gdd', str(tmpdir), aggregate='weekly')
+
+def test_derive_variable_output_policy(model_set, tmpdir):
+    policy = OutputPolicy(complevel=4, chunking='timeseries', dtypes={'ffd': 'i1'}, packing={'gdd': (0.01, 0.)})
+    base = get_derivable_base(model_set)
+    ffd_fp, gdd_fp = base.derive_variables(['ffd', 'gdd'], str(tmpdir), output_policy=policy)()
+
+    with Dataset(ffd_fp) as nc:
+        ncvar = nc.variables['ffd']
+        assert ncvar.dtype == np.int8
+        assert ncvar.filters()['zlib']
+        assert ncvar.chunking() == [40, 6, 8]
+        np.testing.assert_array_equal(ncvar[:], expected_values(model_set, 'ffd'))
+
+    with Dataset(gdd_fp) as nc:
+        ncvar = nc.variables['gdd']
+        assert ncvar.dtype == np.int16
+        assert ncvar.scale_factor == 0.01
+        np.testing.assert_allclose(ncvar[:], expected_values(model_set, 'gdd'), atol=0.005 + 1e-6)
+
+def test_derive_variable_timeseries_chunks_within_block(model_set, tmpdir):
+    # Blocks of 13 time steps: tasmax, tasmin, tas and gdd, and the gdd output, of 6 x 8 doubles
+    max_block_mb = 13 * 5 * 6 * 8 * 8 / 1024. / 1024
+    policy = OutputPolicy(complevel=4, chunking='timeseries')
+    base = get_derivable_base(model_set)
+    gdd_fp, = base.derive_variables(['gdd'], str(tmpdir), max_block_mb=max_block_mb, output_policy=policy)()
+    with Dataset(gdd_fp) as nc:
+        assert nc.variables['gdd'].chunking() == [13, 6, 8]
+        np.testing.assert_allclose(nc.variables['gdd'][:], expected_values(model_set, 'gdd'), rtol=1e-6)
+
+def test_derive_variable_packed_totals(model_set, tmpdir):
+    policy = OutputPolicy(packing={'gdd': (0.01, 0.)})
+    base = get_derivable_base(model_set)
+    with pytest.warns(UserWarning, match='monthly totals'):
+        base.derive_variable('gdd', str(tmpdir), aggregate='monthly', output_policy=policy)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        base.derive_variable('gdd', str(tmpdir), output_policy=policy)
+        base.derive_variable('tas', str(tmpdir), aggregate='monthly', output_policy=OutputPolicy(packing={'tas': (0.01, 250.)}))
+
+def test_registry():
+    assert list(DERIVED_VARIABLES) == ['tas', 'gdd', 'hdd', 'ffd', 'pas']
+    assert get_required_vars(['gdd', 'pas']) == ['tasmax', 'tasmin', 'pr']
+
+def test_plan_shares_intermediates(model_set, tmpdir, monkeypatch):
+    calls = []
+    compute_into = tas.compute_into
+    def counting_compute_into(self, block, out):
+        calls.append(self)
+        compute_into(self, block, out)
+    monkeypatch.setattr(tas, 'compute_into', counting_compute_into)
+
+    base = get_derivable_base(model_set)
+    derived = [base.derive_variable(v, str(tmpdir)) for v in ('gdd', 'hdd', 'ffd')]
+    plan = DerivationPlan(derived)
+    assert list(plan.nodes) == ['tas', 'gdd', 'hdd', 'ffd']
+    assert plan.base_vars == ['tasmax', 'tasmin']
+
+    data = dict((x, read_base(model_set, x)[:3]) for x in plan.base_vars)
+    results = plan.evaluate(data)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(results[0], expected_values(model_set, 'gdd')[:3])
+
+def test_plan_masks_fill_values(model_set, tmpdir):
+    base = get_derivable_base(model_set)
+    plan = DerivationPlan([base.derive_variable(v, str(tmpdir)) for v in ('gdd', 'ffd', 'pas')])
+    data = dict((x, read_base(model_set, x)[:3].filled(1e20)) for x in plan.base_vars)
+    data['tasmax'][0, 0, 0] = 1e20
+    data['tasmin'][1, 0, 0] = 1e20
+    masks = dict((x, data[x] == 1e20) for x in data)
+    gdd, ffd, pas = plan.evaluate(data, masks)
+    assert gdd.mask[0, 0, 0] and gdd.mask[1, 0, 0]
+    assert not ffd.mask[0, 0, 0] and ffd.mask[1, 0, 0]
+    assert pas.mask[0, 0, 0] and not pas.mask[1, 0, 0]
+    assert gdd.mask.sum() == 2
+
+def test_plan_reuses_buffers(model_set, tmpdir):
+    base = get_derivable_base(model_set)
+    plan = DerivationPlan([base.derive_variable(v, str(tmpdir)) for v in ('gdd', 'hdd')], nbuffers=2)
+    data = dict((x, read_base(model_set, x)[:3]) for x in plan.base_vars)
+    first, second, third = [plan.evaluate(data)[0] for i in range(3)]
+    assert not np.shares_memory(first.data, second.data)
+    assert np.shares_memory(first.data, third.data)
+    nbytes = plan.buffers.nbytes
+    plan.evaluate(data)
+    assert plan.buffers.nbytes == nbytes
+    np.testing.assert_array_equal(third, expected_values(model_set, 'gdd')[:3])
+
+def test_register_derived_variable(model_set, tmpdir, monkeypatch):
+    monkeypatch.setattr('pyclimate.variables.DERIVED_VARIABLES', OrderedDict(DERIVED_VARIABLES))
+
+    @register
+    class gdd_frac(DerivedVariable):
+        variable_name = 'gdd_frac'
+        inputs = ['gdd', 'hdd']
+        variable_atts = {'units': '1', 'long_name': 'Fraction of degree days above the growing threshold'}
+
+        def compute(self, block):
+            total = block['gdd'] + block['hdd']
+            return np.where(total > 0, block['gdd'] / np.where(total > 0, total, 1), 0)
+
+    base = get_derivable_base(model_set)
+    v = base.derive_variable('gdd_frac', str(tmpdir))
+    assert v.required_vars == ['tasmax', 'tasmin']
+    assert list(DerivationPlan([v]).nodes) == ['tas', 'gdd', 'hdd', 'gdd_frac']
+    with Dataset(v()) as nc:
+        gdd, hdd = expected_values(model_set, 'gdd'), expected_values(model_set, 'hdd')
+        np.testing.assert_allclose(nc.variables['gdd_frac'][:], np.where(gdd + hdd > 0, gdd / np.where(gdd + hdd > 0, gdd + hdd, 1), 0), rtol=1e-6)
+
+def test_cyclic_dependency(monkeypatch):
+    monkeypatch.setattr('pyclimate.variables.DERIVED_VARIABLES', OrderedDict(DERIVED_VARIABLES))
+
+    @register
+    class a(DerivedVariable):
+        variable_name = 'a'
+        inputs = ['tasmax', 'b']
+
+    @register
+    class b(DerivedVariable):
+        variable_name = 'b'
+        inputs = ['a']
+
+    with pytest.raises(ValueError):
+        get_required_vars(['b'])
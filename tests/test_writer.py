@@ -0,0 +1,70 @@
+import os
+import signal
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from pyclimate.variables import DerivedVariableSet, tas
+from pyclimate.writer import WriterFailed, WriterProcess
+
+@pytest.fixture(scope='function')
+def output_nc(tmpdir):
+    fp = str(tmpdir.join('out.nc'))
+    with Dataset(fp, 'w') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('lat', 2)
+        nc.createVariable('x', 'f8', ('time', 'lat'))
+        nc.createVariable('x_sum', 'f8', ('time', 'lat'))
+    return fp
+
+def test_writer_process(output_nc):
+    writer = WriterProcess([(output_nc, 'x', None, None)])
+    writer.start()
+    data = np.arange(12.).reshape(6, 2)
+    for start in range(0, 6, 2):
+        buf = data[start:start + 2].copy()
+        writer.write(slice(start, start + 2), [buf])
+        # Results are copied when queued
+        buf[:] = -1
+    metrics = writer.finish()
+    assert metrics.blocks == 3 and metrics.bytes_written == data.nbytes
+    assert writer.exitcode == 0
+    with Dataset(output_nc) as nc:
+        np.testing.assert_array_equal(nc.variables['x'][:], data)
+
+def test_writer_process_aggregates(output_nc):
+    writer = WriterProcess([(output_nc, 'x_sum', [slice(0, 3), slice(3, 6)], 'sum')])
+    writer.start()
+    data = np.arange(12.).reshape(6, 2)
+    for start in range(0, 6, 4):
+        writer.write(slice(start, min(start + 4, 6)), [data[start:start + 4]])
+    writer.finish()
+    with Dataset(output_nc) as nc:
+        np.testing.assert_array_equal(nc.variables['x_sum'][:], [data[:3].sum(axis=0), data[3:].sum(axis=0)])
+
+def test_writer_process_error(output_nc):
+    writer = WriterProcess([(output_nc, 'missing', None, None)])
+    writer.start()
+    # Raised by write once the writer has stopped, or by finish
+    with pytest.raises(KeyError):
+        for i in range(10):
+            writer.write(slice(i, i + 1), [np.zeros((1, 2))])
+        writer.finish()
+    writer.abort()
+
+def test_writer_process_killed(output_nc):
+    writer = WriterProcess([(output_nc, 'x', None, None)])
+    writer.start()
+    os.kill(writer.pid, signal.SIGKILL)
+    writer.join()
+    with pytest.raises(WriterFailed):
+        writer.finish()
+
+def test_pipelined_metrics(model_set, tmpdir):
+    derived_set = DerivedVariableSet([tas(model_set, str(tmpdir), max_block_mb=0.01)], pipeline_depth=2)
+    outfp, = derived_set()
+    assert derived_set.metrics.blocks > 1
+    assert derived_set.metrics.seconds['write'] > 0
+    with Dataset(outfp) as nc:
+        assert nc.variables['tas'].shape == (40, 6, 8)